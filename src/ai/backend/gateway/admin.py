@@ -3,6 +3,7 @@ import logging
 from typing import (
     Any,
     Iterable,
+    Optional,
     Tuple,
 )
 import re
@@ -13,6 +14,8 @@ from aiojobs.aiohttp import atomic
 import graphene
 from graphql.execution.executors.asyncio import AsyncioExecutor
 from graphql.error import GraphQLError, format_error
+from graphql.language.ast import OperationDefinition
+from graphql.language.parser import parse as parse_gql
 import trafaret as t
 
 from ai.backend.common.logging import BraceStyleAdapter
@@ -46,6 +49,28 @@ class GQLLoggingMiddleware:
         return next(root, info, **args)
 
 
+def is_readonly_operation(query: str, operation_name: Optional[str]) -> bool:
+    """
+    Checks if the operation to be executed in the given GraphQL document
+    is a query (not a mutation), so that it may be served from a read replica.
+    """
+    try:
+        document = parse_gql(query)
+    except GraphQLError:
+        # Let the schema executor report the syntax error.
+        return False
+    operations = [
+        defn for defn in document.definitions
+        if isinstance(defn, OperationDefinition)
+    ]
+    if operation_name is not None:
+        operations = [
+            op for op in operations
+            if op.name is not None and op.name.value == operation_name
+        ]
+    return len(operations) == 1 and operations[0].operation == 'query'
+
+
 @atomic
 @auth_required
 @check_api_params(
@@ -59,19 +84,24 @@ async def handle_gql(request: web.Request, params: Any) -> web.Response:
     schema = request.app['admin.gql_schema']
     manager_status = await request.app['shared_config'].get_manager_status()
     known_slot_types = await request.app['shared_config'].get_resource_slots()
+    if is_readonly_operation(params['query'], params['operation_name']):
+        dbpool = request.app['dbpool_router'].readonly
+    else:
+        dbpool = request.app['dbpool']
     context = {
         'local_config': request.app['local_config'],
         'shared_config': request.app['shared_config'],
         'etcd': request.app['shared_config'].etcd,
         'user': request['user'],
         'access_key': request['keypair']['access_key'],
-        'dbpool': request.app['dbpool'],
+        'dbpool': dbpool,
         'redis_stat': request.app['redis_stat'],
         'manager_status': manager_status,
         'known_slot_types': known_slot_types,
         'background_task_manager': request.app['background_task_manager'],
         'storage_manager': request.app['storage_manager'],
         'registry': request.app['registry'],
+        'event_dispatcher': request.app['event_dispatcher'],
     }
     dlmanager = DataLoaderManager(context)
     result = schema.execute(
@@ -1,18 +1,26 @@
-from collections import ChainMap
+from __future__ import annotations
+
+from collections import ChainMap, OrderedDict
 from datetime import datetime, timedelta
 import functools
 import hashlib, hmac
+import itertools
 import logging
 import secrets
+import time
 from typing import (
-    Any, Final,
+    Any, Dict, Final,
     Iterable,
+    Mapping,
+    Optional,
     Tuple,
 )
 
 from aiohttp import web
 import aiohttp_cors
 from aiojobs.aiohttp import atomic
+from aiopg.sa.engine import Engine as SAEngine
+import attr
 import click
 from dateutil.tz import tzutc
 from dateutil.parser import parse as dtparse
@@ -41,6 +49,7 @@ from ..manager.models import (
 )
 from ..manager.models.user import UserRole, UserStatus, INACTIVE_USER_STATUSES, check_credential
 from ..manager.models.keypair import generate_keypair as _gen_keypair, generate_ssh_keypair
+from ..manager.models.engine import cached_statement
 from ..manager.models.group import association_groups_users, groups
 from .types import CORSOptions, WebMiddleware
 from .utils import check_api_params, set_handler_attr, get_handler_attr
@@ -277,6 +286,188 @@ whois_timezone_info: Final = {
     "Z": 0 * 3600,
 }
 
+# Large or sensitive keypair columns which are not used by the API handlers
+# are excluded from the (cached) authentication context.
+_AUTH_CONTEXT_EXCLUDED_KEYPAIR_COLUMNS: Final = frozenset({
+    'secret_key', 'ssh_private_key', 'dotfiles', 'bootstrap_script',
+})
+_AUTH_CONTEXT_EXCLUDED_USER_COLUMNS: Final = frozenset({
+    'password', 'description', 'created_at',
+})
+
+
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class AuthContext:
+    secret_key: str
+    keypair: Mapping[str, Any]
+    resource_policy: Mapping[str, Any]
+    user: Mapping[str, Any]
+
+
+class AuthContextCache:
+    """
+    A per-process TTL/LRU cache of the authentication contexts keyed by access keys,
+    so that authenticated API requests do not have to query the database every time.
+
+    Entries are invalidated via the "auth_context_invalidated" event broadcasted
+    by the keypair, user, and resource policy mutations, while the TTL bounds
+    the staleness caused by out-of-band database updates.
+    """
+
+    _entries: OrderedDict[str, Tuple[float, AuthContext]]
+
+    def __init__(self, ttl: float = 60.0, maxsize: int = 4096) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, access_key: str) -> Optional[AuthContext]:
+        entry = self._entries.get(access_key)
+        if entry is None:
+            return None
+        expires_at, auth_ctx = entry
+        if expires_at < time.monotonic():
+            del self._entries[access_key]
+            return None
+        self._entries.move_to_end(access_key)
+        return auth_ctx
+
+    def put(self, access_key: str, auth_ctx: AuthContext) -> None:
+        if self.ttl <= 0:
+            return
+        self._entries[access_key] = (time.monotonic() + self.ttl, auth_ctx)
+        self._entries.move_to_end(access_key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, scope: str, key: str) -> None:
+        if scope == 'access_key':
+            self._entries.pop(key, None)
+            return
+        if scope == 'user':
+            matches = lambda auth_ctx: auth_ctx.user['email'] == key  # noqa: E731
+        elif scope == 'resource_policy':
+            matches = lambda auth_ctx: auth_ctx.resource_policy['name'] == key  # noqa: E731
+        else:
+            self._entries.clear()
+            return
+        stale_keys = [ak for ak, (_, auth_ctx) in self._entries.items() if matches(auth_ctx)]
+        for access_key in stale_keys:
+            del self._entries[access_key]
+
+
+class KeypairUsageBuffer:
+    """
+    Accumulates the "last_used" and "num_queries" statistics of keypairs in memory
+    and writes them to the database in batches, instead of updating the hot keypair
+    rows on every API request.
+    """
+
+    _usage: Dict[str, Tuple[datetime, int]]
+
+    def __init__(self, batch_size: int = 500) -> None:
+        self.batch_size = batch_size
+        self._usage = {}
+
+    def __len__(self) -> int:
+        return len(self._usage)
+
+    def record(self, access_key: str, now: datetime = None) -> None:
+        if now is None:
+            now = datetime.now(tzutc())
+        _, count = self._usage.get(access_key, (now, 0))
+        self._usage[access_key] = (now, count + 1)
+
+    async def flush(self, dbpool: SAEngine) -> None:
+        usage, self._usage = self._usage, {}
+        items = iter(usage.items())
+        while batch := dict(itertools.islice(items, self.batch_size)):
+            query = (
+                keypairs.update()
+                .values(
+                    last_used=sa.case(
+                        {ak: last_used for ak, (last_used, _) in batch.items()},
+                        value=keypairs.c.access_key,
+                    ),
+                    num_queries=keypairs.c.num_queries + sa.case(
+                        {ak: count for ak, (_, count) in batch.items()},
+                        value=keypairs.c.access_key,
+                    ),
+                )
+                .where(keypairs.c.access_key.in_(batch.keys()))
+            )
+            try:
+                async with dbpool.acquire() as conn:
+                    await conn.execute(query)
+            except Exception:
+                log.exception('failed to write keypair usage statistics; will retry later')
+                self._restore(batch)
+                self._restore(dict(items))
+                return
+
+    def _restore(self, usage: Mapping[str, Tuple[datetime, int]]) -> None:
+        for access_key, (last_used, count) in usage.items():
+            new_last_used, new_count = self._usage.get(access_key, (last_used, 0))
+            self._usage[access_key] = (max(last_used, new_last_used), count + new_count)
+
+
+async def invalidate_auth_context(
+    app: web.Application,
+    agent_id: str,
+    event_name: str,
+    scope: str,
+    key: str,
+) -> None:
+    auth_cache: Optional[AuthContextCache] = app.get('auth_context_cache')
+    if auth_cache is not None:
+        auth_cache.invalidate(scope, key)
+
+
+_auth_context_keypair_columns: Final = [
+    col for col in keypairs.c
+    if col.name not in _AUTH_CONTEXT_EXCLUDED_KEYPAIR_COLUMNS
+]
+_auth_context_user_columns: Final = [
+    col for col in users.c
+    if col.name not in _AUTH_CONTEXT_EXCLUDED_USER_COLUMNS
+]
+_auth_context_query: Final = cached_statement(
+    sa.select([*_auth_context_user_columns, *_auth_context_keypair_columns,
+               keypairs.c.secret_key, keypair_resource_policies], use_labels=True)
+    .select_from(
+        keypairs
+        .join(users, keypairs.c.user == users.c.uuid)
+        .join(keypair_resource_policies,
+              keypairs.c.resource_policy == keypair_resource_policies.c.name))
+    .where((keypairs.c.access_key == sa.bindparam('access_key')) &
+           (keypairs.c.is_active.is_(True)))
+)
+
+
+async def _query_auth_context(dbpool: SAEngine, access_key: str) -> Optional[AuthContext]:
+    async with dbpool.acquire() as conn:
+        result = await conn.execute(_auth_context_query, {'access_key': access_key})
+        row = await result.first()
+    if row is None:
+        return None
+    user = {col.name: row[f'users_{col.name}'] for col in _auth_context_user_columns}
+    user['id'] = row['keypairs_user_id']  # legacy
+    return AuthContext(
+        secret_key=row['keypairs_secret_key'],
+        keypair={
+            col.name: row[f'keypairs_{col.name}']
+            for col in _auth_context_keypair_columns
+        },
+        resource_policy={
+            col.name: row[f'keypair_resource_policies_{col.name}']
+            for col in keypair_resource_policies.c
+        },
+        user=user,
+    )
+
 
 def _extract_auth_params(request):
     """
@@ -308,6 +499,44 @@ def _extract_auth_params(request):
         raise InvalidAuthParameters('Missing or malformed authorization parameters')
 
 
+_http_date_months: Final = {
+    'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+    'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12,
+}
+
+
+def _parse_http_date(raw_date: str) -> Optional[datetime]:
+    """
+    Parses the "IMF-fixdate" format of RFC 7231 (e.g., "Sun, 06 Nov 1994 08:49:37 GMT")
+    without going through dateutil.  Returns None if it does not match the format.
+    """
+    if len(raw_date) != 29 or raw_date[3:5] != ', ' or not raw_date.endswith(' GMT'):
+        return None
+    try:
+        day, month, year, hms = raw_date[5:25].split(' ')
+        hour, minute, second = hms.split(':')
+        return datetime(int(year), _http_date_months[month], int(day),
+                        int(hour), int(minute), int(second), tzinfo=tzutc())
+    except (KeyError, ValueError):
+        return None
+
+
+def _parse_date(raw_date: str) -> datetime:
+    date = _parse_http_date(raw_date)
+    if date is not None:
+        return date
+    if raw_date[4:5] == '-':
+        # Fast path for the ISO 8601 timestamps generated by our client SDKs.
+        try:
+            return datetime.fromisoformat(raw_date)
+        except ValueError:
+            pass
+    # HTTP standard says "Date" header must be in GMT only.
+    # However, dateutil.parser can recognize other commonly used
+    # timezone names and offsets.
+    return dtparse(raw_date, tzinfos=whois_timezone_info)
+
+
 def check_date(request) -> bool:
     raw_date = request.headers.get('Date')
     if not raw_date:
@@ -316,10 +545,7 @@ def check_date(request) -> bool:
     if not raw_date:
         return False
     try:
-        # HTTP standard says "Date" header must be in GMT only.
-        # However, dateutil.parser can recognize other commonly used
-        # timezone names and offsets.
-        date = dtparse(raw_date, tzinfos=whois_timezone_info)
+        date = _parse_date(raw_date)
         if date.tzinfo is None:
             date = date.replace(tzinfo=tzutc())  # assume as UTC
         now = datetime.now(tzutc())
@@ -334,6 +560,14 @@ def check_date(request) -> bool:
     return True
 
 
+@functools.lru_cache(maxsize=4096)
+def _derive_signing_key(secret_key: str, date: str, host: str, hash_type: str) -> bytes:
+    # The derived key only changes per day and per host for each keypair,
+    # so it is memoized to save two HMAC computations for most requests.
+    sign_key = hmac.new(secret_key.encode(), date.encode(), hash_type).digest()
+    return hmac.new(sign_key, host.encode(), hash_type).digest()
+
+
 async def sign_request(sign_method, request, secret_key) -> str:
     try:
         mac_type, hash_type = map(lambda s: s.lower(), sign_method.split('-'))
@@ -360,10 +594,8 @@ async def sign_request(sign_method, request, secret_key) -> str:
             body_hash,
             name='backendai' if new_api_version is not None else 'sorna'
         ).encode()
-        sign_key = hmac.new(secret_key.encode(),
-                            request['date'].strftime('%Y%m%d').encode(),
-                            hash_type).digest()
-        sign_key = hmac.new(sign_key, request.host.encode(), hash_type).digest()
+        sign_key = _derive_signing_key(
+            secret_key, request['date'].strftime('%Y%m%d'), request.host, hash_type)
         return hmac.new(sign_key, sign_bytes, hash_type).hexdigest()
     except ValueError:
         raise AuthorizationFailed('Invalid signature')
@@ -390,47 +622,36 @@ async def auth_middleware(request, handler):
     params = _extract_auth_params(request)
     if params:
         sign_method, access_key, signature = params
-        async with request.app['dbpool'].acquire() as conn, conn.begin():
-            j = (keypairs.join(users, keypairs.c.user == users.c.uuid)
-                         .join(keypair_resource_policies,
-                               keypairs.c.resource_policy == keypair_resource_policies.c.name))
-            query = (sa.select([users, keypairs, keypair_resource_policies], use_labels=True)
-                       .select_from(j)
-                       .where((keypairs.c.access_key == access_key) &
-                              (keypairs.c.is_active.is_(True))))
-            result = await conn.execute(query)
-            row = await result.first()
-            if row is None:
+        auth_cache: Optional[AuthContextCache] = request.app.get('auth_context_cache')
+        auth_ctx = auth_cache.get(access_key) if auth_cache is not None else None
+        if auth_ctx is None:
+            auth_ctx = await _query_auth_context(request.app['dbpool'], access_key)
+            if auth_ctx is None:
                 raise AuthorizationFailed('Access key not found')
-            my_signature = \
-                await sign_request(sign_method, request, row['keypairs_secret_key'])
-            if secrets.compare_digest(my_signature, signature):
-                query = (keypairs.update()
-                                 .values(last_used=datetime.now(tzutc()),
-                                         num_queries=keypairs.c.num_queries + 1)
-                                 .where(keypairs.c.access_key == access_key))
-                await conn.execute(query)
-                request['is_authorized'] = True
-                request['keypair'] = {
-                    col.name: row[f'keypairs_{col.name}']
-                    for col in keypairs.c
-                    if col.name != 'secret_key'
-                }
-                request['keypair']['resource_policy'] = {
-                    col.name: row[f'keypair_resource_policies_{col.name}']
-                    for col in keypair_resource_policies.c
-                }
-                request['user'] = {
-                    col.name: row[f'users_{col.name}']
-                    for col in users.c
-                    if col.name not in ('password', 'description', 'created_at')
-                }
-                request['user']['id'] = row['keypairs_user_id']  # legacy
-                # if request['role'] in ['admin', 'superadmin']:
-                if row['keypairs_is_admin']:
-                    request['is_admin'] = True
-                if request['user']['role'] == 'superadmin':
-                    request['is_superadmin'] = True
+            if auth_cache is not None:
+                auth_cache.put(access_key, auth_ctx)
+        my_signature = \
+            await sign_request(sign_method, request, auth_ctx.secret_key)
+        if secrets.compare_digest(my_signature, signature):
+            usage_buffer: Optional[KeypairUsageBuffer] = request.app.get('keypair_usage_buffer')
+            if usage_buffer is not None:
+                usage_buffer.record(access_key)
+            else:
+                async with request.app['dbpool'].acquire() as conn:
+                    query = (keypairs.update()
+                                     .values(last_used=datetime.now(tzutc()),
+                                             num_queries=keypairs.c.num_queries + 1)
+                                     .where(keypairs.c.access_key == access_key))
+                    await conn.execute(query)
+            request['is_authorized'] = True
+            request['keypair'] = dict(auth_ctx.keypair)
+            request['keypair']['resource_policy'] = dict(auth_ctx.resource_policy)
+            request['user'] = dict(auth_ctx.user)
+            # if request['role'] in ['admin', 'superadmin']:
+            if auth_ctx.keypair['is_admin']:
+                request['is_admin'] = True
+            if request['user']['role'] == 'superadmin':
+                request['is_superadmin'] = True
 
     # No matter if authenticated or not, pass-through to the handler.
     # (if it's required, auth_required decorator will handle the situation.)
@@ -737,6 +958,8 @@ async def signout(request: web.Request, params: Any) -> web.Response:
                          .values(is_active=False)
                          .where(keypairs.c.user_id == params['email']))
         await conn.execute(query)
+    await request.app['event_dispatcher'].broadcast_event(
+        'auth_context_invalidated', ('user', params['email']))
     return web.json_response({})
 
 
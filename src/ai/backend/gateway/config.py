@@ -257,6 +257,13 @@ manager_local_config_iv = t.Dict({
         t.Key('name'): tx.Slug[2:64],
         t.Key('user'): t.String,
         t.Key('password'): t.String,
+        t.Key('pool-min-size', default=8): t.Int[1:],
+        t.Key('pool-max-size', default=256): t.Int[1:],
+        t.Key('max-connections', default=None): t.Null | t.Int[1:],
+        t.Key('slow-query-threshold', default=0.0): t.Float[0.0:],  # type: ignore
+        t.Key('replica-addr', default=None): t.Null | tx.HostPortPair,
+        t.Key('replica-max-lag', default=10.0): t.Float[0.0:],  # type: ignore
+        t.Key('replica-check-interval', default=2.0): t.Float[0.1:],  # type: ignore
     }),
     t.Key('manager'): t.Dict({
         t.Key('num-proc', default=_max_cpu_count): t.Int[1:_max_cpu_count],
@@ -275,6 +282,31 @@ manager_local_config_iv = t.Dict({
         t.Key('hide-agents', default=False): t.Bool,
         t.Key('importer-image', default='lablup/importer:manylinux2010'): t.String,
         t.Key('max-wsmsg-size', default=16 * (2**20)): t.ToInt,  # default: 16 MiB
+        t.Key('stream-execute-flush-timeout', default=0.05): t.Float[0.01:],  # type: ignore
+        t.Key('app-proxy-mode', default='relay'): t.Enum('relay', 'redirect'),
+        t.Key('app-proxy-redirect-url', default=None): t.Null | t.String,
+        t.Key('app-proxy-token-secret', default=None): t.Null | t.String,
+        t.Key('app-proxy-token-ttl', default=30.0): t.Float[1.0:],  # type: ignore
+        t.Key('app-proxy-token-max-lifetime', default=86400.0): t.Float[1.0:],  # type: ignore
+        t.Key('proxy-buffer-high-water', default='1m'): tx.BinarySize,
+        t.Key('proxy-buffer-low-water', default='256k'): tx.BinarySize,
+        t.Key('proxy-memory-budget', default='256m'): tx.BinarySize,
+        t.Key('file-transfer-chunk-size', default='1m'): tx.BinarySize,
+        t.Key('stream-drain-timeout', default=10.0): t.Float[0.0:],  # type: ignore
+        t.Key('stream-reconnect-spread', default=30.0): t.Float[0.0:],  # type: ignore
+        t.Key('event-consumer-concurrency', default=64): t.Int[1:],
+        t.Key('event-consumer-concurrency-overrides', default={}): t.Mapping(t.String, t.Int[1:]),
+        t.Key('event-consumer-batch-size', default=16): t.Int[1:],
+        t.Key('auth-context-cache-ttl', default=60.0): t.Float[0.0:],  # type: ignore
+        t.Key('auth-context-cache-size', default=4096): t.Int[1:],
+        t.Key('keypair-usage-flush-interval', default=5.0): t.Float[0.1:],  # type: ignore
+        t.Key('session-route-cache-ttl', default=30.0): t.Float[0.0:],  # type: ignore
+        t.Key('session-usage-flush-interval', default=5.0): t.Float[0.0:],  # type: ignore
+        t.Key('usage-rollup-interval', default=300.0): t.Float[10.0:],  # type: ignore
+        t.Key('rate-limiter', default='rolling-log'): t.Enum('rolling-log', 'sliding-window'),
+        t.Key('rate-limit-lease-size', default=1): t.Int[1:],
+        t.Key('rate-limit-endpoint-overrides', default={}): t.Mapping(t.String, t.Int[1:]),
+        t.Key('slow-request-threshold', default=0.0): t.Float[0.0:],  # type: ignore
     }).allow_extra('*'),
     t.Key('docker-registry'): t.Dict({  # deprecated in v20.09
         t.Key('ssl-verify', default=True): t.ToBool,
@@ -440,6 +472,18 @@ def load(config_path: Path = None, debug: bool = False) -> LocalConfig:
         cfg['_src'] = cfg_src_path
         if cfg['manager']['secret'] is None:
             cfg['manager']['secret'] = secrets.token_urlsafe(16)
+        if cfg['manager']['app-proxy-mode'] == 'redirect':
+            for key in ('app-proxy-redirect-url', 'app-proxy-token-secret'):
+                if cfg['manager'][key] is None:
+                    raise config.ConfigurationError({
+                        'manager': {key: 'required for the "redirect" app-proxy mode'},
+                    })
+        if cfg['manager']['proxy-buffer-low-water'] > cfg['manager']['proxy-buffer-high-water']:
+            raise config.ConfigurationError({
+                'manager': {
+                    'proxy-buffer-low-water': 'must not be larger than proxy-buffer-high-water',
+                },
+            })
     except config.ConfigurationError as e:
         print('Validation of manager configuration has failed:', file=sys.stderr)
         print(pformat(e.invalid_data), file=sys.stderr)
@@ -505,6 +549,10 @@ class SharedConfig(AbstractConfig):
         }
         await self.etcd.put_dict(manager_info)
 
+    async def mark_myself_draining(self) -> None:
+        instance_id = await get_instance_id()
+        await self.etcd.put(f'nodes/manager/{instance_id}', 'draining')
+
     async def deregister_myself(self) -> None:
         instance_id = await get_instance_id()
         await self.etcd.delete_prefix(f'nodes/manager/{instance_id}')
@@ -1,18 +1,26 @@
 from __future__ import annotations
 
 import asyncio
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
 import functools
+import itertools
 import logging
 import json
+import time
 from typing import (
     Any,
     AsyncIterator,
     Awaitable,
+    Callable,
+    DefaultDict,
+    Deque,
+    Dict,
     Final,
     Iterable,
+    Iterator,
     Mapping,
     MutableMapping,
+    Optional,
     Protocol,
     Sequence,
     Set,
@@ -36,6 +44,7 @@ import trafaret as t
 from ai.backend.common import msgpack, redis
 from ai.backend.common import validators as tx
 from ai.backend.common.logging import BraceStyleAdapter
+from ai.backend.common.plugin.monitor import GAUGE
 from ai.backend.common.types import (
     aobject,
     AgentId,
@@ -48,6 +57,7 @@ from .utils import check_api_params
 from ..manager.models import kernels, groups, UserRole
 from ..manager.types import BackgroundTaskEventArgs, Sentinel
 if TYPE_CHECKING:
+    from ai.backend.common.plugin.monitor import StatsPluginContext
     from .types import CORSOptions, WebMiddleware
     from ..gateway.config import LocalConfig, SharedConfig
 
@@ -55,6 +65,12 @@ log = BraceStyleAdapter(logging.getLogger('ai.backend.gateway.events'))
 
 sentinel: Final = Sentinel.token
 
+# The length of the local backlog per event name, relative to its concurrency limit,
+# over which the consumer loop stops taking new events from the queue.
+CONSUMER_BACKLOG_FACTOR: Final = 16
+# The delay before checking the backlogs again while they are over the above length.
+CONSUMER_BACKLOG_BACKOFF: Final = 0.1
+
 
 class EventCallback(Protocol):
     async def __call__(self,
@@ -71,6 +87,116 @@ class EventHandler:
     callback: EventCallback
 
 
+@attr.s(auto_attribs=True, slots=True)
+class EventConsumerStats:
+    num_inflight: int = 0
+    num_processed: int = 0
+    num_failed: int = 0
+    # latencies measured since the last stats report
+    window_count: int = 0
+    window_latency_sum: float = 0.0
+    window_latency_max: float = 0.0
+
+    def record(self, latency: float) -> None:
+        self.num_processed += 1
+        self.window_count += 1
+        self.window_latency_sum += latency
+        self.window_latency_max = max(self.window_latency_max, latency)
+
+    def reset_window(self) -> None:
+        self.window_count = 0
+        self.window_latency_sum = 0.0
+        self.window_latency_max = 0.0
+
+
+KERNEL_OWNER_FIELDS: Final = (
+    'id', 'session_id', 'session_name', 'access_key',
+    'cluster_role', 'cluster_idx',
+    'domain_name', 'group_id', 'user_uuid',
+)
+_KERNEL_OWNER_UUID_FIELDS: Final = ('id', 'session_id', 'group_id', 'user_uuid')
+
+
+class KernelOwnershipCache:
+    """
+    A per-process cache of the ownership information of kernels
+    (session, access key, domain, group and user), which is required to route
+    kernel/session lifecycle events to the event streaming API subscribers.
+
+    It is populated with the ownership records piggybacked on the event messages
+    (e.g., "session_enqueued") so that all manager processes receiving the events
+    do not have to query the database again for every event.
+    """
+
+    _entries: OrderedDict[uuid.UUID, Tuple[float, Mapping[str, Any]]]
+    _session_kernels: DefaultDict[uuid.UUID, Set[uuid.UUID]]
+
+    def __init__(self, ttl: float = 3600.0, maxsize: int = 16384) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._session_kernels = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, kernel_id: uuid.UUID) -> Optional[Mapping[str, Any]]:
+        entry = self._entries.get(kernel_id)
+        if entry is None:
+            return None
+        expires_at, row = entry
+        if expires_at < time.monotonic():
+            self.invalidate(kernel_id)
+            return None
+        return row
+
+    def update(self, rows: Iterable[Mapping[str, Any]]) -> None:
+        expires_at = time.monotonic() + self.ttl
+        for row in rows:
+            kernel_id = row['id']
+            self._entries[kernel_id] = (expires_at, row)
+            self._entries.move_to_end(kernel_id)
+            self._session_kernels[row['session_id']].add(kernel_id)
+        while len(self._entries) > self.maxsize:
+            kernel_id, (_, row) = self._entries.popitem(last=False)
+            self._discard_session_kernel(row['session_id'], kernel_id)
+
+    def invalidate(self, kernel_id: uuid.UUID) -> None:
+        entry = self._entries.pop(kernel_id, None)
+        if entry is not None:
+            self._discard_session_kernel(entry[1]['session_id'], kernel_id)
+
+    def invalidate_session(self, session_id: uuid.UUID) -> None:
+        for kernel_id in self._session_kernels.pop(session_id, set()):
+            self._entries.pop(kernel_id, None)
+
+    def _discard_session_kernel(self, session_id: uuid.UUID, kernel_id: uuid.UUID) -> None:
+        kernel_ids = self._session_kernels.get(session_id)
+        if kernel_ids is None:
+            return
+        kernel_ids.discard(kernel_id)
+        if not kernel_ids:
+            del self._session_kernels[session_id]
+
+    @staticmethod
+    def serialize(row: Mapping[str, Any]) -> Dict[str, Any]:
+        return {
+            k: (str(row[k]) if k in _KERNEL_OWNER_UUID_FIELDS and row[k] is not None else row[k])
+            for k in KERNEL_OWNER_FIELDS
+        }
+
+    @staticmethod
+    def deserialize(data: Mapping[str, Any]) -> Dict[str, Any]:
+        return {
+            k: (
+                uuid.UUID(data[k])
+                if k in _KERNEL_OWNER_UUID_FIELDS and data[k] is not None
+                else data[k]
+            )
+            for k in KERNEL_OWNER_FIELDS
+        }
+
+
 class EventDispatcher(aobject):
     '''
     We have two types of event handlers: consumer and subscriber.
@@ -84,6 +210,16 @@ class EventDispatcher(aobject):
     receive the same event.
 
     Subscriber example: enqueuing events to the queues for event streaming API handlers
+
+    The number of in-flight asynchronous consumer handlers is bounded per event name
+    (configured by ``manager.event-consumer-concurrency`` and its per-event overrides).
+    When an event name hits its limit, its further events wait in a local backlog
+    and are handled in their arrival order as the running handlers finish.
+    The consumer loop itself never waits for the handlers, so a slow event name
+    does not delay the dispatch of the other events.  Only when a backlog grows
+    over ``CONSUMER_BACKLOG_FACTOR`` times its limit, the loop stops taking new
+    events from the Redis list until it shrinks, letting other manager processes
+    take them meanwhile.
     '''
 
     consumers: MutableMapping[str, Set[EventHandler]]
@@ -96,22 +232,44 @@ class EventDispatcher(aobject):
     producer_lock: asyncio.Lock
     consumer_taskset: weakref.WeakSet[asyncio.Task]
     subscriber_taskset: weakref.WeakSet[asyncio.Task]
-
-    def __init__(self, local_config: LocalConfig, shared_config: SharedConfig) -> None:
+    consumer_limits: MutableMapping[str, int]
+    consumer_backlogs: DefaultDict[str, Deque[Callable[[], Awaitable[None]]]]
+    consumer_stats: MutableMapping[str, EventConsumerStats]
+    consumer_queue_depth: int
+    stats_monitor: Optional[StatsPluginContext]
+    stats_report_task: Optional[asyncio.Task]
+    kernel_ownership_cache: KernelOwnershipCache
+
+    def __init__(
+        self,
+        local_config: LocalConfig,
+        shared_config: SharedConfig,
+        *,
+        stats_monitor: StatsPluginContext = None,
+    ) -> None:
         self.local_config = local_config
         self.shared_config = shared_config
         self.consumers = defaultdict(set)
         self.subscribers = defaultdict(set)
+        self.consumer_limits = {}
+        self.consumer_backlogs = defaultdict(deque)
+        self.consumer_stats = defaultdict(EventConsumerStats)
+        self.consumer_queue_depth = 0
+        self.stats_monitor = stats_monitor
+        self.kernel_ownership_cache = KernelOwnershipCache()
 
     async def __ainit__(self) -> None:
         self.redis_producer = await self._create_redis()
         self.redis_consumer = await self._create_redis()
         self.redis_subscriber = await self._create_redis()
-        self.consumer_loop_task = asyncio.create_task(self._consume_loop())
-        self.subscriber_loop_task = asyncio.create_task(self._subscribe_loop())
         self.producer_lock = asyncio.Lock()
         self.consumer_taskset = weakref.WeakSet()
         self.subscriber_taskset = weakref.WeakSet()
+        self.consumer_loop_task = asyncio.create_task(self._consume_loop())
+        self.subscriber_loop_task = asyncio.create_task(self._subscribe_loop())
+        self.stats_report_task = None
+        if self.stats_monitor is not None:
+            self.stats_report_task = asyncio.create_task(self._report_stats_loop())
 
     async def _create_redis(self):
         redis_url = self.shared_config.get_redis_url(db=REDIS_STREAM_DB)
@@ -131,6 +289,9 @@ class EventDispatcher(aobject):
         self.subscriber_loop_task.cancel()
         cancelled_tasks.append(self.consumer_loop_task)
         cancelled_tasks.append(self.subscriber_loop_task)
+        if self.stats_report_task is not None:
+            self.stats_report_task.cancel()
+            cancelled_tasks.append(self.stats_report_task)
         await asyncio.gather(*cancelled_tasks, return_exceptions=True)
         self.redis_producer.close()
         self.redis_consumer.close()
@@ -157,12 +318,23 @@ class EventDispatcher(aobject):
 
     async def produce_event(self, event_name: str,
                             args: Sequence[Any] = tuple(), *,
-                            agent_id: str = 'manager') -> None:
-        raw_msg = msgpack.packb({
+                            agent_id: str = 'manager',
+                            kernel_owners: Sequence[Mapping[str, Any]] = None) -> None:
+        '''
+        Produce an event to both consumers and subscribers.
+
+        If *kernel_owners* is given, the ownership records of the kernels related to the event
+        are delivered along with the event so that the subscribers in all manager processes
+        could update their :class:`KernelOwnershipCache` without querying the database.
+        '''
+        msg: Dict[str, Any] = {
             'event_name': event_name,
             'agent_id': agent_id,
             'args': args,
-        })
+        }
+        if kernel_owners:
+            msg['kernel_owners'] = [KernelOwnershipCache.serialize(row) for row in kernel_owners]
+        raw_msg = msgpack.packb(msg)
         async with self.producer_lock:
             def _pipe_builder():
                 pipe = self.redis_producer.pipeline()
@@ -171,6 +343,21 @@ class EventDispatcher(aobject):
                 return pipe
             await redis.execute_with_retries(_pipe_builder)
 
+    async def broadcast_event(self, event_name: str,
+                              args: Sequence[Any] = tuple(), *,
+                              agent_id: str = 'manager') -> None:
+        '''
+        Produce an event only to the subscribers in all manager processes.
+        '''
+        raw_msg = msgpack.packb({
+            'event_name': event_name,
+            'agent_id': agent_id,
+            'args': args,
+        })
+        async with self.producer_lock:
+            await redis.execute_with_retries(
+                lambda: self.redis_producer.publish('events.pubsub', raw_msg))
+
     async def dispatch_consumers(self, event_name: str, agent_id: AgentId,
                                  args: Tuple[Any, ...] = tuple()) -> None:
         log_fmt = 'DISPATCH_CONSUMERS(ev:{}, ag:{})'
@@ -183,9 +370,10 @@ class EventDispatcher(aobject):
             if asyncio.iscoroutine(cb):
                 self.consumer_taskset.add(asyncio.create_task(cast(Awaitable, cb)))
             elif asyncio.iscoroutinefunction(cb):
-                self.consumer_taskset.add(asyncio.create_task(
-                    cb(consumer.context, agent_id, event_name, *args)
-                ))
+                self._start_consumer(
+                    event_name,
+                    functools.partial(cb, consumer.context, agent_id, event_name, *args),
+                )
             else:
                 cb = functools.partial(cb, consumer.context, agent_id, event_name, *args)
                 loop.call_soon(cb)
@@ -209,19 +397,131 @@ class EventDispatcher(aobject):
                 cb = functools.partial(cb, subscriber.context, agent_id, event_name, *args)
                 loop.call_soon(cb)
 
+    def _update_kernel_ownership_cache(self, msg: Mapping[str, Any]) -> None:
+        if kernel_owners := msg.get('kernel_owners'):
+            self.kernel_ownership_cache.update(
+                KernelOwnershipCache.deserialize(data) for data in kernel_owners
+            )
+
+    def _get_consumer_limit(self, event_name: str) -> int:
+        limit = self.consumer_limits.get(event_name)
+        if limit is None:
+            manager_config = self.local_config['manager']
+            limit = manager_config['event-consumer-concurrency-overrides'].get(
+                event_name,
+                manager_config['event-consumer-concurrency'],
+            )
+            self.consumer_limits[event_name] = limit
+        return limit
+
+    def _is_consumer_saturated(self, event_name: str) -> bool:
+        backlog = self.consumer_backlogs.get(event_name)
+        return (
+            backlog is not None and
+            len(backlog) >= self._get_consumer_limit(event_name) * CONSUMER_BACKLOG_FACTOR
+        )
+
+    def _start_consumer(self, event_name: str, handler: Callable[[], Awaitable[None]]) -> None:
+        stats = self.consumer_stats[event_name]
+        if stats.num_inflight >= self._get_consumer_limit(event_name):
+            self.consumer_backlogs[event_name].append(handler)
+            return
+        stats.num_inflight += 1
+        self.consumer_taskset.add(asyncio.create_task(self._run_consumer(event_name, handler)))
+
+    async def _run_consumer(
+        self,
+        event_name: str,
+        handler: Callable[[], Awaitable[None]],
+    ) -> None:
+        stats = self.consumer_stats[event_name]
+        begin = time.perf_counter()
+        try:
+            await handler()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            stats.num_failed += 1
+            raise
+        finally:
+            stats.num_inflight -= 1
+            stats.record(time.perf_counter() - begin)
+            backlog = self.consumer_backlogs.get(event_name)
+            if backlog:
+                self._start_consumer(event_name, backlog.popleft())
+
+    async def _pop_batch(self) -> Sequence[bytes]:
+        batch_size = self.local_config['manager']['event-consumer-batch-size']
+        key, raw_msg = await redis.execute_with_retries(
+            lambda: self.redis_consumer.blpop('events.prodcons'))
+        if batch_size <= 1:
+            return [raw_msg]
+
+        def _pipe_builder():
+            # Atomically pop the remaining messages of the batch.
+            tx = self.redis_consumer.multi_exec()
+            tx.lrange('events.prodcons', 0, batch_size - 2)
+            tx.ltrim('events.prodcons', batch_size - 1, -1)
+            tx.llen('events.prodcons')
+            return tx
+
+        result = await redis.execute_with_retries(_pipe_builder)
+        if result is None:
+            # The connection pool is being closed.
+            return [raw_msg]
+        extra_msgs, _, queue_depth = result
+        self.consumer_queue_depth = queue_depth
+        return [raw_msg, *extra_msgs]
+
     async def _consume_loop(self) -> None:
         while True:
             try:
-                key, raw_msg = await redis.execute_with_retries(
-                    lambda: self.redis_consumer.blpop('events.prodcons'))
-                msg = msgpack.unpackb(raw_msg)
-                await self.dispatch_consumers(msg['event_name'],
-                                              msg['agent_id'],
-                                              msg['args'])
+                while any(map(self._is_consumer_saturated, list(self.consumer_backlogs))):
+                    await asyncio.sleep(CONSUMER_BACKLOG_BACKOFF)
+                raw_msgs = await self._pop_batch()
             except asyncio.CancelledError:
                 break
             except Exception:
                 log.exception('EventDispatcher.consume(): unexpected-error')
+                continue
+            for raw_msg in raw_msgs:
+                # Handle each event separately so that a malformed one
+                # does not discard the rest of the batch.
+                try:
+                    msg = msgpack.unpackb(raw_msg)
+                    self._update_kernel_ownership_cache(msg)
+                    await self.dispatch_consumers(msg['event_name'],
+                                                  msg['agent_id'],
+                                                  msg['args'])
+                except asyncio.CancelledError:
+                    return
+                except Exception:
+                    log.exception('EventDispatcher.consume(): unexpected-error')
+
+    async def _report_stats_loop(self, interval: float = 10.0) -> None:
+        assert self.stats_monitor is not None
+        while True:
+            try:
+                await asyncio.sleep(interval)
+                await self.stats_monitor.report_metric(
+                    GAUGE, 'ai.backend.gateway.events.consumer.queue_depth',
+                    self.consumer_queue_depth,
+                )
+                for event_name, stats in self.consumer_stats.items():
+                    prefix = f'ai.backend.gateway.events.consumer.{event_name}'
+                    await self.stats_monitor.report_metric(
+                        GAUGE, f'{prefix}.inflight', stats.num_inflight)
+                    if stats.window_count > 0:
+                        await self.stats_monitor.report_metric(
+                            GAUGE, f'{prefix}.latency_avg',
+                            stats.window_latency_sum / stats.window_count)
+                        await self.stats_monitor.report_metric(
+                            GAUGE, f'{prefix}.latency_max', stats.window_latency_max)
+                    stats.reset_window()
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                log.exception('EventDispatcher.report_stats(): unexpected-error')
 
     async def _subscribe_loop(self) -> None:
 
@@ -229,6 +529,7 @@ class EventDispatcher(aobject):
             channels = await self.redis_subscriber.subscribe('events.pubsub')
             async for raw_msg in channels[0].iter():
                 msg = msgpack.unpackb(raw_msg)
+                self._update_kernel_ownership_cache(msg)
                 await self.dispatch_subscribers(msg['event_name'],
                                                 msg['agent_id'],
                                                 msg['args'])
@@ -242,6 +543,208 @@ class EventDispatcher(aobject):
                 log.exception('EventDispatcher.subscribe(): unexpected-error')
 
 
+SESSION_EVENT_QUEUE_SIZE: Final = 256
+SESSION_EVENT_STREAM_MAXLEN: Final = 10000  # per domain
+SESSION_EVENT_STREAM_DOMAINS_KEY: Final = 'events.session._domains'
+
+# (event_name, row, reason, event_id)
+SessionEventData = Tuple[str, Mapping[str, Any], Optional[str], Optional[str]]
+# (domain_name, user_uuid, group_id, session_id or (access_key, session_name))
+# where each part may be "*" to match any value.
+SessionEventSubscriptionKey = Tuple[str, Any, Any, Any]
+
+
+class SessionEventSubscriber:
+    """
+    A per-connection event queue for the session event streaming API.
+
+    The queue is bounded and drops the oldest event when full, so that a slow client
+    cannot make the manager accumulate events indefinitely.
+    """
+
+    __slots__ = ('scope', 'queue', 'num_dropped')
+
+    scope: str
+    queue: asyncio.Queue[Union[Sentinel, SessionEventData]]
+    num_dropped: int
+
+    def __init__(self, scope: str, maxsize: int = SESSION_EVENT_QUEUE_SIZE) -> None:
+        self.scope = scope
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.num_dropped = 0
+
+    def accepts(self, event_name: str) -> bool:
+        if self.scope == 'session':
+            return event_name.startswith('session_')
+        if self.scope == 'kernel':
+            return event_name.startswith('kernel_')
+        return True
+
+    def put(self, item: Union[Sentinel, SessionEventData]) -> None:
+        if self.queue.full():
+            try:
+                self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                pass
+            else:
+                self.queue.task_done()
+                self.num_dropped += 1
+        self.queue.put_nowait(item)
+
+
+class SessionEventSubscriptionIndex:
+    """
+    Routes session/kernel lifecycle events only to the subscribers whose
+    domain, user, group and session filters match the event,
+    instead of broadcasting every event to all connected clients.
+    """
+
+    _index: DefaultDict[SessionEventSubscriptionKey, Set[SessionEventSubscriber]]
+
+    def __init__(self) -> None:
+        self._index = defaultdict(set)
+
+    def __len__(self) -> int:
+        return sum(len(subscribers) for subscribers in self._index.values())
+
+    def __bool__(self) -> bool:
+        return bool(self._index)
+
+    def __iter__(self) -> Iterator[SessionEventSubscriber]:
+        for subscribers in self._index.values():
+            yield from subscribers
+
+    def add(self, key: SessionEventSubscriptionKey, subscriber: SessionEventSubscriber) -> None:
+        self._index[key].add(subscriber)
+
+    def remove(self, key: SessionEventSubscriptionKey, subscriber: SessionEventSubscriber) -> None:
+        subscribers = self._index.get(key)
+        if subscribers is None:
+            return
+        subscribers.discard(subscriber)
+        if not subscribers:
+            del self._index[key]
+
+    @staticmethod
+    def key_matches(key: SessionEventSubscriptionKey, row: Mapping[str, Any]) -> bool:
+        domain_name, user_uuid, group_id, session_key = key
+        return (
+            (domain_name == '*' or domain_name == row['domain_name']) and
+            (user_uuid == '*' or user_uuid == row['user_uuid']) and
+            (group_id == '*' or group_id == row['group_id']) and
+            (
+                session_key == '*' or
+                session_key == row['session_id'] or
+                session_key == (row['access_key'], row['session_name'])
+            )
+        )
+
+    def match(self, row: Mapping[str, Any]) -> Iterator[SessionEventSubscriber]:
+        candidate_keys = itertools.product(
+            ('*', row['domain_name']),
+            ('*', row['user_uuid']),
+            ('*', row['group_id']),
+            ('*', row['session_id'], (row['access_key'], row['session_name'])),
+        )
+        for key in candidate_keys:
+            subscribers = self._index.get(key)
+            if subscribers:
+                yield from subscribers
+
+    def dispatch(
+        self,
+        event_name: str,
+        row: Mapping[str, Any],
+        reason: Optional[str],
+        event_id: str = None,
+    ) -> None:
+        for subscriber in self.match(row):
+            if subscriber.accepts(event_name):
+                subscriber.put((event_name, row, reason, event_id))
+
+
+def parse_stream_event_id(event_id: str) -> Tuple[int, int]:
+    """
+    Parses a Redis stream entry ID (e.g., "1612345678901-0") into a comparable tuple.
+    Raises ValueError if the ID is malformed.
+    """
+    timestamp, sep, seq = event_id.partition('-')
+    if not sep:
+        raise ValueError('invalid stream event ID', event_id)
+    return int(timestamp), int(seq)
+
+
+def _next_stream_event_id(event_id: Tuple[int, int]) -> str:
+    # XRANGE's start is inclusive, so we need the smallest ID after the given one.
+    return f'{event_id[0]}-{event_id[1] + 1}'
+
+
+def _get_last_event_id(request: web.Request) -> Optional[Tuple[int, int]]:
+    raw_event_id = request.headers.get('Last-Event-ID')
+    if not raw_event_id:
+        return None
+    try:
+        return parse_stream_event_id(raw_event_id)
+    except ValueError:
+        log.debug('ignoring malformed Last-Event-ID: {!r}', raw_event_id)
+        return None
+
+
+async def _send_session_event(
+    resp: web.StreamResponse,
+    event_name: str,
+    row: Mapping[str, Any],
+    reason: Optional[str],
+    event_id: Optional[str],
+) -> None:
+    response_data = {
+        'reason': reason,
+        'sessionName': row['session_name'],
+        'ownerAccessKey': row['access_key'],
+        'sessionId': str(row['session_id']),
+    }
+    if kernel_id := row.get('id'):
+        response_data['kernelId'] = str(kernel_id)
+    if cluster_role := row.get('cluster_role'):
+        response_data['clusterRole'] = cluster_role
+    if cluster_idx := row.get('cluster_idx'):
+        response_data['clusterIdx'] = cluster_idx
+    await resp.send(json.dumps(response_data), id=event_id, event=event_name)
+
+
+async def _replay_session_events(
+    app: web.Application,
+    resp: web.StreamResponse,
+    subscription_key: SessionEventSubscriptionKey,
+    subscriber: SessionEventSubscriber,
+    last_event_id: Tuple[int, int],
+) -> Tuple[int, int]:
+    redis_stream = app['redis_stream']
+    if subscription_key[0] == '*':
+        domain_names = await redis_stream.smembers(SESSION_EVENT_STREAM_DOMAINS_KEY)
+    else:
+        domain_names = [subscription_key[0]]
+    entries = []
+    for domain_name in domain_names:
+        entries.extend(await redis_stream.xrange(
+            f'events.session.{domain_name}',
+            start=_next_stream_event_id(last_event_id),
+        ))
+    # Merge the entries from multiple domains in the order of their IDs.
+    entries.sort(key=lambda entry: parse_stream_event_id(entry[0]))
+    replayed_until = last_event_id
+    for event_id, fields in entries:
+        data = json.loads(fields['data'])
+        row = KernelOwnershipCache.deserialize(data['row'])
+        if (
+            SessionEventSubscriptionIndex.key_matches(subscription_key, row) and
+            subscriber.accepts(data['event_name'])
+        ):
+            await _send_session_event(resp, data['event_name'], row, data['reason'], event_id)
+        replayed_until = parse_stream_event_id(event_id)
+    return replayed_until
+
+
 @server_status_required(READ_ALLOWED)
 @auth_required
 @check_api_params(
@@ -272,8 +775,6 @@ async def push_session_events(
         if access_key != request['keypair']['access_key']:
             raise GenericForbidden
     group_name = params['group_name']
-    session_event_queues = app['session_event_queues']  # type: Set[asyncio.Queue]
-    my_queue = asyncio.Queue()  # type: asyncio.Queue[Union[Sentinel, Tuple[str, dict, str]]]
     log.info('PUSH_SESSION_EVENTS (ak:{}, s:{}, g:{})', access_key, session_name, group_name)
     if group_name == '*':
         group_id = '*'
@@ -288,49 +789,44 @@ async def push_session_events(
             if row is None:
                 raise GroupNotFound
             group_id = row['id']
-    session_event_queues.add(my_queue)
-    defer(lambda: session_event_queues.remove(my_queue))
+    if session_id is not None:
+        session_key = session_id
+    elif session_name != '*':
+        session_key = (access_key, session_name)
+    else:
+        session_key = '*'
+    subscription_key: SessionEventSubscriptionKey = (
+        '*' if user_role == UserRole.SUPERADMIN else request['user']['domain_name'],
+        user_uuid if user_role == UserRole.USER else '*',
+        group_id,
+        session_key,
+    )
+    subscriptions: SessionEventSubscriptionIndex = app['session_event_subscriptions']
+    subscriber = SessionEventSubscriber(scope)
+    # Subscribe before replaying so that we do not miss any event in the middle.
+    subscriptions.add(subscription_key, subscriber)
+    defer(lambda: subscriptions.remove(subscription_key, subscriber))
+    my_queue = subscriber.queue
+    last_event_id = _get_last_event_id(request)
     try:
         async with sse_response(request) as resp:
+            if last_event_id is not None:
+                last_event_id = await _replay_session_events(
+                    app, resp, subscription_key, subscriber, last_event_id,
+                )
             while True:
                 evdata = await my_queue.get()
                 try:
                     if evdata is sentinel:
                         break
-                    event_name, row, reason = evdata
-                    if user_role in (UserRole.USER, UserRole.ADMIN):
-                        if row['domain_name'] != request['user']['domain_name']:
-                            continue
-                    if user_role == UserRole.USER:
-                        if row['user_uuid'] != user_uuid:
-                            continue
-                    if group_id != '*' and row['group_id'] != group_id:
-                        continue
-                    if scope == 'session' and not event_name.startswith('session_'):
+                    event_name, row, reason, event_id = evdata
+                    if (
+                        last_event_id is not None and event_id is not None and
+                        parse_stream_event_id(event_id) <= last_event_id
+                    ):
+                        # already sent while replaying
                         continue
-                    if scope == 'kernel' and not event_name.startswith('kernel_'):
-                        continue
-                    if session_id is not None:
-                        if row['session_id'] != session_id:
-                            continue
-                    else:
-                        if session_name != '*' and not (
-                            (row['session_name'] == session_name) and
-                            (row['access_key'] == access_key)):
-                            continue
-                    response_data = {
-                        'reason': reason,
-                        'sessionName': row['session_name'],
-                        'ownerAccessKey': row['access_key'],
-                        'sessionId': str(row['session_id']),
-                    }
-                    if kernel_id := row.get('id'):
-                        response_data['kernelId'] = str(kernel_id)
-                    if cluster_role := row.get('cluster_role'):
-                        response_data['clusterRole'] = cluster_role
-                    if cluster_idx := row.get('cluster_idx'):
-                        response_data['clusterIdx'] = cluster_idx
-                    await resp.send(json.dumps(response_data), event=event_name)
+                    await _send_session_event(resp, event_name, row, reason, event_id)
                 finally:
                     my_queue.task_done()
     finally:
@@ -355,51 +851,68 @@ async def push_background_task_events(
 
     tracker_key = f'bgtask.{task_id}'
     task_info = await app['redis_stream'].hgetall(tracker_key)
-    if task_info is None:
+    if not task_info:
         # The task ID is invalid or represents a task completed more than 24 hours ago.
         raise GenericNotFound('No such background task.')
+    last_event_id = _get_last_event_id(request)
 
     if task_info['status'] != 'started':
         # It is an already finished task!
         async with sse_response(request) as resp:
             try:
-                body = {
-                    'task_id': str(task_id),
-                    'status': task_info['status'],
-                    'current_progress': task_info['current'],
-                    'total_progress': task_info['total'],
-                    'message': task_info['msg'],
-                }
-                await resp.send(json.dumps(body), event=f"task_{task_info['status']}")
+                if last_event_id is not None:
+                    # The stream includes the final event of the task.
+                    await _replay_task_events(app, resp, task_id, last_event_id)
+                else:
+                    body = {
+                        'task_id': str(task_id),
+                        'status': task_info['status'],
+                        'current_progress': task_info['current'],
+                        'total_progress': task_info['total'],
+                        'message': task_info['msg'],
+                    }
+                    await resp.send(json.dumps(body), event=f"task_{task_info['status']}")
             finally:
                 await resp.send(b'{}', event="server_close")
         return resp
 
     # It is an ongoing task.
-    task_update_queues = app['task_update_queues']  # type: Set[asyncio.Queue]
-    my_queue = asyncio.Queue()  # type: asyncio.Queue[Union[Sentinel, Tuple[str, Any]]]
-    task_update_queues.add(my_queue)
-    defer(lambda: task_update_queues.remove(my_queue))
+    # The queues are indexed by the task ID so that each listener receives
+    # only the updates of its own task.
+    task_update_queues: DefaultDict[uuid.UUID, Set[asyncio.Queue]] = app['task_update_queues']
+    my_queue: asyncio.Queue[Union[Sentinel, Tuple[str, BackgroundTaskEventArgs]]] = asyncio.Queue()
+    # Subscribe before replaying so that we do not miss any event in the middle.
+    task_update_queues[task_id].add(my_queue)
+
+    def _unsubscribe():
+        queues = task_update_queues[task_id]
+        queues.discard(my_queue)
+        if not queues:
+            del task_update_queues[task_id]
+
+    defer(_unsubscribe)
     try:
         async with sse_response(request) as resp:
+            if last_event_id is not None:
+                last_event_id, is_finished = await _replay_task_events(
+                    app, resp, task_id, last_event_id,
+                )
+                if is_finished:
+                    await resp.send('{}', event="server_close")
+                    return resp
             while True:
                 event_args = await my_queue.get()
                 try:
                     if event_args is sentinel:
                         break
-                    event_name = event_args[0]
-                    event_data = BackgroundTaskEventArgs(**event_args[1])
-                    if task_id != uuid.UUID(event_data.task_id):
+                    event_name, event_data = event_args
+                    if (
+                        last_event_id is not None and event_data.event_id is not None and
+                        parse_stream_event_id(event_data.event_id) <= last_event_id
+                    ):
+                        # already sent while replaying
                         continue
-                    body = {
-                        'task_id': str(task_id),
-                        'message': event_data.message,
-                    }
-                    if event_data.current_progress is not None:
-                        body['current_progress'] = event_data.current_progress
-                    if event_data.total_progress is not None:
-                        body['total_progress'] = event_data.total_progress
-                    await resp.send(json.dumps(body), event=event_name, retry=5)
+                    await _send_task_event(resp, task_id, event_name, event_data)
                     if event_name in ('task_done', 'task_failed', 'task_cancelled'):
                         await resp.send('{}', event="server_close")
                         break
@@ -409,33 +922,60 @@ async def push_background_task_events(
         return resp
 
 
-async def enqueue_kernel_status_update_with_creation_id(
-    app: web.Application,
-    agent_id: AgentId,
+async def _send_task_event(
+    resp: web.StreamResponse,
+    task_id: uuid.UUID,
     event_name: str,
-    raw_kernel_id: str,
-    kernel_creation_id: str,
-    reason: str = None,
-    exit_code: int = None,
+    event_data: BackgroundTaskEventArgs,
 ) -> None:
-    if raw_kernel_id is None:
-        return
-    kernel_id = uuid.UUID(raw_kernel_id)
+    body = {
+        'task_id': str(task_id),
+        'message': event_data.message,
+    }
+    if event_data.current_progress is not None:
+        body['current_progress'] = event_data.current_progress
+    if event_data.total_progress is not None:
+        body['total_progress'] = event_data.total_progress
+    await resp.send(json.dumps(body), id=event_data.event_id, event=event_name, retry=5)
+
+
+async def _replay_task_events(
+    app: web.Application,
+    resp: web.StreamResponse,
+    task_id: uuid.UUID,
+    last_event_id: Tuple[int, int],
+) -> Tuple[Tuple[int, int], bool]:
+    entries = await app['redis_stream'].xrange(
+        f'bgtask.{task_id}.events',
+        start=_next_stream_event_id(last_event_id),
+    )
+    replayed_until = last_event_id
+    is_finished = False
+    for event_id, fields in entries:
+        data = json.loads(fields['data'])
+        event_name = data['event_name']
+        event_data = attr.evolve(BackgroundTaskEventArgs(**data['args']), event_id=event_id)
+        await _send_task_event(resp, task_id, event_name, event_data)
+        replayed_until = parse_stream_event_id(event_id)
+        if event_name in ('task_done', 'task_failed', 'task_cancelled'):
+            is_finished = True
+            break
+    return replayed_until, is_finished
+
+
+async def _lookup_kernel_owner(
+    app: web.Application,
+    kernel_id: uuid.UUID,
+) -> Optional[Mapping[str, Any]]:
+    cache: KernelOwnershipCache = app['event_dispatcher'].kernel_ownership_cache
+    row = cache.get(kernel_id)
+    if row is not None:
+        return row
 
     async def _fetch():
-        async with app['dbpool'].acquire() as conn, conn.begin():
+        async with app['dbpool'].acquire() as conn:
             query = (
-                sa.select([
-                    kernels.c.id,
-                    kernels.c.session_id,
-                    kernels.c.session_name,
-                    kernels.c.access_key,
-                    kernels.c.cluster_role,
-                    kernels.c.cluster_idx,
-                    kernels.c.domain_name,
-                    kernels.c.group_id,
-                    kernels.c.user_uuid,
-                ])
+                sa.select([kernels.c[field] for field in KERNEL_OWNER_FIELDS])
                 .select_from(kernels)
                 .where(
                     (kernels.c.id == kernel_id)
@@ -444,11 +984,68 @@ async def enqueue_kernel_status_update_with_creation_id(
             result = await conn.execute(query)
             return await result.first()
 
-    row = await asyncio.shield(_fetch())
+    fetched_row = await asyncio.shield(_fetch())
+    if fetched_row is None:
+        return None
+    row = dict(fetched_row)
+    cache.update([row])
+    return row
+
+
+async def _record_session_event(
+    app: web.Application,
+    event_name: str,
+    row: Mapping[str, Any],
+    reason: Optional[str],
+) -> None:
+    """
+    Append the event to the per-domain session event stream to allow replaying events
+    for reconnecting clients, and then deliver it with the stream entry ID
+    to the event streaming API handlers in all manager processes.
+    """
+    redis_stream = app['redis_stream']
+    domain_name = row['domain_name']
+    serialized_row = KernelOwnershipCache.serialize(row)
+
+    def _pipe_builder():
+        pipe = redis_stream.pipeline()
+        pipe.xadd(
+            f'events.session.{domain_name}',
+            {'data': json.dumps({
+                'event_name': event_name,
+                'row': serialized_row,
+                'reason': reason,
+            })},
+            max_len=SESSION_EVENT_STREAM_MAXLEN,
+            exact_len=False,
+        )
+        pipe.sadd(SESSION_EVENT_STREAM_DOMAINS_KEY, domain_name)
+        return pipe
+
+    result = await redis.execute_with_retries(_pipe_builder)
+    event_id = result[0] if result is not None else None
+    await app['event_dispatcher'].broadcast_event(
+        'session_event_recorded',
+        (event_id, event_name, serialized_row, reason),
+    )
+
+
+async def enqueue_kernel_status_update_with_creation_id(
+    app: web.Application,
+    agent_id: AgentId,
+    event_name: str,
+    raw_kernel_id: str,
+    kernel_creation_id: str,
+    reason: str = None,
+    exit_code: int = None,
+) -> None:
+    if raw_kernel_id is None:
+        return
+    kernel_id = uuid.UUID(raw_kernel_id)
+    row = await _lookup_kernel_owner(app, kernel_id)
     if row is None:
         return
-    for q in app['session_event_queues']:
-        q.put_nowait((event_name, row, reason))
+    await _record_session_event(app, event_name, row, reason)
 
 
 async def enqueue_kernel_status_update(
@@ -462,34 +1059,10 @@ async def enqueue_kernel_status_update(
     if raw_kernel_id is None:
         return
     kernel_id = uuid.UUID(raw_kernel_id)
-
-    async def _fetch():
-        async with app['dbpool'].acquire() as conn, conn.begin():
-            query = (
-                sa.select([
-                    kernels.c.id,
-                    kernels.c.session_id,
-                    kernels.c.session_name,
-                    kernels.c.access_key,
-                    kernels.c.cluster_role,
-                    kernels.c.cluster_idx,
-                    kernels.c.domain_name,
-                    kernels.c.group_id,
-                    kernels.c.user_uuid,
-                ])
-                .select_from(kernels)
-                .where(
-                    (kernels.c.id == kernel_id)
-                )
-            )
-            result = await conn.execute(query)
-            return await result.first()
-
-    row = await asyncio.shield(_fetch())
+    row = await _lookup_kernel_owner(app, kernel_id)
     if row is None:
         return
-    for q in app['session_event_queues']:
-        q.put_nowait((event_name, row, reason))
+    await _record_session_event(app, event_name, row, reason)
 
 
 async def enqueue_session_status_update_with_creation_id(
@@ -504,33 +1077,11 @@ async def enqueue_session_status_update_with_creation_id(
     if raw_session_id is None:
         return
     session_id = uuid.UUID(raw_session_id)
-
-    async def _fetch():
-        async with app['dbpool'].acquire() as conn:
-            query = (
-                sa.select([
-                    kernels.c.id,
-                    kernels.c.session_id,
-                    kernels.c.session_name,
-                    kernels.c.access_key,
-                    kernels.c.domain_name,
-                    kernels.c.group_id,
-                    kernels.c.user_uuid,
-                ])
-                .select_from(kernels)
-                .where(
-                    (kernels.c.id == session_id)
-                    # for the main kernel, kernel ID == session ID
-                )
-            )
-            result = await conn.execute(query)
-            return await result.first()
-
-    row = await asyncio.shield(_fetch())
+    # for the main kernel, kernel ID == session ID
+    row = await _lookup_kernel_owner(app, session_id)
     if row is None:
         return
-    for q in app['session_event_queues']:
-        q.put_nowait((event_name, row, reason))
+    await _record_session_event(app, event_name, row, reason)
 
 
 async def enqueue_session_status_update(
@@ -544,33 +1095,11 @@ async def enqueue_session_status_update(
     if raw_session_id is None:
         return
     session_id = uuid.UUID(raw_session_id)
-
-    async def _fetch():
-        async with app['dbpool'].acquire() as conn:
-            query = (
-                sa.select([
-                    kernels.c.id,
-                    kernels.c.session_id,
-                    kernels.c.session_name,
-                    kernels.c.access_key,
-                    kernels.c.domain_name,
-                    kernels.c.group_id,
-                    kernels.c.user_uuid,
-                ])
-                .select_from(kernels)
-                .where(
-                    (kernels.c.id == session_id)
-                    # for the main kernel, kernel ID == session ID
-                )
-            )
-            result = await conn.execute(query)
-            return await result.first()
-
-    row = await asyncio.shield(_fetch())
+    # for the main kernel, kernel ID == session ID
+    row = await _lookup_kernel_owner(app, session_id)
     if row is None:
         return
-    for q in app['session_event_queues']:
-        q.put_nowait((event_name, row, reason))
+    await _record_session_event(app, event_name, row, reason)
 
 
 async def enqueue_batch_task_result_update(
@@ -582,69 +1111,67 @@ async def enqueue_batch_task_result_update(
     exit_reason: str = None,
 ) -> None:
     kernel_id = uuid.UUID(raw_kernel_id)
-
-    async def _fetch():
-        async with app['dbpool'].acquire() as conn:
-            query = (
-                sa.select([
-                    kernels.c.id,
-                    kernels.c.session_id,
-                    kernels.c.session_name,
-                    kernels.c.access_key,
-                    kernels.c.domain_name,
-                    kernels.c.group_id,
-                    kernels.c.user_uuid,
-                ])
-                .select_from(kernels)
-                .where(
-                    (kernels.c.id == kernel_id)
-                )
-            )
-            result = await conn.execute(query)
-            return await result.first()
-
-    row = await asyncio.shield(_fetch())
+    row = await _lookup_kernel_owner(app, kernel_id)
     if row is None:
         return
     if event_name == 'session_success':
         reason = 'task-success'
     else:
         reason = 'task-failure'
-    for q in app['session_event_queues']:
-        q.put_nowait((event_name, row, reason))
+    await _record_session_event(app, event_name, row, reason)
+
+
+async def deliver_session_event(
+    app: web.Application,
+    agent_id: AgentId,
+    _event_name: str,
+    event_id: Optional[str],
+    event_name: str,
+    raw_row: Mapping[str, Any],
+    reason: Optional[str],
+) -> None:
+    row = KernelOwnershipCache.deserialize(raw_row)
+    app['session_event_subscriptions'].dispatch(event_name, row, reason, event_id)
+    kernel_ownership_cache = app['event_dispatcher'].kernel_ownership_cache
+    if event_name in ('kernel_terminated', 'kernel_cancelled'):
+        kernel_ownership_cache.invalidate(row['id'])
+    elif event_name in ('session_terminated', 'session_cancelled'):
+        kernel_ownership_cache.invalidate_session(row['session_id'])
 
 
 async def enqueue_task_status_update(
     app: web.Application,
     agent_id: AgentId,
     event_name: str,
-    raw_task_id: str,
-    current_progress: Union[int, float] = None,
-    total_progress: Union[int, float] = None,
-    message: str = None,
+    raw_event_args: Mapping[str, Any],
 ) -> None:
-    for q in app['task_update_queues']:
-        q.put_nowait((event_name, raw_task_id, current_progress, total_progress, message, ))
+    event_args = BackgroundTaskEventArgs(**raw_event_args)
+    queues = app['task_update_queues'].get(uuid.UUID(event_args.task_id))
+    if not queues:
+        return
+    for q in queues:
+        q.put_nowait((event_name, event_args))
 
 
 async def events_app_ctx(app: web.Application) -> AsyncIterator[None]:
-    app['session_event_queues'] = set()
-    app['task_update_queues'] = set()
+    app['session_event_subscriptions'] = SessionEventSubscriptionIndex()
+    app['task_update_queues'] = defaultdict(set)
     event_dispatcher = app['event_dispatcher']
-    event_dispatcher.subscribe('session_enqueued', app, enqueue_session_status_update_with_creation_id)
-    event_dispatcher.subscribe('session_scheduled', app, enqueue_session_status_update_with_creation_id)
-    event_dispatcher.subscribe('kernel_preparing', app, enqueue_kernel_status_update_with_creation_id)
-    event_dispatcher.subscribe('kernel_pulling', app, enqueue_kernel_status_update_with_creation_id)
-    event_dispatcher.subscribe('kernel_creating', app, enqueue_kernel_status_update_with_creation_id)
-    event_dispatcher.subscribe('kernel_started', app, enqueue_kernel_status_update_with_creation_id)
-    event_dispatcher.subscribe('session_started', app, enqueue_session_status_update_with_creation_id)
-    event_dispatcher.subscribe('kernel_terminating', app, enqueue_kernel_status_update)
-    event_dispatcher.subscribe('kernel_terminated', app, enqueue_kernel_status_update)
-    event_dispatcher.subscribe('session_terminated', app, enqueue_session_status_update)
-    event_dispatcher.subscribe('kernel_cancelled', app, enqueue_kernel_status_update)
-    event_dispatcher.subscribe('session_cancelled', app, enqueue_session_status_update_with_creation_id)
-    event_dispatcher.subscribe('session_success', app, enqueue_batch_task_result_update)
-    event_dispatcher.subscribe('session_failure', app, enqueue_batch_task_result_update)
+    event_dispatcher.consume('session_enqueued', app, enqueue_session_status_update_with_creation_id)
+    event_dispatcher.consume('session_scheduled', app, enqueue_session_status_update_with_creation_id)
+    event_dispatcher.consume('kernel_preparing', app, enqueue_kernel_status_update_with_creation_id)
+    event_dispatcher.consume('kernel_pulling', app, enqueue_kernel_status_update_with_creation_id)
+    event_dispatcher.consume('kernel_creating', app, enqueue_kernel_status_update_with_creation_id)
+    event_dispatcher.consume('kernel_started', app, enqueue_kernel_status_update_with_creation_id)
+    event_dispatcher.consume('session_started', app, enqueue_session_status_update_with_creation_id)
+    event_dispatcher.consume('kernel_terminating', app, enqueue_kernel_status_update)
+    event_dispatcher.consume('kernel_terminated', app, enqueue_kernel_status_update)
+    event_dispatcher.consume('session_terminated', app, enqueue_session_status_update)
+    event_dispatcher.consume('kernel_cancelled', app, enqueue_kernel_status_update)
+    event_dispatcher.consume('session_cancelled', app, enqueue_session_status_update_with_creation_id)
+    event_dispatcher.consume('session_success', app, enqueue_batch_task_result_update)
+    event_dispatcher.consume('session_failure', app, enqueue_batch_task_result_update)
+    event_dispatcher.subscribe('session_event_recorded', app, deliver_session_event)
     event_dispatcher.subscribe('task_updated', app, enqueue_task_status_update)
     event_dispatcher.subscribe('task_done', app, enqueue_task_status_update)
     event_dispatcher.subscribe('task_cancelled', app, enqueue_task_status_update)
@@ -656,10 +1183,11 @@ async def events_app_ctx(app: web.Application) -> AsyncIterator[None]:
 async def events_shutdown(app: web.Application) -> None:
     # shutdown handler is called before waiting for closing active connections.
     # We need to put sentinels here to ensure delivery of them to active SSE connections.
-    for q in app['session_event_queues']:
-        q.put_nowait(sentinel)
-    for q in app['task_update_queues']:
-        q.put_nowait(sentinel)
+    for subscriber in app['session_event_subscriptions']:
+        subscriber.put(sentinel)
+    for queues in app['task_update_queues'].values():
+        for q in queues:
+            q.put_nowait(sentinel)
     await asyncio.sleep(0)
 
 
@@ -223,6 +223,16 @@ class AppNotFound(BackendError, web.HTTPNotFound):
     error_title = 'No such app service provided by the session.'
 
 
+class FileOffsetMismatch(BackendError, web.HTTPConflict):
+    error_type  = 'https://api.backend.ai/probs/file-offset-mismatch'
+    error_title = 'The upload offset does not match the current size of the file.'
+
+
+class FileTooLarge(BackendError, web.HTTPRequestEntityTooLarge):
+    error_type  = 'https://api.backend.ai/probs/file-too-large'
+    error_title = 'The file is too large to transfer via this API.'
+
+
 class SessionAlreadyExists(BackendError, web.HTTPBadRequest):
     error_type  = 'https://api.backend.ai/probs/session-already-exists'
     error_title = 'The session already exists but you requested not to reuse existing one.'
@@ -82,7 +82,10 @@ async def append(request: web.Request, params: Any) -> web.Response:
 )
 async def list_logs(request: web.Request, params: Any) -> web.Response:
     resp: MutableMapping[str, Any] = {'logs': []}
-    dbpool = request.app['dbpool']
+    if params['mark_read']:
+        dbpool = request.app['dbpool']
+    else:
+        dbpool = request.app['dbpool_router'].readonly
     domain_name = request['user']['domain_name']
     user_role = request['user']['role']
     user_uuid = request['user']['uuid']
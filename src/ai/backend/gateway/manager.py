@@ -119,6 +119,7 @@ async def fetch_manager_status(request: web.Request) -> web.Response:
                     'ssl_enabled': configs['ssl-enabled'],
                     'active_sessions': active_sessions_num,
                     'status': status.value,
+                    'draining': etcd_info.get(_id) == 'draining',
                 }
             ]
             return web.json_response({
@@ -1,3 +1,454 @@
 '''
 Usage metrics.
+
+This module collects per-route API request metrics (latency, database time,
+and the number of SQL statements and Redis commands) and the per-connection
+streaming metrics (bandwidth, message rates and send latency), and reports them
+periodically via the stats monitor plugins, along with the database
+connection pool statistics.
 '''
+
+from __future__ import annotations
+
+import asyncio
+import bisect
+from contextvars import ContextVar
+import logging
+import re
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Final,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from aiohttp import web
+import aioredis
+import attr
+
+from ai.backend.common.logging import BraceStyleAdapter
+from ai.backend.common.plugin.monitor import GAUGE, StatsPluginContext
+
+from ..manager.models.engine import InstrumentedEngine
+from .types import WebRequestHandler
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.gateway.metric'))
+
+# upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS: Final = (
+    0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5,
+    1.0, 2.0, 5.0, 10.0, 30.0, 60.0, float('inf'),
+)
+MAX_CAPTURED_STATEMENTS: Final = 64
+
+_rx_metric_name_unsafe = re.compile(r'[^A-Za-z0-9]+')
+
+
+@attr.s(auto_attribs=True, slots=True)
+class RequestMetrics:
+    db_acquire_wait: float = 0.0
+    db_time: float = 0.0
+    num_sql: int = 0
+    num_redis_commands: int = 0
+    # SQLAlchemy statement objects are kept as-is and stringified
+    # only when logging slow requests.
+    statements: List[Tuple[Any, float]] = attr.Factory(list)
+
+
+current_request_metrics: ContextVar[Optional[RequestMetrics]] = \
+    ContextVar('current_request_metrics', default=None)
+
+
+def record_db_acquire(wait_time: float) -> None:
+    metrics = current_request_metrics.get()
+    if metrics is not None:
+        metrics.db_acquire_wait += wait_time
+
+
+def record_db_query(query: Any, elapsed: float) -> None:
+    metrics = current_request_metrics.get()
+    if metrics is not None:
+        metrics.num_sql += 1
+        metrics.db_time += elapsed
+        if len(metrics.statements) < MAX_CAPTURED_STATEMENTS:
+            metrics.statements.append((query, elapsed))
+
+
+class InstrumentedRedis(aioredis.Redis):
+    """
+    A Redis commands interface which counts the commands issued
+    while handling each API request, including the pipelined ones.
+
+    Use it as the ``commands_factory`` when creating Redis connection pools.
+    """
+
+    def execute(self, command, *args, **kwargs):
+        metrics = current_request_metrics.get()
+        if metrics is not None:
+            metrics.num_redis_commands += 1
+        return super().execute(command, *args, **kwargs)
+
+
+class LatencyHistogram:
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self) -> None:
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Returns the upper bound of the bucket containing the given quantile
+        (or the observed maximum for the last bucket).
+        """
+        threshold = q * self.count
+        cumulative = 0
+        for upper_bound, count in zip(LATENCY_BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= threshold and count > 0:
+                return min(upper_bound, self.max)
+        return self.max
+
+
+@attr.s(auto_attribs=True, slots=True)
+class RouteStats:
+    latency: LatencyHistogram = attr.Factory(LatencyHistogram)
+    db_acquire_wait: float = 0.0
+    db_time: float = 0.0
+    num_sql: int = 0
+    num_redis_commands: int = 0
+    num_failures: int = 0
+
+    def record(self, latency: float, metrics: RequestMetrics, failed: bool) -> None:
+        self.latency.observe(latency)
+        self.db_acquire_wait += metrics.db_acquire_wait
+        self.db_time += metrics.db_time
+        self.num_sql += metrics.num_sql
+        self.num_redis_commands += metrics.num_redis_commands
+        if failed:
+            self.num_failures += 1
+
+
+class RequestMetricsCollector:
+    """
+    Aggregates the per-route request metrics in each worker process
+    and reports them to the stats monitor at every interval.
+    """
+
+    route_stats: Dict[str, RouteStats]
+
+    def __init__(self, slow_request_threshold: float = 0.0) -> None:
+        self.slow_request_threshold = slow_request_threshold
+        self.route_stats = {}
+
+    def record(
+        self,
+        route: str,
+        latency: float,
+        metrics: RequestMetrics,
+        *,
+        failed: bool = False,
+    ) -> None:
+        stats = self.route_stats.get(route)
+        if stats is None:
+            stats = self.route_stats[route] = RouteStats()
+        stats.record(latency, metrics, failed)
+        if 0 < self.slow_request_threshold <= latency:
+            self._log_slow_request(route, latency, metrics)
+
+    def _log_slow_request(self, route: str, latency: float, metrics: RequestMetrics) -> None:
+        statements = '\n'.join(
+            f'  [{elapsed * 1000:.1f} ms] {query}'
+            for query, elapsed in metrics.statements
+        )
+        log.warning(
+            'slow request: {} took {:.3f} sec '
+            '(db-wait: {:.3f} sec, db: {:.3f} sec, sql: {}, redis: {})\n{}',
+            route, latency,
+            metrics.db_acquire_wait, metrics.db_time,
+            metrics.num_sql, metrics.num_redis_commands,
+            statements,
+        )
+
+    async def report(self, stats_monitor: StatsPluginContext) -> None:
+        route_stats, self.route_stats = self.route_stats, {}
+        for route, stats in route_stats.items():
+            count = stats.latency.count
+            prefix = 'ai.backend.gateway.api.routes.' + \
+                     _rx_metric_name_unsafe.sub('_', route).strip('_')
+            await stats_monitor.report_metric(GAUGE, f'{prefix}.count', count)
+            await stats_monitor.report_metric(GAUGE, f'{prefix}.failures', stats.num_failures)
+            await stats_monitor.report_metric(
+                GAUGE, f'{prefix}.latency_avg', stats.latency.total / count)
+            for q in (0.5, 0.95, 0.99):
+                await stats_monitor.report_metric(
+                    GAUGE, f'{prefix}.latency_p{int(q * 100)}', stats.latency.quantile(q))
+            await stats_monitor.report_metric(
+                GAUGE, f'{prefix}.latency_max', stats.latency.max)
+            await stats_monitor.report_metric(
+                GAUGE, f'{prefix}.db_wait_avg', stats.db_acquire_wait / count)
+            await stats_monitor.report_metric(
+                GAUGE, f'{prefix}.db_time_avg', stats.db_time / count)
+            await stats_monitor.report_metric(
+                GAUGE, f'{prefix}.sql_count_avg', stats.num_sql / count)
+            await stats_monitor.report_metric(
+                GAUGE, f'{prefix}.redis_count_avg', stats.num_redis_commands / count)
+
+    async def report_loop(self, stats_monitor: StatsPluginContext, interval: float = 10.0) -> None:
+        while True:
+            try:
+                await asyncio.sleep(interval)
+                await self.report(stats_monitor)
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                log.exception('RequestMetricsCollector.report(): unexpected-error')
+
+
+async def report_db_pool_stats(
+    dbpool: InstrumentedEngine,
+    stats_monitor: StatsPluginContext,
+    *,
+    prefix: str = 'ai.backend.gateway.db.pool',
+) -> None:
+    stats = dbpool.stats
+    await stats_monitor.report_metric(GAUGE, f'{prefix}.size', dbpool.size)
+    await stats_monitor.report_metric(GAUGE, f'{prefix}.in_use', dbpool.size - dbpool.freesize)
+    await stats_monitor.report_metric(GAUGE, f'{prefix}.waiting', stats.num_waiting)
+    await stats_monitor.report_metric(GAUGE, f'{prefix}.slow_queries', stats.num_slow_queries)
+    if stats.acquire_count > 0:
+        await stats_monitor.report_metric(
+            GAUGE, f'{prefix}.acquire_wait_avg', stats.acquire_wait_sum / stats.acquire_count)
+        await stats_monitor.report_metric(
+            GAUGE, f'{prefix}.acquire_wait_max', stats.acquire_wait_max)
+    if stats.hold_count > 0:
+        await stats_monitor.report_metric(
+            GAUGE, f'{prefix}.hold_time_avg', stats.hold_time_sum / stats.hold_count)
+        await stats_monitor.report_metric(
+            GAUGE, f'{prefix}.hold_time_max', stats.hold_time_max)
+    stats.reset_window()
+
+
+async def db_pool_report_loop(
+    dbpool: InstrumentedEngine,
+    stats_monitor: StatsPluginContext,
+    interval: float = 10.0,
+    *,
+    prefix: str = 'ai.backend.gateway.db.pool',
+) -> None:
+    while True:
+        try:
+            await asyncio.sleep(interval)
+            await report_db_pool_stats(dbpool, stats_monitor, prefix=prefix)
+        except asyncio.CancelledError:
+            break
+        except Exception:
+            log.exception('report_db_pool_stats(): unexpected-error')
+
+
+@attr.s(auto_attribs=True, slots=True)
+class StreamKindStats:
+    # measurements since the last report
+    bytes_in: int = 0
+    bytes_out: int = 0
+    frames_in: int = 0
+    frames_out: int = 0
+    send_latency: LatencyHistogram = attr.Factory(LatencyHistogram)
+
+    def reset_window(self) -> None:
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.send_latency = LatencyHistogram()
+
+
+@attr.s(auto_attribs=True, slots=True, eq=False)
+class StreamConnStats:
+    """
+    The traffic statistics of a streaming connection.
+    "in" is the client-to-server direction and "out" is the opposite.
+    """
+    kind: str
+    session_id: Any
+    access_key: str
+    window: StreamKindStats
+    started_at: float = attr.Factory(time.monotonic)
+    bytes_in: int = 0
+    bytes_out: int = 0
+    frames_in: int = 0
+    frames_out: int = 0
+    send_latency_sum: float = 0.0
+    send_latency_max: float = 0.0
+    # returns the number of messages pending in the connection's buffer, if any
+    queue_depth: Optional[Callable[[], int]] = None
+
+    def record_in(self, nbytes: int) -> None:
+        self.bytes_in += nbytes
+        self.frames_in += 1
+        self.window.bytes_in += nbytes
+        self.window.frames_in += 1
+
+    def record_out(self, nbytes: int, send_latency: float) -> None:
+        self.bytes_out += nbytes
+        self.frames_out += 1
+        self.send_latency_sum += send_latency
+        self.send_latency_max = max(self.send_latency_max, send_latency)
+        self.window.bytes_out += nbytes
+        self.window.frames_out += 1
+        self.window.send_latency.observe(send_latency)
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            'kind': self.kind,
+            'session_id': str(self.session_id),
+            'access_key': self.access_key,
+            'duration': time.monotonic() - self.started_at,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'send_latency_avg': (
+                self.send_latency_sum / self.frames_out if self.frames_out else None
+            ),
+            'send_latency_max': self.send_latency_max,
+            'queue_depth': None if self.queue_depth is None else self.queue_depth(),
+        }
+
+
+class StreamMetricsCollector:
+    """
+    Tracks the active streaming connections (PTY, execute and service proxies)
+    in each worker process and reports their traffic to the stats monitor
+    at every interval.
+    """
+
+    connections: Set[StreamConnStats]
+    kind_stats: Dict[str, StreamKindStats]
+
+    def __init__(self) -> None:
+        self.connections = set()
+        self.kind_stats = {}
+
+    def open(self, kind: str, session_id: Any, access_key: str) -> StreamConnStats:
+        window = self.kind_stats.get(kind)
+        if window is None:
+            window = self.kind_stats[kind] = StreamKindStats()
+        stats = StreamConnStats(kind, session_id, access_key, window)
+        self.connections.add(stats)
+        return stats
+
+    def close(self, stats: StreamConnStats) -> None:
+        self.connections.discard(stats)
+
+    def snapshot(self) -> Dict[str, Any]:
+        summary: Dict[str, Dict[str, Any]] = {
+            kind: {'active': 0, 'sessions': set()} for kind in self.kind_stats
+        }
+        for conn in self.connections:
+            summary[conn.kind]['active'] += 1
+            summary[conn.kind]['sessions'].add(str(conn.session_id))
+        return {
+            'kinds': {
+                kind: {'active': item['active'], 'sessions': len(item['sessions'])}
+                for kind, item in summary.items()
+            },
+            'connections': [conn.as_dict() for conn in self.connections],
+        }
+
+    async def report(self, stats_monitor: StatsPluginContext) -> None:
+        active: Dict[str, int] = {kind: 0 for kind in self.kind_stats}
+        sessions: Dict[str, Set[Any]] = {kind: set() for kind in self.kind_stats}
+        queue_depth_sum: Dict[str, int] = {kind: 0 for kind in self.kind_stats}
+        queue_depth_max: Dict[str, int] = {kind: 0 for kind in self.kind_stats}
+        for conn in self.connections:
+            active[conn.kind] += 1
+            sessions[conn.kind].add(conn.session_id)
+            if conn.queue_depth is not None:
+                depth = conn.queue_depth()
+                queue_depth_sum[conn.kind] += depth
+                queue_depth_max[conn.kind] = max(queue_depth_max[conn.kind], depth)
+        for kind, stats in self.kind_stats.items():
+            prefix = f'ai.backend.gateway.streams.{kind}'
+            await stats_monitor.report_metric(GAUGE, f'{prefix}.active', active[kind])
+            await stats_monitor.report_metric(GAUGE, f'{prefix}.sessions', len(sessions[kind]))
+            await stats_monitor.report_metric(GAUGE, f'{prefix}.bytes_in', stats.bytes_in)
+            await stats_monitor.report_metric(GAUGE, f'{prefix}.bytes_out', stats.bytes_out)
+            await stats_monitor.report_metric(GAUGE, f'{prefix}.frames_in', stats.frames_in)
+            await stats_monitor.report_metric(GAUGE, f'{prefix}.frames_out', stats.frames_out)
+            await stats_monitor.report_metric(
+                GAUGE, f'{prefix}.queue_depth_sum', queue_depth_sum[kind])
+            await stats_monitor.report_metric(
+                GAUGE, f'{prefix}.queue_depth_max', queue_depth_max[kind])
+            latency = stats.send_latency
+            if latency.count > 0:
+                await stats_monitor.report_metric(
+                    GAUGE, f'{prefix}.send_latency_avg', latency.total / latency.count)
+                for q in (0.5, 0.95, 0.99):
+                    await stats_monitor.report_metric(
+                        GAUGE, f'{prefix}.send_latency_p{int(q * 100)}', latency.quantile(q))
+                await stats_monitor.report_metric(
+                    GAUGE, f'{prefix}.send_latency_max', latency.max)
+            stats.reset_window()
+
+    async def report_loop(self, stats_monitor: StatsPluginContext, interval: float = 10.0) -> None:
+        while True:
+            try:
+                await asyncio.sleep(interval)
+                await self.report(stats_monitor)
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                log.exception('StreamMetricsCollector.report(): unexpected-error')
+
+
+def get_route_name(request: web.Request) -> str:
+    resource = request.match_info.route.resource
+    if resource is None:
+        return '(unmatched)'
+    return f'{request.method} {resource.canonical}'
+
+
+@web.middleware
+async def metric_middleware(request: web.Request,
+                            handler: WebRequestHandler) -> web.StreamResponse:
+    # This is a global middleware: request.app is the root app.
+    collector: RequestMetricsCollector = request.app['request_metrics']
+    metrics = RequestMetrics()
+    token = current_request_metrics.set(metrics)
+    started_at = time.perf_counter()
+    failed = True
+    streaming = False
+    try:
+        resp = await handler(request)
+        failed = resp.status >= 500
+        # Long-lived streaming responses (e.g., websockets and SSE) are excluded
+        # as their latency is determined by the client.
+        streaming = not isinstance(resp, web.Response)
+        return resp
+    except web.HTTPException as e:
+        failed = e.status_code >= 500
+        raise
+    finally:
+        current_request_metrics.reset(token)
+        if not streaming:
+            collector.record(
+                get_route_name(request),
+                time.perf_counter() - started_at,
+                metrics,
+                failed=failed,
+            )
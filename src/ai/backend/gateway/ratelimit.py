@@ -1,22 +1,28 @@
 from __future__ import annotations
 
+from abc import ABCMeta, abstractmethod
 from decimal import Decimal
 import logging
 import time
 from typing import (
+    Dict,
     Iterable,
     Final,
+    Optional,
     Tuple,
 )
 
 from aiohttp import web
+import aioredis
 from aiotools import apartial
+import attr
 
 from ai.backend.common import redis
 from ai.backend.common.logging import BraceStyleAdapter
 
 from .defs import REDIS_RLIM_DB
 from .exceptions import RateLimitExceeded
+from .metric import InstrumentedRedis, get_route_name
 from .types import CORSOptions, WebRequestHandler, WebMiddleware
 
 log = BraceStyleAdapter(logging.getLogger('ai.backend.gateway.ratelimit'))
@@ -43,29 +49,151 @@ redis.call('EXPIRE', access_key, window)
 return redis.call('ZCARD', access_key)
 '''
 
+# The sliding-window counter approximates the rolling count with two fixed-window
+# counters, weighting the previous window by its overlap with the rolling window.
+# It keeps O(1) state per key regardless of the request volume.
+
+_sliding_window_script = '''
+local cur_key = KEYS[1]
+local prev_key = KEYS[2]
+local elapsed_ratio = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local prev_count = tonumber(redis.call('GET', prev_key) or '0')
+local cur_count = redis.call('INCRBY', cur_key, cost)
+if cur_count == cost then
+    redis.call('EXPIRE', cur_key, window * 2)
+end
+return math.floor(prev_count * (1 - elapsed_ratio) + cur_count)
+'''
+
+
+class BaseRateLimiter(metaclass=ABCMeta):
+
+    def __init__(self, redis_rlim: aioredis.Redis, window: int = _rlim_window) -> None:
+        self.redis_rlim = redis_rlim
+        self.window = window
+
+    @abstractmethod
+    async def consume(self, key: str, rate_limit: int) -> Optional[int]:
+        """
+        Counts a request for the given key and returns the rolling count
+        within the window including it, or None if the Redis connection is closed.
+        """
+        raise NotImplementedError
+
+
+class RollingLogRateLimiter(BaseRateLimiter):
+    """
+    Records every request in a Redis sorted set per key.
+    This is exact but the state grows linearly with the request volume.
+    """
+
+    async def consume(self, key: str, rate_limit: int) -> Optional[int]:
+        now = Decimal(time.time()).quantize(_time_prec)
+        ret = await redis.execute_script(
+            self.redis_rlim, 'ratelimit', _rlim_script,
+            [key],
+            [str(now), str(self.window)],
+        )
+        if ret is None:
+            return None
+        return int(ret)
+
+
+@attr.s(auto_attribs=True, slots=True)
+class _TokenLease:
+    tokens: int
+    rolling_count: int
+    expires_at: float
+
+
+class SlidingWindowRateLimiter(BaseRateLimiter):
+    """
+    Keeps two fixed-window counters per key in Redis.
+
+    If ``lease_size`` is larger than 1, each worker process reserves a batch of
+    tokens at once and serves the subsequent requests of the same key locally
+    until the lease is used up or expires, reducing Redis round-trips for
+    high-QPS keys.  Unused leased tokens are still counted, so a lease is capped
+    to 1% of the rate limit to bound the over-counting.
+    """
+
+    _leases: Dict[str, _TokenLease]
+
+    def __init__(
+        self,
+        redis_rlim: aioredis.Redis,
+        window: int = _rlim_window,
+        *,
+        lease_size: int = 1,
+        lease_ttl: float = 1.0,
+        max_leases: int = 16384,
+    ) -> None:
+        super().__init__(redis_rlim, window)
+        self.lease_size = lease_size
+        self.lease_ttl = lease_ttl
+        self.max_leases = max_leases
+        self._leases = {}
+
+    async def consume(self, key: str, rate_limit: int) -> Optional[int]:
+        lease = self._leases.pop(key, None)
+        if lease is not None and lease.tokens > 0 and lease.expires_at > time.monotonic():
+            lease.tokens -= 1
+            lease.rolling_count += 1
+            self._leases[key] = lease
+            return lease.rolling_count
+        cost = min(self.lease_size, max(1, rate_limit // 100))
+        now = time.time()
+        window_start = int(now // self.window) * self.window
+        ret = await redis.execute_script(
+            self.redis_rlim, 'ratelimit_sliding_window', _sliding_window_script,
+            [f'{key}:{window_start}', f'{key}:{window_start - self.window}'],
+            [str((now - window_start) / self.window), str(self.window), str(cost)],
+        )
+        if ret is None:
+            return None
+        # the rolling count as of the first token in this batch
+        rolling_count = int(ret) - cost + 1
+        granted = min(cost, rate_limit - rolling_count + 1)
+        if granted > 1:
+            if len(self._leases) >= self.max_leases:
+                self._expire_leases()
+            self._leases[key] = _TokenLease(
+                tokens=granted - 1,
+                rolling_count=rolling_count,
+                expires_at=time.monotonic() + self.lease_ttl,
+            )
+        return rolling_count
+
+    def _expire_leases(self) -> None:
+        now = time.monotonic()
+        for key in [k for k, lease in self._leases.items() if lease.expires_at <= now]:
+            del self._leases[key]
+
 
 @web.middleware
 async def rlim_middleware(app: web.Application,
                           request: web.Request,
                           handler: WebRequestHandler) -> web.StreamResponse:
     # This is a global middleware: request.app is the root app.
-    now = Decimal(time.time()).quantize(_time_prec)
-    rr = app['redis_rlim']
+    limiter: BaseRateLimiter = app['rate_limiter']
     if request['is_authorized']:
         rate_limit = request['keypair']['rate_limit']
         access_key = request['keypair']['access_key']
-        ret = await redis.execute_script(
-            rr, 'ratelimit', _rlim_script,
-            [access_key],
-            [str(now), str(_rlim_window)],
-        )
-        if ret is None:
+        rolling_count = await limiter.consume(access_key, rate_limit)
+        if rolling_count is None:
             remaining = rate_limit
         else:
-            rolling_count = int(ret)
             if rolling_count > rate_limit:
                 raise RateLimitExceeded
             remaining = rate_limit - rolling_count
+        endpoint = get_route_name(request)
+        endpoint_rate_limit = app['rate_limit_endpoint_overrides'].get(endpoint)
+        if endpoint_rate_limit is not None:
+            rolling_count = await limiter.consume(f'{access_key}:{endpoint}', endpoint_rate_limit)
+            if rolling_count is not None and rolling_count > endpoint_rate_limit:
+                raise RateLimitExceeded
         response = await handler(request)
         response.headers['X-RateLimit-Limit'] = str(rate_limit)
         response.headers['X-RateLimit-Remaining'] = str(remaining)
@@ -81,13 +209,22 @@ async def rlim_middleware(app: web.Application,
 
 
 async def init(app: web.Application) -> None:
+    mgr_config = app['local_config']['manager']
     rr = await redis.connect_with_retries(
         str(app['shared_config'].get_redis_url(db=REDIS_RLIM_DB)),
         timeout=3.0,
         encoding='utf8',
+        commands_factory=InstrumentedRedis,
     )
     app['redis_rlim'] = rr
-    app['redis_rlim_script'] = await rr.script_load(_rlim_script)
+    limiter: BaseRateLimiter
+    if mgr_config['rate-limiter'] == 'sliding-window':
+        limiter = SlidingWindowRateLimiter(rr, lease_size=mgr_config['rate-limit-lease-size'])
+    else:
+        limiter = RollingLogRateLimiter(rr)
+        app['redis_rlim_script'] = await rr.script_load(_rlim_script)
+    app['rate_limiter'] = limiter
+    app['rate_limit_endpoint_overrides'] = mgr_config['rate-limit-endpoint-overrides']
 
 
 async def shutdown(app: web.Application) -> None:
@@ -43,7 +43,8 @@ from ..manager.models import (
     association_groups_users,
     query_allowed_sgroups,
     AGENT_RESOURCE_OCCUPYING_KERNEL_STATUSES,
-    RESOURCE_USAGE_KERNEL_STATUSES, LIVE_STATUS,
+    RESOURCE_USAGE_KERNEL_STATUSES,
+    usage_daily,
 )
 from .types import CORSOptions, WebMiddleware
 from .utils import check_api_params
@@ -276,23 +277,45 @@ async def recalculate_usage(request) -> web.Response:
 
 
 async def get_container_stats_for_period(request, start_date, end_date, group_ids=None):
-    async with request.app['dbpool'].acquire() as conn, conn.begin():
-        j = (kernels.join(groups, groups.c.id == kernels.c.group_id)
-                    .join(users, users.c.uuid == kernels.c.user_uuid))
+    # Read the usage aggregated per kernel from the daily rollups,
+    # instead of scanning the kernels and their last statistics for the whole period.
+    usage = (
+        sa.select([
+            usage_daily.c.kernel_id,
+            sa.func.sum(usage_daily.c.cpu_used).label('cpu_used'),
+            sa.func.max(usage_daily.c.mem_used).label('mem_used'),
+            sa.func.max(usage_daily.c.disk_used).label('disk_used'),
+            sa.func.sum(usage_daily.c.io_read).label('io_read'),
+            sa.func.sum(usage_daily.c.io_write).label('io_write'),
+        ])
+        .select_from(usage_daily)
+        .where(
+            (usage_daily.c.bucket >= start_date) &
+            (usage_daily.c.bucket < end_date)
+        )
+        .group_by(usage_daily.c.kernel_id)
+    )
+    if group_ids:
+        usage = usage.where(usage_daily.c.group_id.in_(group_ids))
+    usage = usage.alias('usage')
+    async with request.app['dbpool_router'].readonly.acquire() as conn, conn.begin():
+        j = (usage.join(kernels, kernels.c.id == usage.c.kernel_id)
+                  .join(groups, groups.c.id == kernels.c.group_id)
+                  .join(users, users.c.uuid == kernels.c.user_uuid))
         query = (
-            sa.select([kernels, groups.c.name, users.c.email])
+            sa.select([
+                usage,
+                kernels.c.id, kernels.c.container_id, kernels.c.session_name,
+                kernels.c.domain_name, kernels.c.group_id, kernels.c.access_key,
+                kernels.c.agent, kernels.c.image, kernels.c.mounts,
+                kernels.c.occupied_slots, kernels.c.attached_devices, kernels.c.resource_opts,
+                kernels.c.created_at, kernels.c.terminated_at,
+                kernels.c.status, kernels.c.status_changed,
+                groups.c.name, users.c.email,
+            ])
             .select_from(j)
-            .where(
-                # Filter sessions which existence period overlaps with requested period
-                ((kernels.c.terminated_at >= start_date) & (kernels.c.created_at < end_date) &
-                 (kernels.c.status.in_(RESOURCE_USAGE_KERNEL_STATUSES))) |
-                # Or, filter running sessions which created before requested end_date
-                ((kernels.c.created_at < end_date) & (kernels.c.status.in_(LIVE_STATUS)))
-            )
             .order_by(sa.asc(kernels.c.terminated_at))
         )
-        if group_ids:
-            query = query.where(kernels.c.group_id.in_(group_ids))
         result = await conn.execute(query)
         rows = await result.fetchall()
 
@@ -301,7 +324,6 @@ async def get_container_stats_for_period(request, start_date, end_date, group_id
 
     for row in rows:
         group_id = str(row['group_id'])
-        last_stat = row['last_stat']
         nfs = None
         if row['mounts'] is not None:
             nfs = list(set([mount[1] for mount in row['mounts']]))
@@ -336,14 +358,14 @@ async def get_container_stats_for_period(request, start_date, end_date, group_id
             'email': row['email'],
             'agent': row['agent'],
             'cpu_allocated': float(row.occupied_slots.get('cpu', 0)),
-            'cpu_used': float(nmget(last_stat, 'cpu_used.current', 0)),
+            'cpu_used': float(row['cpu_used']),
             'mem_allocated': int(row.occupied_slots.get('mem', 0)),
-            'mem_used': int(nmget(last_stat, 'mem.capacity', 0)),
+            'mem_used': int(row['mem_used']),
             'shared_memory': int(nmget(row.resource_opts, 'shmem', 0)),
             'disk_allocated': 0,  # TODO: disk quota limit
-            'disk_used': (int(nmget(last_stat, 'io_scratch_size/stats.max', 0, '/'))),
-            'io_read': int(nmget(last_stat, 'io_read.current', 0)),
-            'io_write': int(nmget(last_stat, 'io_write.current', 0)),
+            'disk_used': int(row['disk_used']),
+            'io_read': int(row['io_read']),
+            'io_write': int(row['io_write']),
             'used_time': used_time,
             'used_days': used_days,
             'device_type': list(device_type),
@@ -413,6 +435,10 @@ async def usage_per_month(request: web.Request, params: Any) -> web.Response:
     '''
     Return usage statistics of terminated containers for a specified month.
     The date/time comparison is done using the configured timezone.
+    The statistics are read from the daily usage rollups, so the usage of running
+    containers is as recent as the last rollup and the cumulative usage (e.g., CPU time
+    and I/O bytes) counts only the portion within the month, where the increments
+    between two rollups are apportioned to the days by the running time.
 
     :param group_ids: If not None, query containers only in those groups.
     :param month: The year-month to query usage statistics. ex) "202006" to query for Jun 2020
@@ -445,6 +471,7 @@ async def usage_per_period(request: web.Request, params: Any) -> web.Response:
     Return usage statistics of terminated containers belonged to the given group for a specified
     period in dates.
     The date/time comparison is done using the configured timezone.
+    The statistics are read from the daily usage rollups as in :func:`usage_per_month`.
 
     :param group_id: If not None, query containers only in the group.
     :param start_date str: "yyyymmdd" format.
@@ -491,7 +518,7 @@ async def get_time_binned_monthly_stats(request, user_uuid=None):
     time_window = 900  # 15 min
     now = datetime.now(tzutc())
     start_date = now - timedelta(days=30)
-    async with request.app['dbpool'].acquire() as conn, conn.begin():
+    async with request.app['dbpool_router'].readonly.acquire() as conn, conn.begin():
         query = (
             sa.select([kernels])
             .select_from(kernels)
@@ -22,6 +22,7 @@ from typing import (
     Mapping,
     MutableMapping,
     Sequence,
+    Tuple,
     cast,
 )
 
@@ -29,7 +30,6 @@ from aiohttp import web
 import aiohttp_cors
 import aiojobs.aiohttp
 import aiotools
-from aiopg.sa import create_engine
 from aiopg.sa.engine import get_dialect
 import click
 from pathlib import Path
@@ -46,23 +46,40 @@ from ai.backend.common.plugin.monitor import (
     StatsPluginContext,
     INCREMENT,
 )
+from ai.backend.common.types import HostPortPair
 
 from ..manager import __version__
 from ..manager.background import BackgroundTaskManager
 from ..manager.exceptions import InvalidArgument
 from ..manager.idle import create_idle_checkers
+from ..manager.models.engine import InstrumentedEngine, ReadReplicaRouter, create_engine
 from ..manager.models.storage import StorageSessionManager
 from ..manager.plugin.webapp import WebappPluginContext
-from ..manager.registry import AgentRegistry
+from ..manager.registry import (
+    AgentRegistry,
+    SessionRoutingCache,
+    SessionUsageBuffer,
+    invalidate_session_route,
+)
 from ..manager.scheduler.dispatcher import SchedulerDispatcher
+from ..manager.usage import UsageRollup
 from .config import (
     LocalConfig,
     SharedConfig,
     load as load_config,
     volume_config_iv,
 )
+from .auth import AuthContextCache, KeypairUsageBuffer, invalidate_auth_context
 from .defs import REDIS_STAT_DB, REDIS_LIVE_DB, REDIS_IMAGE_DB, REDIS_STREAM_DB
 from .events import EventDispatcher
+from .metric import (
+    InstrumentedRedis,
+    RequestMetricsCollector,
+    db_pool_report_loop,
+    metric_middleware,
+    record_db_acquire,
+    record_db_query,
+)
 from .exceptions import (
     BackendError,
     MethodNotAllowed,
@@ -122,6 +139,7 @@ PUBLIC_INTERFACES: Final = [
     'local_config',
     'shared_config',
     'dbpool',
+    'dbpool_router',
     'registry',
     'redis_live',
     'redis_stat',
@@ -285,21 +303,25 @@ async def redis_ctx(app: web.Application) -> AsyncIterator[None]:
         str(app['shared_config'].get_redis_url(db=REDIS_LIVE_DB)),
         timeout=3.0,
         encoding='utf8',
+        commands_factory=InstrumentedRedis,
     )
     app['redis_stat'] = await redis.connect_with_retries(
         str(app['shared_config'].get_redis_url(db=REDIS_STAT_DB)),
         timeout=3.0,
         encoding='utf8',
+        commands_factory=InstrumentedRedis,
     )
     app['redis_image'] = await redis.connect_with_retries(
         str(app['shared_config'].get_redis_url(db=REDIS_IMAGE_DB)),
         timeout=3.0,
         encoding='utf8',
+        commands_factory=InstrumentedRedis,
     )
     app['redis_stream'] = await redis.connect_with_retries(
         str(app['shared_config'].get_redis_url(db=REDIS_STREAM_DB)),
         timeout=3.0,
         encoding='utf8',
+        commands_factory=InstrumentedRedis,
     )
     _update_public_interface_objs(app)
     yield
@@ -313,31 +335,109 @@ async def redis_ctx(app: web.Application) -> AsyncIterator[None]:
     await app['redis_stream'].wait_closed()
 
 
+def get_db_pool_size(local_config: LocalConfig) -> Tuple[int, int]:
+    '''
+    Returns the minimum and maximum size of the database connection pool
+    of each worker process.
+
+    The size applies to each database endpoint: when a read replica is configured,
+    every worker keeps a separately sized pool for the primary and the replica.
+    '''
+    db_config = local_config['db']
+    maxsize = db_config['pool-max-size']
+    if db_config['max-connections'] is not None:
+        # Split the total connection budget across the worker processes.
+        maxsize = max(1, db_config['max-connections'] // local_config['manager']['num-proc'])
+    minsize = min(db_config['pool-min-size'], maxsize)
+    return minsize, maxsize
+
+
 async def database_ctx(app: web.Application) -> AsyncIterator[None]:
-    app['dbpool'] = await create_engine(
-        host=app['local_config']['db']['addr'].host, port=app['local_config']['db']['addr'].port,
-        user=app['local_config']['db']['user'], password=app['local_config']['db']['password'],
-        dbname=app['local_config']['db']['name'],
-        echo=bool(app['local_config']['logging']['level'] == 'DEBUG'),
-        minsize=8, maxsize=256,
-        timeout=60, pool_recycle=120,
-        dialect=get_dialect(
-            json_serializer=functools.partial(json.dumps, cls=ExtendedJSONEncoder),
-        ),
-    )
+    db_config = app['local_config']['db']
+    pool_minsize, pool_maxsize = get_db_pool_size(app['local_config'])
+    if app['pidx'] == 0:
+        log.info('Database connection pool size per worker and endpoint: {}-{}',
+                 pool_minsize, pool_maxsize)
+
+    async def _create_engine(addr: HostPortPair) -> InstrumentedEngine:
+        engine = await create_engine(
+            host=addr.host, port=addr.port,
+            user=db_config['user'], password=db_config['password'],
+            dbname=db_config['name'],
+            echo=bool(app['local_config']['logging']['level'] == 'DEBUG'),
+            minsize=pool_minsize, maxsize=pool_maxsize,
+            timeout=60, pool_recycle=120,
+            slow_query_threshold=db_config['slow-query-threshold'],
+            dialect=get_dialect(
+                json_serializer=functools.partial(json.dumps, cls=ExtendedJSONEncoder),
+            ),
+        )
+        engine.acquire_listeners.append(record_db_acquire)
+        engine.query_listeners.append(record_db_query)
+        return engine
+
+    app['dbpool'] = await _create_engine(db_config['addr'])
+    replica_check_timer = None
+    if db_config['replica-addr'] is not None:
+        app['dbpool_replica'] = await _create_engine(db_config['replica-addr'])
+        app['dbpool_router'] = ReadReplicaRouter(
+            app['dbpool'], app['dbpool_replica'],
+            max_lag=db_config['replica-max-lag'],
+        )
+        await app['dbpool_router'].check_lag()
+
+        async def _check_replica_lag(interval: float) -> None:
+            await app['dbpool_router'].check_lag()
+
+        replica_check_timer = aiotools.create_timer(
+            _check_replica_lag, db_config['replica-check-interval'])
+    else:
+        app['dbpool_router'] = ReadReplicaRouter(app['dbpool'])
     _update_public_interface_objs(app)
     yield
+    if replica_check_timer is not None:
+        replica_check_timer.cancel()
+        await replica_check_timer
+        app['dbpool_replica'].close()
+        await app['dbpool_replica'].wait_closed()
     app['dbpool'].close()
     await app['dbpool'].wait_closed()
 
 
 async def event_dispatcher_ctx(app: web.Application) -> AsyncIterator[None]:
-    app['event_dispatcher'] = await EventDispatcher.new(app['local_config'], app['shared_config'])
+    app['event_dispatcher'] = await EventDispatcher.new(
+        app['local_config'], app['shared_config'],
+        stats_monitor=app.get('stats_monitor'),
+    )
     _update_public_interface_objs(app)
     yield
     await app['event_dispatcher'].close()
 
 
+async def auth_context_ctx(app: web.Application) -> AsyncIterator[None]:
+    mgr_config = app['local_config']['manager']
+    app['auth_context_cache'] = AuthContextCache(
+        ttl=mgr_config['auth-context-cache-ttl'],
+        maxsize=mgr_config['auth-context-cache-size'],
+    )
+    app['keypair_usage_buffer'] = KeypairUsageBuffer()
+    invalidation_handler = app['event_dispatcher'].subscribe(
+        'auth_context_invalidated', app, invalidate_auth_context)
+
+    async def _flush_keypair_usage(interval: float) -> None:
+        await app['keypair_usage_buffer'].flush(app['dbpool'])
+
+    flush_timer = aiotools.create_timer(
+        _flush_keypair_usage,
+        mgr_config['keypair-usage-flush-interval'],
+    )
+    yield
+    flush_timer.cancel()
+    await flush_timer
+    app['event_dispatcher'].unsubscribe('auth_context_invalidated', invalidation_handler)
+    await app['keypair_usage_buffer'].flush(app['dbpool'])
+
+
 async def idle_checker_ctx(app: web.Application) -> AsyncIterator[None]:
     app['idle_checkers'] = await create_idle_checkers(
         app['dbpool'], app['shared_config'], app['event_dispatcher'],
@@ -375,6 +475,13 @@ async def hook_plugin_ctx(app: web.Application) -> AsyncIterator[None]:
 
 
 async def agent_registry_ctx(app: web.Application) -> AsyncIterator[None]:
+    mgr_config = app['local_config']['manager']
+    session_route_cache = None
+    if mgr_config['session-route-cache-ttl'] > 0:
+        session_route_cache = SessionRoutingCache(ttl=mgr_config['session-route-cache-ttl'])
+    session_usage_buffer = None
+    if mgr_config['session-usage-flush-interval'] > 0:
+        session_usage_buffer = SessionUsageBuffer()
     app['registry'] = AgentRegistry(
         app['shared_config'],
         app['dbpool'],
@@ -384,10 +491,38 @@ async def agent_registry_ctx(app: web.Application) -> AsyncIterator[None]:
         app['event_dispatcher'],
         app['storage_manager'],
         app['hook_plugin_ctx'],
+        session_route_cache=session_route_cache,
+        session_usage_buffer=session_usage_buffer,
     )
     await app['registry'].init()
+    invalidation_handlers = [
+        (event_name, app['event_dispatcher'].subscribe(
+            event_name, app['registry'], invalidate_session_route))
+        for event_name in (
+            'kernel_terminating',
+            'kernel_terminated',
+            'session_started',  # also sent after restarts which may change the ports
+            'session_terminated',
+        )
+    ]
+    flush_timer = None
+    if session_usage_buffer is not None:
+
+        async def _flush_session_usage(interval: float) -> None:
+            await app['registry'].flush_session_usage()
+
+        flush_timer = aiotools.create_timer(
+            _flush_session_usage,
+            mgr_config['session-usage-flush-interval'],
+        )
     _update_public_interface_objs(app)
     yield
+    if flush_timer is not None:
+        flush_timer.cancel()
+        await flush_timer
+    for event_name, handler in invalidation_handlers:
+        app['event_dispatcher'].unsubscribe(event_name, handler)
+    await app['registry'].flush_session_usage()
     await app['registry'].shutdown()
 
 
@@ -398,6 +533,13 @@ async def sched_dispatcher_ctx(app: web.Application) -> AsyncIterator[None]:
     await sched_dispatcher.close()
 
 
+async def usage_rollup_ctx(app: web.Application) -> AsyncIterator[None]:
+    usage_rollup = await UsageRollup.new(
+        app['local_config'], app['shared_config'], app['event_dispatcher'], app['registry'])
+    yield
+    await usage_rollup.close()
+
+
 async def monitoring_ctx(app: web.Application) -> AsyncIterator[None]:
     ectx = ErrorPluginContext(app['shared_config'].etcd, app['local_config'])
     sctx = StatsPluginContext(app['shared_config'].etcd, app['local_config'])
@@ -406,7 +548,18 @@ async def monitoring_ctx(app: web.Application) -> AsyncIterator[None]:
     app['error_monitor'] = ectx
     app['stats_monitor'] = sctx
     _update_public_interface_objs(app)
+    report_tasks = [
+        asyncio.create_task(app['request_metrics'].report_loop(sctx)),
+    ]
+    if 'dbpool' in app:
+        report_tasks.append(asyncio.create_task(db_pool_report_loop(app['dbpool'], sctx)))
+    if 'dbpool_replica' in app:
+        report_tasks.append(asyncio.create_task(db_pool_report_loop(
+            app['dbpool_replica'], sctx, prefix='ai.backend.gateway.db.replica_pool')))
     yield
+    for task in report_tasks:
+        task.cancel()
+        await task
     await sctx.cleanup()
     await ectx.cleanup()
 
@@ -488,6 +641,7 @@ def build_root_app(
 ) -> web.Application:
     public_interface_objs.clear()
     app = web.Application(middlewares=[
+        metric_middleware,
         exception_middleware,
         api_middleware,
     ])
@@ -495,6 +649,9 @@ def build_root_app(
     loop = asyncio.get_running_loop()
     loop.set_exception_handler(global_exception_handler)
     app['local_config'] = local_config
+    app['request_metrics'] = RequestMetricsCollector(
+        slow_request_threshold=local_config['manager']['slow-request-threshold'],
+    )
     app['cors_opts'] = {
         '*': aiohttp_cors.ResourceOptions(
             allow_credentials=False,
@@ -518,13 +675,15 @@ def build_root_app(
             manager_status_ctx,
             redis_ctx,
             database_ctx,
+            monitoring_ctx,
             event_dispatcher_ctx,
+            auth_context_ctx,
             idle_checker_ctx,
             storage_manager_ctx,
             hook_plugin_ctx,
-            monitoring_ctx,
             agent_registry_ctx,
             sched_dispatcher_ctx,
+            usage_rollup_ctx,
             background_task_ctx,
         ]
     for cleanup_ctx in cleanup_contexts:
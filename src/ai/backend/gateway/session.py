@@ -4,9 +4,11 @@ REST-style session management APIs.
 
 import asyncio
 import base64
+import binascii
 from decimal import Decimal
 from datetime import datetime, timedelta
 import functools
+import hashlib
 from io import BytesIO
 import json
 import logging
@@ -15,7 +17,9 @@ from pathlib import PurePosixPath
 import secrets
 from typing import (
     Any,
+    AsyncIterator,
     Dict,
+    Final,
     Iterable,
     List,
     Mapping,
@@ -37,7 +41,6 @@ import aiotools
 from async_timeout import timeout
 from dateutil.parser import isoparse
 from dateutil.tz import tzutc
-import multidict
 import sqlalchemy as sa
 from sqlalchemy.sql.expression import true, null
 import trafaret as t
@@ -62,6 +65,8 @@ from ai.backend.common.plugin.monitor import GAUGE
 from .config import DEFAULT_CHUNK_SIZE
 from .defs import REDIS_STREAM_DB
 from .exceptions import (
+    FileOffsetMismatch,
+    FileTooLarge,
     InvalidAPIParameters,
     GenericNotFound,
     ImageNotFound,
@@ -1560,10 +1565,24 @@ async def shutdown_service(request: web.Request, params: Any) -> web.Response:
     return web.Response(status=204)
 
 
+# The limits of the multipart file transfer APIs, which keep whole files in memory.
+# Larger files should be transferred via the "/session/{name}/file" API.
+MULTIPART_MAX_FILE_COUNT: Final = 20
+MULTIPART_MAX_FILE_SIZE: Final = 1048576  # 1 MiB
+MULTIPART_MAX_BODY_SIZE: Final = MULTIPART_MAX_FILE_COUNT * MULTIPART_MAX_FILE_SIZE + 65536
+
+
 @server_status_required(READ_ALLOWED)
 @auth_required
 async def upload_files(request: web.Request) -> web.Response:
-    loop = asyncio.get_event_loop()
+    """
+    Uploads small files in a multipart body.  Each file is relayed to the agent
+    as soon as it is read, so only a single file is kept in memory at a time.
+    """
+    if request.content_length is not None and request.content_length > MULTIPART_MAX_BODY_SIZE:
+        raise FileTooLarge(
+            'Use the /session/{name}/file API to upload large files.',
+            max_size=MULTIPART_MAX_BODY_SIZE, actual_size=request.content_length)
     reader = await request.multipart()
     registry = request.app['registry']
     session_name = request.match_info['session_name']
@@ -1573,30 +1592,27 @@ async def upload_files(request: web.Request) -> web.Response:
     try:
         await registry.increment_session_usage(session_name, owner_access_key)
         file_count = 0
-        upload_tasks = []
         async for file in aiotools.aiter(reader.next, None):
-            if file_count == 20:
+            if file_count == MULTIPART_MAX_FILE_COUNT:
                 raise InvalidAPIParameters('Too many files')
             file_count += 1
             # This API handles only small files, so let's read it at once.
             chunks = []
             recv_size = 0
             while True:
-                chunk = await file.read_chunk(size=1048576)
+                chunk = await file.read_chunk(size=MULTIPART_MAX_FILE_SIZE)
                 if not chunk:
                     break
                 chunk_size = len(chunk)
-                if recv_size + chunk_size >= 1048576:
-                    raise InvalidAPIParameters('Too large file')
+                if recv_size + chunk_size >= MULTIPART_MAX_FILE_SIZE:
+                    raise FileTooLarge(
+                        'Use the /session/{name}/file API to upload large files.',
+                        max_size=MULTIPART_MAX_FILE_SIZE, actual_size=recv_size + chunk_size)
                 chunks.append(chunk)
                 recv_size += chunk_size
             data = file.decode(b''.join(chunks))
             log.debug('received file: {0} ({1:,} bytes)', file.filename, recv_size)
-            t = loop.create_task(
-                registry.upload_file(session_name, owner_access_key,
-                                     file.filename, data))
-            upload_tasks.append(t)
-        await asyncio.gather(*upload_tasks)
+            await registry.upload_file(session_name, owner_access_key, file.filename, data)
     except BackendError:
         log.exception('UPLOAD_FILES: exception')
         raise
@@ -1609,7 +1625,13 @@ async def upload_files(request: web.Request) -> web.Response:
     t.Dict({
         tx.MultiKey('files'): t.List(t.String),
     }))
-async def download_files(request: web.Request, params: Any) -> web.Response:
+async def download_files(request: web.Request, params: Any) -> web.StreamResponse:
+    """
+    Downloads small files as the parts of a multipart response.  The files are
+    fetched from the agent one by one and each part is sent as soon as it is
+    fetched, so only a single file is kept in memory at a time.
+    Large files should be downloaded via the "/session/{name}/file" API.
+    """
     registry = request.app['registry']
     session_name = request.match_info['session_name']
     requester_access_key, owner_access_key = await get_access_key_scopes(request)
@@ -1617,31 +1639,53 @@ async def download_files(request: web.Request, params: Any) -> web.Response:
     log.info('DOWNLOAD_FILE (ak:{0}/{1}, s:{2}, path:{3!r})',
              requester_access_key, owner_access_key, session_name,
              files[0])
-    try:
-        assert len(files) <= 5, 'Too many files'
-        await registry.increment_session_usage(session_name, owner_access_key)
-        # TODO: Read all download file contents. Need to fix by using chuncking, etc.
-        results = await asyncio.gather(*map(
-            functools.partial(registry.download_file, session_name, owner_access_key),
-            files))
-        log.debug('file(s) inside container retrieved')
-    except asyncio.CancelledError:
-        raise
-    except BackendError:
-        log.exception('DOWNLOAD_FILE: exception')
-        raise
-    except (ValueError, FileNotFoundError):
-        raise InvalidAPIParameters('The file is not found.')
-    except Exception:
-        await request.app['error_monitor'].capture_exception(context={'user': request['user']['uuid']})
-        log.exception('DOWNLOAD_FILE: unexpected error!')
-        raise InternalServerError
+    if len(files) > 5:
+        raise InvalidAPIParameters('Too many files')
+    await registry.increment_session_usage(session_name, owner_access_key)
 
-    with aiohttp.MultipartWriter('mixed') as mpwriter:
-        headers = multidict.MultiDict({'Content-Encoding': 'identity'})
-        for tarbytes in results:
-            mpwriter.append(tarbytes, headers)
-        return web.Response(body=mpwriter, status=200)
+    async def _download(path: str) -> bytes:
+        try:
+            return await registry.download_file(session_name, owner_access_key, path)
+        except asyncio.CancelledError:
+            raise
+        except BackendError:
+            log.exception('DOWNLOAD_FILE: exception')
+            raise
+        except (ValueError, FileNotFoundError):
+            raise InvalidAPIParameters('The file is not found.')
+        except Exception:
+            await request.app['error_monitor'].capture_exception(
+                context={'user': request['user']['uuid']})
+            log.exception('DOWNLOAD_FILE: unexpected error!')
+            raise InternalServerError
+
+    boundary = uuid.uuid4().hex
+    response = web.StreamResponse(status=200)
+    response.headers[hdrs.CONTENT_TYPE] = f'multipart/mixed; boundary="{boundary}"'
+    for path in files:
+        try:
+            tarbytes = await _download(path)
+        except web.HTTPException:
+            if not response.prepared:
+                raise
+            # The status is already sent, so abort the connection
+            # instead of ending the response without the remaining parts.
+            if request.transport is not None:
+                request.transport.close()
+            return response
+        if not response.prepared:
+            await response.prepare(request)
+        await response.write(
+            f'--{boundary}\r\n'
+            f'Content-Type: application/octet-stream\r\n'
+            f'Content-Encoding: identity\r\n'
+            f'Content-Length: {len(tarbytes)}\r\n'
+            f'\r\n'.encode('ascii')
+            + tarbytes + b'\r\n')
+    await response.write(f'--{boundary}--\r\n'.encode('ascii'))
+    log.debug('file(s) inside container retrieved')
+    await response.write_eof()
+    return response
 
 
 @auth_required
@@ -1677,6 +1721,222 @@ async def download_single(request: web.Request, params: Any) -> web.Response:
     return web.Response(body=result, status=200)
 
 
+def _parse_sha256_digest(value: Optional[str]) -> Optional[bytes]:
+    """
+    Extracts the SHA-256 checksum from the value of an RFC 3230 "Digest" header.
+    """
+    if value is None:
+        return None
+    for item in value.split(','):
+        algorithm, _, encoded = item.strip().partition('=')
+        if algorithm.lower() == 'sha-256':
+            try:
+                return base64.b64decode(encoded, validate=True)
+            except binascii.Error:
+                raise InvalidAPIParameters('Malformed Digest header')
+    return None
+
+
+async def _read_body_chunks(
+    content: aiohttp.StreamReader,
+    chunk_size: int,
+    hasher: Any,
+) -> AsyncIterator[bytes]:
+    buf = bytearray()
+    while True:
+        data = await content.read(chunk_size - len(buf))
+        if not data:
+            break
+        buf += data
+        if len(buf) >= chunk_size:
+            chunk = bytes(buf)
+            buf.clear()
+            hasher.update(chunk)
+            yield chunk
+    if buf:
+        chunk = bytes(buf)
+        hasher.update(chunk)
+        yield chunk
+
+
+_file_path_iv = t.Dict({
+    t.Key('path'): t.String,
+})
+
+
+@server_status_required(READ_ALLOWED)
+@auth_required
+@check_api_params(_file_path_iv)
+async def get_file_info(request: web.Request, params: Any) -> web.Response:
+    """
+    Returns the current size of a file in the session as the "Upload-Offset"
+    and "Content-Length" headers, to resume interrupted uploads and downloads.
+    """
+    registry = request.app['registry']
+    session_name = request.match_info['session_name']
+    requester_access_key, owner_access_key = await get_access_key_scopes(request)
+    log.info('GET_FILE_INFO (ak:{0}/{1}, s:{2}, path:{3!r})',
+             requester_access_key, owner_access_key, session_name, params['path'])
+    try:
+        stat = await registry.stat_file(session_name, owner_access_key, params['path'])
+    except BackendError:
+        log.exception('GET_FILE_INFO: exception')
+        raise
+    except (ValueError, FileNotFoundError):
+        raise InvalidAPIParameters('The file is not found.')
+    return web.Response(status=200, headers={
+        'Upload-Offset': str(stat['size']),
+        hdrs.CONTENT_LENGTH: str(stat['size']),
+        hdrs.ACCEPT_RANGES: 'bytes',
+    })
+
+
+@server_status_required(READ_ALLOWED)
+@auth_required
+async def upload_file_range(request: web.Request) -> web.Response:
+    """
+    Writes the request body to a file in the session from the offset given as
+    the "Upload-Offset" header, relaying it to the agent in fixed-size chunks
+    so that the memory usage does not depend on the file size.
+
+    An offset of zero starts a new upload, and any other offset must match
+    the current size of the file to continue an interrupted upload.
+    If the "Digest" header has the SHA-256 checksum of the request body,
+    it is verified after writing.  Upon mismatch, the written data is discarded
+    by truncating the file back to the offset, and the client should resend
+    the body from the same offset.
+    """
+    registry = request.app['registry']
+    session_name = request.match_info['session_name']
+    requester_access_key, owner_access_key = await get_access_key_scopes(request)
+    try:
+        path = _file_path_iv.check({'path': request.query.get('path')})['path']
+        offset = int(request.headers['Upload-Offset'])
+        assert offset >= 0
+    except t.DataError as e:
+        raise InvalidAPIParameters('Input validation error', extra_data=e.as_dict())
+    except (KeyError, ValueError, AssertionError):
+        raise InvalidAPIParameters('Missing or invalid Upload-Offset header')
+    expected_digest = _parse_sha256_digest(request.headers.get('Digest'))
+    log.info('UPLOAD_FILE_RANGE (ak:{0}/{1}, s:{2}, path:{3!r}, offset:{4})',
+             requester_access_key, owner_access_key, session_name, path, offset)
+    chunk_size = int(request.app['local_config']['manager']['file-transfer-chunk-size'])
+    hasher = hashlib.sha256()
+    try:
+        await registry.increment_session_usage(session_name, owner_access_key)
+        if offset > 0:
+            stat = await registry.stat_file(session_name, owner_access_key, path)
+            if stat['size'] != offset:
+                raise FileOffsetMismatch(headers={'Upload-Offset': str(stat['size'])})
+        else:
+            # Start a new upload with an empty file, even if the body is empty.
+            await registry.truncate_file(session_name, owner_access_key, path, 0)
+        new_offset = await registry.upload_file_chunks(
+            session_name, owner_access_key, path, offset,
+            _read_body_chunks(request.content, chunk_size, hasher))
+    except asyncio.CancelledError:
+        raise
+    except BackendError:
+        log.exception('UPLOAD_FILE_RANGE: exception')
+        raise
+    except (ValueError, FileNotFoundError):
+        raise InvalidAPIParameters('The file is not found.')
+    except Exception:
+        await request.app['error_monitor'].capture_exception(context={'user': request['user']['uuid']})
+        log.exception('UPLOAD_FILE_RANGE: unexpected error!')
+        raise InternalServerError
+    if expected_digest is not None and hasher.digest() != expected_digest:
+        await registry.truncate_file(session_name, owner_access_key, path, offset)
+        raise InvalidAPIParameters('Checksum mismatch', headers={'Upload-Offset': str(offset)})
+    return web.Response(status=204, headers={'Upload-Offset': str(new_offset)})
+
+
+@server_status_required(READ_ALLOWED)
+@auth_required
+@check_api_params(_file_path_iv)
+async def download_file_range(request: web.Request, params: Any) -> web.StreamResponse:
+    """
+    Streams a file (or the byte range given as the "Range" header) in the session,
+    relaying it from the agent in fixed-size chunks so that the memory usage does
+    not depend on the file size.
+
+    The responses not larger than a single chunk have the SHA-256 checksum
+    of the body as the "Digest" header.
+    """
+    registry = request.app['registry']
+    session_name = request.match_info['session_name']
+    requester_access_key, owner_access_key = await get_access_key_scopes(request)
+    path = params['path']
+    log.info('DOWNLOAD_FILE_RANGE (ak:{0}/{1}, s:{2}, path:{3!r}, range:{4})',
+             requester_access_key, owner_access_key, session_name, path,
+             request.headers.get(hdrs.RANGE))
+    try:
+        byte_range = request.http_range
+    except ValueError:
+        raise InvalidAPIParameters('Malformed Range header')
+    chunk_size = int(request.app['local_config']['manager']['file-transfer-chunk-size'])
+    try:
+        await registry.increment_session_usage(session_name, owner_access_key)
+        size = (await registry.stat_file(session_name, owner_access_key, path))['size']
+    except BackendError:
+        log.exception('DOWNLOAD_FILE_RANGE: exception')
+        raise
+    except (ValueError, FileNotFoundError):
+        raise InvalidAPIParameters('The file is not found.')
+
+    start = 0 if byte_range.start is None else byte_range.start
+    if start < 0:  # suffix range (e.g., "bytes=-500")
+        start = max(0, size + start)
+    stop = size if byte_range.stop is None else min(byte_range.stop, size)
+    partial = hdrs.RANGE in request.headers
+    if partial and start >= stop:
+        raise web.HTTPRequestRangeNotSatisfiable(headers={
+            hdrs.CONTENT_RANGE: f'bytes */{size}',
+        })
+    length = stop - start
+
+    response = web.StreamResponse(status=206 if partial else 200)
+    response.headers[hdrs.CONTENT_TYPE] = 'application/octet-stream'
+    response.headers[hdrs.ACCEPT_RANGES] = 'bytes'
+    async with aiotools.aclosing(registry.download_file_chunks(
+        session_name, owner_access_key, path, start, length,
+        chunk_size=chunk_size,
+    )) as chunks:
+        if length <= chunk_size:
+            data = b''.join([chunk async for chunk in chunks])
+            if len(data) < length:
+                # The file is truncated while reading, so it ends at the last byte read.
+                stop = size = start + len(data)
+                if partial and not data:
+                    raise web.HTTPRequestRangeNotSatisfiable(
+                        headers={hdrs.CONTENT_RANGE: f'bytes */{size}'})
+            if partial:
+                response.headers[hdrs.CONTENT_RANGE] = f'bytes {start}-{stop - 1}/{size}'
+            response.headers['Digest'] = \
+                'sha-256=' + base64.b64encode(hashlib.sha256(data).digest()).decode('ascii')
+            response.content_length = len(data)
+            await response.prepare(request)
+            await response.write(data)
+        else:
+            if partial:
+                response.headers[hdrs.CONTENT_RANGE] = f'bytes {start}-{stop - 1}/{size}'
+            response.content_length = length
+            await response.prepare(request)
+            sent = 0
+            async for chunk in chunks:
+                await response.write(chunk)
+                sent += len(chunk)
+            if sent < length:
+                # The file is truncated while reading.  Abort the connection so that
+                # the client does not take the short body as a complete one.
+                log.warning('DOWNLOAD_FILE_RANGE: {0!r} is truncated while reading', path)
+                if request.transport is not None:
+                    request.transport.close()
+                return response
+    await response.write_eof()
+    return response
+
+
 @atomic
 @server_status_required(READ_ALLOWED)
 @auth_required
@@ -1891,4 +2151,8 @@ def create_app(default_cors_options: CORSOptions) -> Tuple[web.Application, Iter
     cors.add(app.router.add_route('GET',  '/{session_name}/download', download_files))
     cors.add(app.router.add_route('GET',  '/{session_name}/download_single', download_single))
     cors.add(app.router.add_route('GET',  '/{session_name}/files', list_files))
+    file_resource = cors.add(app.router.add_resource(r'/{session_name}/file'))
+    cors.add(file_resource.add_route('HEAD',  get_file_info))
+    cors.add(file_resource.add_route('GET',   download_file_range))
+    cors.add(file_resource.add_route('PATCH', upload_file_range))
     return app, []
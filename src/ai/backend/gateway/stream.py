@@ -9,17 +9,30 @@ import asyncio
 import base64
 from collections import defaultdict
 from datetime import timedelta
+import functools
+import hashlib
+import hmac
 import json
 import logging
+import os
+import random
 import secrets
+import time
 from typing import (
     Any,
     AsyncIterator,
+    Awaitable,
+    Callable,
     DefaultDict,
+    Dict,
+    Final,
     Iterable,
     List,
     Mapping,
     MutableMapping,
+    Optional,
+    Sequence,
+    Set,
     TYPE_CHECKING,
     Tuple,
     Union,
@@ -29,14 +42,16 @@ import uuid
 import weakref
 
 import aiohttp
-from aiohttp import web
+from aiohttp import WSCloseCode, web
 import aiohttp_cors
 import aioredis
-from aiotools import apartial, adefer
+from aiotools import aclosing, adefer
+import jwt
 import trafaret as t
+from yarl import URL
 import zmq, zmq.asyncio
 
-from ai.backend.common import validators as tx
+from ai.backend.common import redis, validators as tx
 from ai.backend.common.logging import BraceStyleAdapter
 from ai.backend.common.types import (
     AccessKey,
@@ -45,29 +60,229 @@ from ai.backend.common.types import (
 )
 from ai.backend.gateway.config import SharedConfig
 
-from ai.backend.manager.idle import AppStreamingStatus
+from ai.backend.manager.idle import AppStreamingStatus, BaseIdleChecker
 
-from .auth import auth_required
+from .auth import auth_required, superadmin_required
 from .exceptions import (
     AppNotFound,
+    AuthorizationFailed,
     BackendError,
+    GenericNotFound,
     InternalServerError,
     InvalidAPIParameters,
+    ServiceUnavailable,
     SessionNotFound,
     TooManySessionsMatched,
 )
 from .manager import READ_ALLOWED, server_status_required
+from .metric import StreamMetricsCollector
 from .types import CORSOptions, WebMiddleware
-from .utils import check_api_params, call_non_bursty
-from .wsproxy import TCPProxy
+from .utils import check_api_params
+from .wsproxy import ProxyMemoryBudget, ServiceProxy, TCPProxy
 from ..manager.defs import DEFAULT_ROLE
 from ..manager.models import kernels
+from ..manager.registry import SessionRoute
 if TYPE_CHECKING:
     from .config import LocalConfig
     from ..manager.registry import AgentRegistry
 
 log = BraceStyleAdapter(logging.getLogger('ai.backend.gateway.stream'))
 
+# The binary PTY streaming protocol is used when the client requests it as the
+# websocket subprotocol.  Each binary message is prefixed with a one-byte type,
+# while the clients may still send the control messages as JSON text messages.
+PTY_BINARY_PROTOCOL: Final = 'backendai.pty.binary'
+PTY_FRAME_DATA: Final = 0x00  # stdin (client-to-server) or stdout (server-to-client)
+PTY_FRAME_CONTROL: Final = 0x01  # JSON-encoded control message (client-to-server)
+PTY_COALESCE_WINDOW: Final = 0.005  # seconds
+PTY_COALESCE_MAX_SIZE: Final = 64 * 1024
+PTY_SUBSCRIBER_QUEUE_SIZE: Final = 4096  # frames
+
+
+class KernelStreamHub:
+    """
+    Shares a single pair of the stdin (PUB) and stdout (SUB) ZeroMQ sockets
+    of a kernel among all PTY websocket connections attached to it.
+
+    The outputs are fanned out to the queues of the attached connections, and
+    the inputs from multiple connections are serialized.  The hub is
+    reference-counted by :func:`acquire_stream_hub` / :func:`release_stream_hub`
+    and closed when the last connection is detached or the kernel terminates.
+    """
+
+    subscribers: Set[asyncio.Queue]
+
+    def __init__(
+        self,
+        zctx: zmq.asyncio.Context,
+        kernel_id: KernelId,
+        route: SessionRoute,
+        get_route: Callable[[], Awaitable[SessionRoute]],
+    ) -> None:
+        self.zctx = zctx
+        self.kernel_id = kernel_id
+        self.get_route = get_route
+        self.refcount = 0
+        self.subscribers = set()
+        self.closed = False
+        self._restarting = False
+        self._stdin_lock = asyncio.Lock()
+        self._connect(route)
+        self._recv_task = asyncio.create_task(self._recv_stdout())
+
+    def _connect(self, route: SessionRoute) -> None:
+        if route.kernel_host is None:
+            kernel_host = urlparse(route.agent_addr).hostname
+        else:
+            kernel_host = route.kernel_host
+        stdin_addr = f'tcp://{kernel_host}:{route.stdin_port}'
+        log.debug('stream_hub({0}): stdin: {1}', self.kernel_id, stdin_addr)
+        self.stdin_sock = self.zctx.socket(zmq.PUB)
+        self.stdin_sock.connect(stdin_addr)
+        self.stdin_sock.setsockopt(zmq.LINGER, 100)
+        stdout_addr = f'tcp://{kernel_host}:{route.stdout_port}'
+        log.debug('stream_hub({0}): stdout: {1}', self.kernel_id, stdout_addr)
+        self.stdout_sock = self.zctx.socket(zmq.SUB)
+        self.stdout_sock.connect(stdout_addr)
+        self.stdout_sock.setsockopt(zmq.LINGER, 100)
+        self.stdout_sock.subscribe(b'')
+
+    async def reconnect(self) -> None:
+        """
+        Re-creates the sockets with the latest ports of the kernel,
+        which may have changed after restarts.
+        """
+        self._recv_task.cancel()
+        await asyncio.gather(self._recv_task, return_exceptions=True)
+        self.stdin_sock.close()
+        self.stdout_sock.close()
+        route = await asyncio.shield(self.get_route())
+        self._connect(route)
+        self._recv_task = asyncio.create_task(self._recv_stdout())
+        log.debug('stream_hub({0}): zmq stream reset', self.kernel_id)
+
+    async def _recv_stdout(self) -> None:
+        try:
+            while True:
+                data = await self.stdout_sock.recv_multipart()
+                for queue in list(self.subscribers):
+                    try:
+                        queue.put_nowait(data[0])
+                    except asyncio.QueueFull:
+                        # Disconnect the subscribers which cannot keep up with
+                        # the outputs instead of buffering them indefinitely.
+                        log.warning('stream_hub({0}): dropping a slow subscriber',
+                                    self.kernel_id)
+                        self.detach(queue)
+        except asyncio.CancelledError:
+            # The sockets are being closed or reconnected.
+            pass
+        except Exception:
+            log.exception('stream_hub({0}): unexpected error', self.kernel_id)
+            for queue in list(self.subscribers):
+                self.detach(queue)
+
+    def attach(self) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=PTY_SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers.add(queue)
+        return queue
+
+    def detach(self, queue: asyncio.Queue) -> None:
+        """
+        Stops delivering the outputs to the given queue
+        and lets its consumer know it by putting None.
+        """
+        if queue not in self.subscribers:
+            return
+        self.subscribers.discard(queue)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    async def send_stdin(self, raw_data: bytes) -> None:
+        async with self._stdin_lock:
+            try:
+                await self.stdin_sock.send_multipart([raw_data])
+            except (RuntimeError, zmq.error.ZMQError):
+                # when the stdin socket is closed, re-initiate the connection.
+                await self.reconnect()
+                await self.stdin_sock.send_multipart([raw_data])
+
+    async def restart(self, restart_session: Callable[[], Awaitable[Any]]) -> None:
+        if self._restarting:
+            log.warning('stream_hub({0}): duplicate kernel restart request; ignoring it.',
+                        self.kernel_id)
+            return
+        self._restarting = True
+        try:
+            async with self._stdin_lock:
+                await asyncio.shield(restart_session())
+                await self.reconnect()
+        finally:
+            self._restarting = False
+
+    async def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self._recv_task.cancel()
+        await asyncio.gather(self._recv_task, return_exceptions=True)
+        self.stdin_sock.close()
+        self.stdout_sock.close()
+        for queue in list(self.subscribers):
+            self.detach(queue)
+
+
+def acquire_stream_hub(
+    app: web.Application,
+    route: SessionRoute,
+    get_route: Callable[[], Awaitable[SessionRoute]],
+) -> KernelStreamHub:
+    hub = app['stream_hubs'].get(route.kernel_id)
+    if hub is None or hub.closed:
+        hub = KernelStreamHub(app['zctx'], route.kernel_id, route, get_route)
+        app['stream_hubs'][route.kernel_id] = hub
+    hub.refcount += 1
+    return hub
+
+
+async def release_stream_hub(app: web.Application, hub: KernelStreamHub) -> None:
+    hub.refcount -= 1
+    if hub.refcount <= 0:
+        if app['stream_hubs'].get(hub.kernel_id) is hub:
+            del app['stream_hubs'][hub.kernel_id]
+        await hub.close()
+
+
+def check_stream_draining(app: web.Application) -> None:
+    '''
+    Rejects new streams while this API server process is draining the
+    existing streams for shutdown.
+    '''
+    if app['stream_draining']:
+        spread = app['local_config']['manager']['stream-reconnect-spread']
+        raise ServiceUnavailable(
+            'The API server is shutting down.',
+            headers={'Retry-After': str(random.randint(1, max(1, int(spread))))},
+        )
+
+
+def register_stream_websocket(app: web.Application, ws: web.WebSocketResponse, defer) -> None:
+    app['stream_websockets'].add(ws)
+    defer(lambda: app['stream_websockets'].discard(ws))
+
+
+async def close_for_restart(ws: web.WebSocketResponse, reconnect_spread: float) -> None:
+    '''
+    Closes the websocket with the "service restart" close code, letting the
+    client reconnect after a randomized delay to avoid reconnection storms.
+    '''
+    reason = json.dumps({
+        'type': 'server-restarting',
+        'retry_after': round(random.uniform(0, reconnect_spread), 1),
+    })
+    await ws.close(code=WSCloseCode.SERVICE_RESTART, message=reason.encode('utf8'))
+
 
 @server_status_required(READ_ALLOWED)
 @auth_required
@@ -78,105 +293,80 @@ async def stream_pty(defer, request: web.Request) -> web.StreamResponse:
     registry = app['registry']
     session_name = request.match_info['session_name']
     access_key = request['keypair']['access_key']
-    extra_fields = (kernels.c.stdin_port, kernels.c.stdout_port)
     api_version = request['api_version']
+    check_stream_draining(app)
     try:
         compute_session = await asyncio.shield(
-            registry.get_session(session_name, access_key, field=extra_fields)
+            registry.get_session_route(session_name, access_key)
         )
     except SessionNotFound:
         raise
     log.info('STREAM_PTY(ak:{0}, s:{1})', access_key, session_name)
-    stream_key = compute_session['id']
+    stream_key = compute_session.kernel_id
 
     await asyncio.shield(registry.increment_session_usage(session_name, access_key))
-    ws = web.WebSocketResponse(max_msg_size=local_config['manager']['max-wsmsg-size'])
+    ws = web.WebSocketResponse(
+        protocols=(PTY_BINARY_PROTOCOL, ),
+        max_msg_size=local_config['manager']['max-wsmsg-size'],
+    )
     await ws.prepare(request)
+    register_stream_websocket(app, ws, defer)
 
     myself = asyncio.current_task()
     app['stream_pty_handlers'][stream_key].add(myself)
     defer(lambda: app['stream_pty_handlers'][stream_key].discard(myself))
 
-    async def connect_streams(compute_session) -> Tuple[zmq.asyncio.Socket, zmq.asyncio.Socket]:
-        # TODO: refactor as custom row/table method
-        if compute_session.kernel_host is None:
-            kernel_host = urlparse(compute_session.agent_addr).hostname
-        else:
-            kernel_host = compute_session.kernel_host
-        stdin_addr = f'tcp://{kernel_host}:{compute_session.stdin_port}'
-        log.debug('stream_pty({0}): stdin: {1}', stream_key, stdin_addr)
-        stdin_sock = await app['zctx'].socket(zmq.PUB)
-        stdin_sock.connect(stdin_addr)
-        stdin_sock.setsockopt(zmq.LINGER, 100)
-        stdout_addr = f'tcp://{kernel_host}:{compute_session.stdout_port}'
-        log.debug('stream_pty({0}): stdout: {1}', stream_key, stdout_addr)
-        stdout_sock = await app['zctx'].socket(zmq.SUB)
-        stdout_sock.connect(stdout_addr)
-        stdout_sock.setsockopt(zmq.LINGER, 100)
-        stdout_sock.subscribe(b'')
-        return stdin_sock, stdout_sock
-
-    # Wrap sockets in a list so that below coroutines can share reference changes.
-    socks = list(await connect_streams(compute_session))
-    app['stream_stdin_socks'][stream_key].add(socks[0])
-    defer(lambda: app['stream_stdin_socks'][stream_key].discard(socks[0]))
-    stream_sync = asyncio.Event()
+    async def get_latest_route() -> SessionRoute:
+        # The stdin/stdout ports may have changed after restarts.
+        if registry.session_route_cache is not None:
+            registry.session_route_cache.invalidate_session(compute_session.session_id)
+        return await registry.get_session_route(session_name, access_key)
+
+    hub = acquire_stream_hub(app, compute_session, get_latest_route)
+    output_queue = hub.attach()
+    conn_stats = app['stream_metrics'].open('pty', compute_session.session_id, access_key)
+    conn_stats.queue_depth = output_queue.qsize
+    defer(lambda: app['stream_metrics'].close(conn_stats))
+    binary_protocol = (ws.ws_protocol == PTY_BINARY_PROTOCOL)
+
+    async def handle_control(data: Mapping[str, Any]) -> None:
+        await asyncio.shield(
+            registry.increment_session_usage(session_name, access_key))
+        run_id = secrets.token_hex(8)
+        if data['type'] == 'resize':
+            code = f"%resize {data['rows']} {data['cols']}"
+            await registry.execute(
+                session_name, access_key,
+                api_version, run_id, 'query', code, {},
+                flush_timeout=None)
+        elif data['type'] == 'ping':
+            await registry.execute(
+                session_name, access_key,
+                api_version, run_id, 'query', '%ping', {},
+                flush_timeout=None)
+        elif data['type'] == 'restart':
+            # Re-create the zmq sockets with changed stdin/stdout ports.
+            log.debug('stream_stdin: restart requested')
+            await hub.restart(lambda: registry.restart_session(session_name, access_key))
 
     async def stream_stdin():
-        nonlocal socks
         try:
             async for msg in ws:
+                if msg.type in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                    conn_stats.record_in(len(msg.data))
                 if msg.type == aiohttp.WSMsgType.TEXT:
                     data = json.loads(msg.data)
                     if data['type'] == 'stdin':
-                        raw_data = base64.b64decode(data['chars'].encode('ascii'))
-                        try:
-                            await socks[0].send_mlutipart([raw_data])
-                        except (RuntimeError, zmq.error.ZMQError):
-                            # when socks[0] is closed, re-initiate the connection.
-                            app['stream_stdin_socks'][stream_key].discard(socks[0])
-                            socks[1].close()
-                            kernel = await asyncio.shield(
-                                registry.get_session(session_name, access_key, field=extra_fields)
-                            )
-                            stdin_sock, stdout_sock = await connect_streams(kernel)
-                            socks[0] = stdin_sock
-                            socks[1] = stdout_sock
-                            app['stream_stdin_socks'][stream_key].add(socks[0])
-                            socks[0].write([raw_data])
-                            log.debug('stream_stdin({0}): zmq stream reset',
-                                      stream_key)
-                            stream_sync.set()
-                            continue
+                        await hub.send_stdin(base64.b64decode(data['chars'].encode('ascii')))
                     else:
-                        await asyncio.shield(
-                            registry.increment_session_usage(session_name, access_key))
-                        run_id = secrets.token_hex(8)
-                        if data['type'] == 'resize':
-                            code = f"%resize {data['rows']} {data['cols']}"
-                            await registry.execute(
-                                session_name, access_key,
-                                api_version, run_id, 'query', code, {},
-                                flush_timeout=None)
-                        elif data['type'] == 'ping':
-                            await registry.execute(
-                                session_name, access_key,
-                                api_version, run_id, 'query', '%ping', {},
-                                flush_timeout=None)
-                        elif data['type'] == 'restart':
-                            # Close existing zmq sockets and let stream
-                            # handlers get a new one with changed stdin/stdout
-                            # ports.
-                            log.debug('stream_stdin: restart requested')
-                            if not socks[0].closed:
-                                await asyncio.shield(
-                                    registry.restart_session(session_name, access_key))
-                                socks[0].close()
-                            else:
-                                log.warning('stream_stdin({0}): '
-                                            'duplicate kernel restart request; '
-                                            'ignoring it.',
-                                            stream_key)
+                        await handle_control(data)
+                elif msg.type == aiohttp.WSMsgType.BINARY:
+                    if not msg.data:
+                        continue
+                    if msg.data[0] == PTY_FRAME_DATA:
+                        await hub.send_stdin(msg.data[1:])
+                    elif msg.data[0] == PTY_FRAME_CONTROL:
+                        await handle_control(json.loads(msg.data[1:]))
                 elif msg.type == aiohttp.WSMsgType.ERROR:
                     log.warning('stream_stdin({0}): connection closed ({1})',
                                 stream_key, ws.exception())
@@ -188,31 +378,39 @@ async def stream_pty(defer, request: web.Request) -> web.StreamResponse:
             log.exception('stream_stdin({0}): unexpected error', stream_key)
         finally:
             log.debug('stream_stdin({0}): terminated', stream_key)
-            if not socks[0].closed:
-                socks[0].close()
 
     async def stream_stdout():
-        nonlocal socks
         log.debug('stream_stdout({0}): started', stream_key)
         try:
             while True:
-                try:
-                    data = await socks[1].recv_multipart()
-                except (asyncio.CancelledError, zmq.error.ZMQError):
-                    if socks[0] not in app['stream_stdin_socks']:
-                        # we are terminating
-                        return
-                    # connection is closed, so wait until stream_stdin() recovers it.
-                    await stream_sync.wait()
-                    stream_sync.clear()
-                    log.debug('stream_stdout({0}): zmq stream reset', stream_key)
-                    continue
+                data = await output_queue.get()
+                if data is None:
+                    # the hub is closed or we could not keep up with the outputs.
+                    break
+                buf = bytearray(bytes([PTY_FRAME_DATA]) if binary_protocol else b'')
+                buf += data
+                # Coalesce the outputs arriving within a short time window
+                # to reduce the number of websocket messages for bursty outputs.
+                await asyncio.sleep(PTY_COALESCE_WINDOW)
+                while len(buf) < PTY_COALESCE_MAX_SIZE and not output_queue.empty():
+                    data = output_queue.get_nowait()
+                    if data is None:
+                        output_queue.put_nowait(None)
+                        break
+                    buf += data
                 if ws.closed:
                     break
-                await ws.send_str(json.dumps({
-                    'type': 'out',
-                    'data': base64.b64encode(data[0]).decode('ascii'),
-                }, ensure_ascii=False))
+                sent_at = time.perf_counter()
+                if binary_protocol:
+                    await ws.send_bytes(buf)
+                    conn_stats.record_out(len(buf), time.perf_counter() - sent_at)
+                else:
+                    msg = json.dumps({
+                        'type': 'out',
+                        'data': base64.b64encode(buf).decode('ascii'),
+                    }, ensure_ascii=False)
+                    await ws.send_str(msg)
+                    conn_stats.record_out(len(msg), time.perf_counter() - sent_at)
         except asyncio.CancelledError:
             pass
         except:
@@ -220,7 +418,8 @@ async def stream_pty(defer, request: web.Request) -> web.StreamResponse:
             log.exception('stream_stdout({0}): unexpected error', stream_key)
         finally:
             log.debug('stream_stdout({0}): terminated', stream_key)
-            socks[1].close()
+            if not ws.closed:
+                await ws.close()
 
     # According to aiohttp docs, reading ws must be done inside this task.
     # We execute the stdout handler as another task.
@@ -233,6 +432,8 @@ async def stream_pty(defer, request: web.Request) -> web.StreamResponse:
     finally:
         stdout_task.cancel()
         await stdout_task
+        hub.detach(output_queue)
+        await asyncio.shield(release_stream_hub(app, hub))
     return ws
 
 
@@ -242,6 +443,10 @@ async def stream_pty(defer, request: web.Request) -> web.StreamResponse:
 async def stream_execute(defer, request: web.Request) -> web.StreamResponse:
     '''
     WebSocket-version of gateway.kernel.execute().
+
+    The first message must be a JSON object with the execution parameters.
+    The console outputs are pushed as soon as the agent flushes them,
+    and the subsequent text messages are passed to the kernel as user inputs.
     '''
     app = request.app
     local_config = app['local_config']
@@ -250,21 +455,25 @@ async def stream_execute(defer, request: web.Request) -> web.StreamResponse:
     access_key = request['keypair']['access_key']
     api_version = request['api_version']
     log.info('STREAM_EXECUTE(ak:{0}, s:{1})', access_key, session_name)
+    check_stream_draining(app)
     try:
         compute_session = await asyncio.shield(
-            registry.get_session(session_name, access_key)  # noqa
+            registry.get_session_route(session_name, access_key)  # noqa
         )
     except SessionNotFound:
         raise
-    stream_key = compute_session['id']
+    stream_key = compute_session.kernel_id
 
     await asyncio.shield(registry.increment_session_usage(session_name, access_key))
     ws = web.WebSocketResponse(max_msg_size=local_config['manager']['max-wsmsg-size'])
     await ws.prepare(request)
+    register_stream_websocket(app, ws, defer)
 
     myself = asyncio.current_task()
     app['stream_execute_handlers'][stream_key].add(myself)
     defer(lambda: app['stream_execute_handlers'][stream_key].discard(myself))
+    conn_stats = app['stream_metrics'].open('execute', compute_session.session_id, access_key)
+    defer(lambda: app['stream_metrics'].close(conn_stats))
 
     # This websocket connection itself is a "run".
     run_id = secrets.token_hex(8)
@@ -280,40 +489,65 @@ async def stream_execute(defer, request: web.Request) -> web.StreamResponse:
         code = params.get('code', '')
         opts = params.get('options', None) or {}
 
-        while True:
-            # TODO: rewrite agent and kernel-runner for unbuffered streaming.
-            raw_result = await registry.execute(
+        # Subsequent text frames are the user inputs, which may arrive at any time
+        # (even before the kernel asks for them).
+        input_queue: asyncio.Queue[str] = asyncio.Queue()
+        conn_stats.queue_depth = input_queue.qsize
+
+        async def read_inputs() -> None:
+            async for msg in ws:
+                if msg.type == aiohttp.WSMsgType.TEXT:
+                    conn_stats.record_in(len(msg.data))
+                    input_queue.put_nowait(msg.data)
+                elif msg.type == aiohttp.WSMsgType.ERROR:
+                    log.warning('STREAM_EXECUTE: connection closed with exception {0!r}',
+                                ws.exception())
+
+        async def run() -> None:
+            # Close the generator explicitly so that its RPC context is exited
+            # even when this task is cancelled in the middle of the iteration.
+            async with aclosing(registry.execute_stream(
                 session_name, access_key,
                 api_version, run_id, mode, code, opts,
-                flush_timeout=0.2)
-            if ws.closed:
+                read_input=input_queue.get,
+                flush_timeout=local_config['manager']['stream-execute-flush-timeout'],
+            )) as results:
+                async for raw_result in results:
+                    msg = json.dumps({
+                        'status': raw_result['status'],
+                        'console': raw_result.get('console'),
+                        'exitCode': raw_result.get('exitCode'),
+                        'options': raw_result.get('options'),
+                        'files': raw_result.get('files'),
+                    })
+                    sent_at = time.perf_counter()
+                    await ws.send_str(msg)
+                    conn_stats.record_out(len(msg), time.perf_counter() - sent_at)
+
+        input_task = asyncio.create_task(read_inputs())
+        run_task = asyncio.create_task(run())
+        try:
+            await asyncio.wait([input_task, run_task], return_when=asyncio.FIRST_COMPLETED)
+            if run_task.done():
+                run_task.result()
+                await ws.close()
+                await input_task
+            elif app['stream_draining']:
+                # The server has closed the connection for shutdown,
+                # so let the execution continue until the client reconnects.
+                log.debug('STREAM_EXECUTE: closed for server shutdown')
+                run_task.cancel()
+                await asyncio.gather(run_task, return_exceptions=True)
+            else:
                 log.debug('STREAM_EXECUTE: client disconnected (interrupted)')
+                run_task.cancel()
+                await asyncio.gather(run_task, return_exceptions=True)
                 await asyncio.shield(registry.interrupt_session(session_name, access_key))
-                break
-            if raw_result is None:
-                # repeat until we get finished
-                log.debug('STREAM_EXECUTE: none returned, continuing...')
-                mode = 'continue'
-                code = ''
-                opts.clear()
-                continue
-            await ws.send_json({
-                'status': raw_result['status'],
-                'console': raw_result.get('console'),
-                'exitCode': raw_result.get('exitCode'),
-                'options': raw_result.get('options'),
-                'files': raw_result.get('files'),
-            })
-            if raw_result['status'] == 'waiting-input':
-                mode = 'input'
-                code = await ws.receive_str()
-            elif raw_result['status'] == 'finished':
-                break
-            else:
-                # repeat until we get finished
-                mode = 'continue'
-                code = ''
-                opts.clear()
+        finally:
+            for task in (input_task, run_task):
+                if not task.done():
+                    task.cancel()
+                    await asyncio.gather(task, return_exceptions=True)
     except (json.decoder.JSONDecodeError, AssertionError) as e:
         log.warning('STREAM_EXECUTE: invalid/missing parameters: {0!r}', e)
         if not ws.closed:
@@ -335,6 +569,8 @@ async def stream_execute(defer, request: web.Request) -> web.StreamResponse:
                 'status': 'server-restarting',
                 'msg': 'The API server is going to restart for maintenance. '
                        'Please connect again with the same run ID.',
+                'retryAfter': round(random.uniform(
+                    0, local_config['manager']['stream-reconnect-spread']), 1),
             })
         raise
     finally:
@@ -413,54 +649,10 @@ async def stream_proxy(defer, request: web.Request, params: Mapping[str, Any]) -
         raise InvalidAPIParameters(
             f"Unsupported service protocol: {sport['protocol']}")
 
-    redis_live: aioredis.Redis = request.app['redis_live']
-    conn_tracker_key = f"session.{kernel['id']}.active_app_connections"
+    conn_tracker: AppConnectionTracker = request.app['conn_tracker']
     conn_tracker_val = f"{kernel['id']}:{service}:{stream_id}"
 
-    async def refresh_cb(kernel_id: str, data: bytes) -> None:
-        now = await redis_live.time()
-        await asyncio.shield(call_non_bursty(
-            conn_tracker_key,
-            apartial(redis_live.zadd, conn_tracker_key, now, conn_tracker_val),
-            max_bursts=64, max_idle=2000,
-        ))
-
-    down_cb = apartial(refresh_cb, kernel['id'])
-    up_cb = apartial(refresh_cb, kernel['id'])
-    ping_cb = apartial(refresh_cb, kernel['id'])
-
-    active_session_ids: DefaultDict[str, int] = request.app['active_session_ids']
-    kernel_id = kernel['id']
-
-    async def add_conn_track() -> None:
-        async with request.app['conn_tracker_lock']:
-            active_session_ids[kernel_id] += 1
-            now = await redis_live.time()
-            await redis_live.zadd(conn_tracker_key, now, conn_tracker_val)
-            for idle_checker in request.app['idle_checkers']:
-                await idle_checker.update_app_streaming_status(
-                    kernel_id,
-                    AppStreamingStatus.HAS_ACTIVE_CONNECTIONS,
-                )
-
-    async def clear_conn_track() -> None:
-        async with request.app['conn_tracker_lock']:
-            active_session_ids[kernel_id] -= 1
-            if active_session_ids[kernel_id] <= 0:
-                del active_session_ids[kernel_id]
-            await redis_live.zrem(conn_tracker_key, conn_tracker_val)
-            remaining_count = await redis_live.zcount(conn_tracker_key)
-            if remaining_count == 0:
-                for idle_checker in request.app['idle_checkers']:
-                    await idle_checker.update_app_streaming_status(
-                        kernel_id,
-                        AppStreamingStatus.NO_ACTIVE_CONNECTIONS,
-                    )
-
-    try:
-        await asyncio.shield(add_conn_track())
-        await asyncio.shield(registry.increment_session_usage(session_name, access_key))
-
+    async def start_service() -> None:
         opts: MutableMapping[str, Union[None, str, List[str]]] = {}
         if params['arguments'] is not None:
             opts['arguments'] = json.loads(params['arguments'])
@@ -474,24 +666,180 @@ async def stream_proxy(defer, request: web.Request, params: Mapping[str, Any]) -
                 "Failed to launch the app service",
                 extra_data=result['error'])
 
+    mgr_config = local_config['manager']
+    check_stream_draining(request.app)
+    if mgr_config['app-proxy-mode'] == 'redirect':
+        # Let the client connect to the app-proxy endpoint near the kernel,
+        # which reports the connection activity via report_app_proxy_activity().
+        await asyncio.shield(registry.increment_session_usage(session_name, access_key))
+        await start_service()
+        token = create_app_proxy_token(
+            mgr_config['app-proxy-token-secret'],
+            mgr_config['app-proxy-token-ttl'],
+            mgr_config['app-proxy-token-max-lifetime'],
+            session_id=stream_key,
+            access_key=access_key,
+            service=service,
+            conn_id=conn_tracker_val,
+            dest=dest,
+        )
+        redirect_url = URL(mgr_config['app-proxy-redirect-url'].format(
+            host=dest[0],
+            port=dest[1],
+            session_id=stream_key,
+            service=service,
+        )).update_query(token=token)
+        raise web.HTTPTemporaryRedirect(
+            redirect_url,
+            text=json.dumps({'redirect': str(redirect_url), 'token': token}),
+            content_type='application/json',
+        )
+
+    try:
+        await asyncio.shield(conn_tracker.add(stream_key, conn_tracker_val))
+        await asyncio.shield(registry.increment_session_usage(session_name, access_key))
+        await start_service()
+
         # TODO: weakref to proxies for graceful shutdown?
         ws = web.WebSocketResponse(
             autoping=False,
             max_msg_size=local_config['manager']['max-wsmsg-size'],
         )
         await ws.prepare(request)
+        register_stream_websocket(request.app, ws, defer)
+        conn_stats = request.app['stream_metrics'].open('proxy', kernel['session_id'], access_key)
+        defer(lambda: request.app['stream_metrics'].close(conn_stats))
         proxy = proxy_cls(
             ws, dest[0], dest[1],
-            downstream_callback=down_cb,
-            upstream_callback=up_cb,
-            ping_callback=ping_cb,
+            stats=conn_stats,
+            high_water=int(mgr_config['proxy-buffer-high-water']),
+            low_water=int(mgr_config['proxy-buffer-low-water']),
+            memory_budget=request.app['proxy_memory_budget'],
         )
+        conn_tracker.attach(stream_key, conn_tracker_val, proxy)
         return await proxy.proxy()
     except asyncio.CancelledError:
         log.debug('stream_proxy({}, {}) cancelled', stream_key, service)
         raise
     finally:
-        await asyncio.shield(clear_conn_track())
+        await asyncio.shield(conn_tracker.remove(stream_key, conn_tracker_val))
+
+
+def create_app_proxy_token(
+    secret: str,
+    ttl: float,
+    max_lifetime: float,
+    *,
+    session_id: KernelId,
+    access_key: AccessKey,
+    service: str,
+    conn_id: str,
+    dest: Tuple[str, int],
+) -> str:
+    """
+    Issues a short-lived token which authorizes a single app-proxy connection
+    to the given destination in the "redirect" app-proxy mode.
+
+    The token must be used to connect within ``ttl`` seconds, while the activity
+    of the connection may be reported with it for up to ``max_lifetime`` seconds.
+    """
+    now = int(time.time())
+    payload = {
+        'iat': now,
+        'exp': now + int(ttl),
+        'max_exp': now + int(max_lifetime),
+        'session_id': str(session_id),
+        'access_key': access_key,
+        'service': service,
+        'conn_id': conn_id,
+        'host': dest[0],
+        'port': dest[1],
+    }
+    return jwt.encode(payload, secret, algorithm='HS256').decode('ascii')
+
+
+def verify_app_proxy_token(secret: str, token: str) -> Mapping[str, Any]:
+    # The "exp" claim is not checked because the activity of a connection
+    # is reported for its lifetime, which may exceed the token's TTL.
+    # Instead, the "max_exp" claim bounds how long a (leaked) token is accepted.
+    claims = jwt.decode(token, secret, algorithms=['HS256'], options={'verify_exp': False})
+    max_exp = claims.get('max_exp')
+    if not isinstance(max_exp, int):
+        raise jwt.InvalidTokenError('The app-proxy token has no maximum lifetime')
+    if max_exp < time.time():
+        raise jwt.ExpiredSignatureError('The app-proxy token has exceeded its maximum lifetime')
+    return claims
+
+
+def sign_app_proxy_report(secret: str, body: bytes) -> str:
+    """
+    Returns the signature of an app-proxy activity report body, which the
+    app-proxy endpoint should send in the ``X-BackendAI-Signature`` header.
+    """
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def app_proxy_signature_required(handler):
+
+    @functools.wraps(handler)
+    async def wrapped(request: web.Request, *args, **kwargs) -> web.Response:
+        mgr_config = request.app['local_config']['manager']
+        if mgr_config['app-proxy-mode'] != 'redirect':
+            raise GenericNotFound
+        body = await request.read()
+        my_signature = sign_app_proxy_report(mgr_config['app-proxy-token-secret'], body)
+        signature = request.headers.get('X-BackendAI-Signature', '')
+        if not secrets.compare_digest(my_signature, signature):
+            raise AuthorizationFailed('Invalid app-proxy report signature')
+        return await handler(request, *args, **kwargs)
+
+    return wrapped
+
+
+_app_proxy_report_iv = t.Dict({
+    t.Key('active', default=[]): t.List(t.String),
+    t.Key('closed', default=[]): t.List(t.String),
+})
+
+
+@server_status_required(READ_ALLOWED)
+@app_proxy_signature_required
+async def report_app_proxy_activity(request: web.Request) -> web.Response:
+    """
+    Receives the activity reports of the app-proxy connections in the "redirect"
+    app-proxy mode, identified by their tokens issued by stream_proxy().
+    The app-proxy endpoint should report the active connections periodically
+    (more frequently than the app-streaming packet timeout) and the closed ones,
+    signing the request body with the app-proxy token secret.
+
+    The tokens which have exceeded their maximum lifetime are ignored, so such
+    connections are no longer counted as active by the idle checkers.
+    """
+    # check_api_params() cannot be used here as the body is already consumed
+    # to verify its signature.
+    try:
+        params = _app_proxy_report_iv.check(await request.json())
+    except json.JSONDecodeError:
+        raise InvalidAPIParameters('Malformed body')
+    except t.DataError as e:
+        raise InvalidAPIParameters('Input validation error', extra_data=e.as_dict())
+    mgr_config = request.app['local_config']['manager']
+    conn_tracker: AppConnectionTracker = request.app['conn_tracker']
+    for active, tokens in ((True, params['active']), (False, params['closed'])):
+        for token in tokens:
+            try:
+                claims = verify_app_proxy_token(mgr_config['app-proxy-token-secret'], token)
+            except jwt.ExpiredSignatureError:
+                log.debug('ignoring an app-proxy token exceeding its maximum lifetime')
+                continue
+            except jwt.InvalidTokenError:
+                raise InvalidAPIParameters('Invalid app-proxy token')
+            await conn_tracker.report_remote(
+                uuid.UUID(claims['session_id']),
+                claims['conn_id'],
+                active=active,
+            )
+    return web.json_response({}, status=200)
 
 
 @server_status_required(READ_ALLOWED)
@@ -519,6 +867,20 @@ async def get_stream_apps(request: web.Request) -> web.Response:
     return web.json_response(resp)
 
 
+@superadmin_required
+@server_status_required(READ_ALLOWED)
+async def get_stream_metrics(request: web.Request) -> web.Response:
+    '''
+    Returns the traffic statistics of the active streaming connections
+    handled by this API server process.
+    '''
+    log.info('GET_STREAM_METRICS (pid:{0})', os.getpid())
+    return web.json_response({
+        'pid': os.getpid(),
+        **request.app['stream_metrics'].snapshot(),
+    })
+
+
 async def kernel_terminated(app: web.Application, agent_id: AgentId, event_name: str,
                             kernel_id: KernelId, reason: str,
                             exit_code: int = None) -> None:
@@ -530,8 +892,9 @@ async def kernel_terminated(app: web.Application, agent_id: AgentId, event_name:
     if kernel['cluster_role'] == DEFAULT_ROLE:
         stream_key = kernel['id']
         cancelled_tasks = []
-        for sock in app['stream_stdin_socks'][stream_key]:
-            sock.close()
+        hub = app['stream_hubs'].pop(stream_key, None)
+        if hub is not None:
+            await hub.close()
         for handler in list(app['stream_pty_handlers'].get(stream_key, [])):
             handler.cancel()
             cancelled_tasks.append(handler)
@@ -545,32 +908,206 @@ async def kernel_terminated(app: web.Application, agent_id: AgentId, event_name:
         # TODO: reconnect if restarting?
 
 
-async def stream_conn_tracker_gc(app: web.Application) -> None:
-    redis_live: aioredis.Redis = app['redis_live']
-    shared_config: SharedConfig = app['shared_config']
-    try:
-        while True:
-            no_packet_timeout: timedelta = tx.TimeDuration().check(
-                await shared_config.etcd.get('config/idle/app-streaming-packet-timeout', '5m')
+_conn_tracker_gc_script = '''
+local cutoff = ARGV[1]
+local emptied = {}
+for i, key in ipairs(KEYS) do
+    if redis.call('ZCARD', key) > 0 then
+        redis.call('ZREMRANGEBYSCORE', key, '-inf', cutoff)
+        if redis.call('ZCARD', key) == 0 then
+            table.insert(emptied, i)
+        end
+    end
+end
+return emptied
+'''
+
+
+def _get_conn_tracker_key(session_id: KernelId) -> str:
+    return f"session.{session_id}.active_app_connections"
+
+
+class AppConnectionTracker:
+    """
+    Keeps the app-streaming connections of sessions in the Redis sorted sets
+    scored by their last activity time, which the idle checkers refer to.
+
+    The proxies only update their last activity timestamps in memory, and
+    the tracker writes the timestamps of the connections active since the last
+    flush using a single Redis pipeline per interval.  The stale connections of
+    all sessions served by this process are garbage-collected by a single
+    Lua script call.
+    """
+
+    _proxies: Dict[Tuple[KernelId, str], ServiceProxy]
+    _remote_sessions: Dict[KernelId, float]
+
+    def __init__(
+        self,
+        redis_live: aioredis.Redis,
+        idle_checkers: Sequence[BaseIdleChecker],
+        *,
+        packet_timeout: float = 300.0,
+    ) -> None:
+        self.redis_live = redis_live
+        self.idle_checkers = idle_checkers
+        self.packet_timeout = packet_timeout
+        self.active_session_ids: DefaultDict[KernelId, int] = defaultdict(int)  # multiset
+        self._proxies = {}
+        self._remote_sessions = {}
+        self._last_flush = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def _update_app_streaming_status(
+        self,
+        session_id: KernelId,
+        status: AppStreamingStatus,
+    ) -> None:
+        for idle_checker in self.idle_checkers:
+            await idle_checker.update_app_streaming_status(session_id, status)
+
+    async def add(self, session_id: KernelId, conn_id: str) -> None:
+        async with self._lock:
+            self.active_session_ids[session_id] += 1
+            now = await self.redis_live.time()
+            await self.redis_live.zadd(_get_conn_tracker_key(session_id), now, conn_id)
+            await self._update_app_streaming_status(
+                session_id,
+                AppStreamingStatus.HAS_ACTIVE_CONNECTIONS,
             )
-            async with app['conn_tracker_lock']:
-                now = await redis_live.time()
-                for session_id in app['active_session_ids'].keys():
-                    conn_tracker_key = f"session.{session_id}.active_app_connections"
-                    prev_remaining_count = await redis_live.zcount(conn_tracker_key)
-                    removed_count = await redis_live.zremrangebyscore(
-                        conn_tracker_key, float('-inf'), now - no_packet_timeout.total_seconds(),
+
+    def attach(self, session_id: KernelId, conn_id: str, proxy: ServiceProxy) -> None:
+        """
+        Starts to report the activity of the given proxy for the connection.
+        """
+        self._proxies[(session_id, conn_id)] = proxy
+
+    async def remove(self, session_id: KernelId, conn_id: str) -> None:
+        async with self._lock:
+            self._proxies.pop((session_id, conn_id), None)
+            self.active_session_ids[session_id] -= 1
+            if self.active_session_ids[session_id] <= 0:
+                del self.active_session_ids[session_id]
+            conn_tracker_key = _get_conn_tracker_key(session_id)
+            await self.redis_live.zrem(conn_tracker_key, conn_id)
+            remaining_count = await self.redis_live.zcount(conn_tracker_key)
+            if remaining_count == 0:
+                await self._update_app_streaming_status(
+                    session_id,
+                    AppStreamingStatus.NO_ACTIVE_CONNECTIONS,
+                )
+
+    async def report_remote(self, session_id: KernelId, conn_id: str, *, active: bool) -> None:
+        """
+        Records the activity of a connection proxied outside the manager
+        (i.e., in the "redirect" app-proxy mode).
+        The remote connections are garbage-collected in the same way
+        if their activity reports stop.
+        """
+        async with self._lock:
+            conn_tracker_key = _get_conn_tracker_key(session_id)
+            if active:
+                self._remote_sessions[session_id] = time.monotonic()
+                now = await self.redis_live.time()
+                num_added = await self.redis_live.zadd(conn_tracker_key, now, conn_id)
+                if num_added:
+                    await self._update_app_streaming_status(
+                        session_id,
+                        AppStreamingStatus.HAS_ACTIVE_CONNECTIONS,
+                    )
+            else:
+                await self.redis_live.zrem(conn_tracker_key, conn_id)
+                remaining_count = await self.redis_live.zcount(conn_tracker_key)
+                if remaining_count == 0:
+                    self._remote_sessions.pop(session_id, None)
+                    await self._update_app_streaming_status(
+                        session_id,
+                        AppStreamingStatus.NO_ACTIVE_CONNECTIONS,
                     )
-                    remaining_count = await redis_live.zcount(conn_tracker_key)
-                    log.debug(f"conn_tracker: gc {session_id} "
-                              f"removed/remaining = {removed_count}/{remaining_count}")
-                    if prev_remaining_count > 0 and remaining_count == 0:
-                        for idle_checker in app['idle_checkers']:
-                            await idle_checker.update_app_streaming_status(
-                                session_id,
-                                AppStreamingStatus.NO_ACTIVE_CONNECTIONS,
-                            )
-            await asyncio.sleep(10)
+
+    async def flush(self) -> None:
+        async with self._lock:
+            last_flush, self._last_flush = self._last_flush, time.monotonic()
+            active_conns = [
+                (session_id, conn_id, proxy.last_activity)
+                for (session_id, conn_id), proxy in self._proxies.items()
+                if proxy.last_activity > last_flush
+            ]
+            if not active_conns:
+                return
+            # Convert the local monotonic timestamps to the Redis server time.
+            now = await self.redis_live.time()
+            offset = now - time.monotonic()
+
+            def _pipe_builder():
+                pipe = self.redis_live.pipeline()
+                for session_id, conn_id, last_activity in active_conns:
+                    pipe.zadd(_get_conn_tracker_key(session_id), last_activity + offset, conn_id)
+                return pipe
+
+            await redis.execute_with_retries(_pipe_builder)
+
+    async def gc(self) -> None:
+        async with self._lock:
+            session_ids = list({**self.active_session_ids, **self._remote_sessions}.keys())
+            if not session_ids:
+                return
+            now = await self.redis_live.time()
+            emptied_indices = await redis.execute_script(
+                self.redis_live, 'conn_tracker_gc', _conn_tracker_gc_script,
+                [_get_conn_tracker_key(session_id) for session_id in session_ids],
+                [str(now - self.packet_timeout)],
+            )
+            for idx in (emptied_indices or []):
+                session_id = session_ids[int(idx) - 1]
+                log.debug('conn_tracker: gc {} removed all connections', session_id)
+                await self._update_app_streaming_status(
+                    session_id,
+                    AppStreamingStatus.NO_ACTIVE_CONNECTIONS,
+                )
+            # The connections of the remote sessions without recent reports
+            # are removed above, so we no longer need to check them.
+            expired_before = time.monotonic() - self.packet_timeout
+            for session_id, reported_at in list(self._remote_sessions.items()):
+                if reported_at < expired_before:
+                    del self._remote_sessions[session_id]
+
+    async def flush_loop(self, interval: float = 5.0) -> None:
+        while True:
+            try:
+                await asyncio.sleep(interval)
+                await self.flush()
+                await self.gc()
+            except asyncio.CancelledError:
+                break
+            except Exception:
+                log.exception('AppConnectionTracker.flush_loop(): unexpected-error')
+
+
+async def watch_packet_timeout(app: web.Application) -> None:
+    """
+    Keeps the app-streaming packet timeout of the connection tracker
+    in sync with the etcd configuration.
+    """
+    shared_config: SharedConfig = app['shared_config']
+    conn_tracker: AppConnectionTracker = app['conn_tracker']
+    config_key = 'config/idle/app-streaming-packet-timeout'
+
+    def _update(raw_timeout: Optional[str]) -> None:
+        try:
+            no_packet_timeout: timedelta = tx.TimeDuration().check(raw_timeout or '5m')
+        except t.DataError:
+            log.warning('invalid {}: {!r}', config_key, raw_timeout)
+            return
+        conn_tracker.packet_timeout = no_packet_timeout.total_seconds()
+
+    try:
+        _update(await shared_config.etcd.get(config_key))
+        async with aclosing(shared_config.etcd.watch(config_key)) as agen:
+            async for _ in agen:
+                # The watch only covers the global scope, so re-read the merged value
+                # to respect the overrides in the narrower scopes.
+                _update(await shared_config.etcd.get(config_key))
     except asyncio.CancelledError:
         pass
 
@@ -579,11 +1116,18 @@ async def stream_app_ctx(app: web.Application) -> AsyncIterator[None]:
     app['stream_pty_handlers'] = defaultdict(weakref.WeakSet)
     app['stream_execute_handlers'] = defaultdict(weakref.WeakSet)
     app['stream_proxy_handlers'] = defaultdict(weakref.WeakSet)
-    app['stream_stdin_socks'] = defaultdict(weakref.WeakSet)
+    app['stream_hubs'] = {}
+    app['stream_websockets'] = weakref.WeakSet()
+    app['stream_draining'] = False
     app['zctx'] = zmq.asyncio.Context()
-    app['conn_tracker_lock'] = asyncio.Lock()
-    app['active_session_ids'] = defaultdict(int)  # multiset[int]
-    app['conn_tracker_gc_task'] = asyncio.create_task(stream_conn_tracker_gc(app))
+    app['conn_tracker'] = AppConnectionTracker(app['redis_live'], app['idle_checkers'])
+    app['conn_tracker_flush_task'] = asyncio.create_task(app['conn_tracker'].flush_loop())
+    app['conn_tracker_config_task'] = asyncio.create_task(watch_packet_timeout(app))
+    app['stream_metrics'] = StreamMetricsCollector()
+    app['proxy_memory_budget'] = ProxyMemoryBudget(
+        int(app['local_config']['manager']['proxy-memory-budget']))
+    app['stream_metrics_task'] = asyncio.create_task(
+        app['stream_metrics'].report_loop(app['stats_monitor']))
 
     event_dispatcher = app['event_dispatcher']
     event_dispatcher.subscribe('kernel_terminated', app, kernel_terminated)
@@ -595,25 +1139,42 @@ async def stream_app_ctx(app: web.Application) -> AsyncIterator[None]:
 
 
 async def stream_shutdown(app: web.Application) -> None:
+    # At this point, the server has already stopped accepting new connections.
+    app['stream_draining'] = True
+    mgr_config = app['local_config']['manager']
+    if app['pidx'] == 0:
+        try:
+            await app['shared_config'].mark_myself_draining()
+        except Exception:
+            log.exception('failed to advertise the draining status of this manager')
+
+    handlers: List[asyncio.Task] = []
+    for handler_group in ('stream_pty_handlers', 'stream_execute_handlers', 'stream_proxy_handlers'):
+        for per_kernel_handlers in app[handler_group].values():
+            handlers.extend(handler for handler in per_kernel_handlers if not handler.done())
+    if handlers and mgr_config['stream-drain-timeout'] > 0:
+        log.info('draining {0} streams (timeout: {1:.1f} sec)',
+                 len(handlers), mgr_config['stream-drain-timeout'])
+        await asyncio.wait(handlers, timeout=mgr_config['stream-drain-timeout'])
+    # Let the clients of the remaining streams reconnect to other servers
+    # at different moments.
+    await asyncio.gather(*[
+        close_for_restart(ws, mgr_config['stream-reconnect-spread'])
+        for ws in list(app['stream_websockets']) if not ws.closed
+    ], return_exceptions=True)
+
     cancelled_tasks: List[asyncio.Task] = []
-    app['conn_tracker_gc_task'].cancel()
-    cancelled_tasks.append(app['conn_tracker_gc_task'])
-    for per_kernel_handlers in app['stream_pty_handlers'].values():
-        for handler in list(per_kernel_handlers):
-            if not handler.done():
-                handler.cancel()
-                cancelled_tasks.append(handler)
-    for per_kernel_handlers in app['stream_execute_handlers'].values():
-        for handler in list(per_kernel_handlers):
-            if not handler.done():
-                handler.cancel()
-                cancelled_tasks.append(handler)
-    for per_kernel_handlers in app['stream_proxy_handlers'].values():
-        for handler in list(per_kernel_handlers):
-            if not handler.done():
-                handler.cancel()
-                cancelled_tasks.append(handler)
+    for task_name in ('conn_tracker_flush_task', 'conn_tracker_config_task', 'stream_metrics_task'):
+        app[task_name].cancel()
+        cancelled_tasks.append(app[task_name])
+    for handler in handlers:
+        if not handler.done():
+            handler.cancel()
+            cancelled_tasks.append(handler)
     await asyncio.gather(*cancelled_tasks, return_exceptions=True)
+    hubs = list(app['stream_hubs'].values())
+    app['stream_hubs'].clear()
+    await asyncio.gather(*[hub.close() for hub in hubs], return_exceptions=True)
 
 
 def create_app(default_cors_options: CORSOptions) -> Tuple[web.Application, Iterable[WebMiddleware]]:
@@ -631,4 +1192,6 @@ def create_app(default_cors_options: CORSOptions) -> Tuple[web.Application, Iter
     # and thus they have the same implementation here.
     cors.add(add_route('GET', r'/session/{session_name}/httpproxy', stream_proxy))
     cors.add(add_route('GET', r'/session/{session_name}/tcpproxy', stream_proxy))
+    cors.add(add_route('POST', r'/app-proxy/activity', report_app_proxy_activity))
+    cors.add(add_route('GET', r'/_/metrics', get_stream_metrics))
     return app, []
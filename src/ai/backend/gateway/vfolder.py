@@ -372,7 +372,7 @@ async def create(request: web.Request, params: Any) -> web.Response:
 )
 async def list_folders(request: web.Request, params: Any) -> web.Response:
     resp = []
-    dbpool = request.app['dbpool']
+    dbpool = request.app['dbpool_router'].readonly
     access_key = request['keypair']['access_key']
     domain_name = request['user']['domain_name']
     user_role = request['user']['role']
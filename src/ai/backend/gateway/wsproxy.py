@@ -4,12 +4,16 @@ WebSocket-based streaming kernel interaction APIs.
 
 from abc import ABCMeta, abstractmethod
 import asyncio
+from collections import deque
 import logging
+import time
 from typing import (
-    Any,
     Awaitable,
     Callable,
+    Deque,
+    Final,
     Optional,
+    Tuple,
     Union,
 )
 
@@ -20,18 +24,89 @@ from aiohttp import web
 from ai.backend.common.logging import BraceStyleAdapter
 
 from .config import DEFAULT_CHUNK_SIZE
+from .metric import StreamConnStats
 
 log = BraceStyleAdapter(logging.getLogger('ai.backend.gateway.wsproxy'))
 
+MIN_CHUNK_SIZE: Final = 16 * 1024  # 16 KiB
+MAX_CHUNK_SIZE: Final = 4 * DEFAULT_CHUNK_SIZE  # 1 MiB
+DEFAULT_HIGH_WATER: Final = 4 * DEFAULT_CHUNK_SIZE  # 1 MiB
+DEFAULT_LOW_WATER: Final = DEFAULT_CHUNK_SIZE  # 256 KiB
+WRITE_BUFFER_CHECK_INTERVAL: Final = 0.05  # seconds
+
+
+class ProxyMemoryBudget:
+    '''
+    Limits the total size of the client data buffered by all service proxies
+    in a worker process.
+
+    The proxies reserve the budget before buffering the data received from
+    the clients and release it after the data is written to the services.
+    When the budget is exhausted, the proxies stop reading from the clients
+    until other proxies release their reservations.  A limit of zero
+    disables the budget.
+    '''
+
+    _waiters: Deque[Tuple[int, asyncio.Future]]
+
+    def __init__(self, limit: int = 0) -> None:
+        self.limit = limit
+        self.used = 0
+        self._waiters = deque()
+
+    def _fits(self, nbytes: int) -> bool:
+        # A single reservation larger than the limit is allowed
+        # when nothing else is reserved, to avoid stalling forever.
+        return self.limit <= 0 or self.used == 0 or self.used + nbytes <= self.limit
+
+    async def reserve(self, nbytes: int) -> None:
+        if not self._waiters and self._fits(nbytes):
+            self.used += nbytes
+            return
+        fut = asyncio.get_running_loop().create_future()
+        item = (nbytes, fut)
+        self._waiters.append(item)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # The reservation was granted just before the cancellation.
+                self.release(nbytes)
+            else:
+                self._waiters.remove(item)
+                self._wakeup()
+            raise
+
+    def release(self, nbytes: int) -> None:
+        self.used -= nbytes
+        self._wakeup()
+
+    def _wakeup(self) -> None:
+        while self._waiters and self._fits(self._waiters[0][0]):
+            nbytes, fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            self.used += nbytes
+            fut.set_result(None)
+
 
 class ServiceProxy(metaclass=ABCMeta):
     '''
     The abstract base class to implement service proxy handlers.
+
+    The proxy handlers only update :attr:`last_activity` and :attr:`stats`
+    on the data path so that the connection activity can be reported
+    periodically elsewhere.
+
+    The data from the client which is not yet written to the service is kept
+    below ``high_water`` bytes (and within the shared ``memory_budget``) by
+    pausing reading from the client until it drains below ``low_water`` bytes.
     '''
 
     __slots__ = (
         'ws', 'host', 'port',
-        'downstream_cb', 'upstream_cb', 'ping_cb',
+        'last_activity', 'stats',
+        'high_water', 'low_water', 'memory_budget',
     )
 
     def __init__(
@@ -40,34 +115,203 @@ class ServiceProxy(metaclass=ABCMeta):
         dest_host: str,
         dest_port: int,
         *,
-        downstream_callback: Callable[[Any], Awaitable[None]] = None,
-        upstream_callback: Callable[[Any], Awaitable[None]] = None,
-        ping_callback: Callable[[Any], Awaitable[None]] = None,
+        stats: StreamConnStats = None,
+        high_water: int = DEFAULT_HIGH_WATER,
+        low_water: int = DEFAULT_LOW_WATER,
+        memory_budget: ProxyMemoryBudget = None,
     ) -> None:
         self.ws = down_ws
         self.host = dest_host
         self.port = dest_port
-        self.downstream_cb = downstream_callback
-        self.upstream_cb = upstream_callback
-        self.ping_cb = ping_callback
+        self.last_activity = time.monotonic()
+        self.stats = stats
+        self.high_water = high_water
+        self.low_water = low_water
+        self.memory_budget = memory_budget
 
     @abstractmethod
     async def proxy(self) -> web.WebSocketResponse:
         pass
 
 
+class _TCPProxyProtocol(asyncio.BufferedProtocol):
+    '''
+    Receives the data from the proxied service directly into the chunk buffers
+    which are handed over to the websocket writer without copying.
+
+    Small segments received while the previous chunk is being sent are coalesced
+    into the next chunk, and the chunk size adapts to the throughput between
+    MIN_CHUNK_SIZE and MAX_CHUNK_SIZE.  Reading from the service is paused while
+    the chunk buffer is full, so a slow websocket client applies backpressure to
+    the service.
+
+    If ``write_buffer_callback`` is given, it is called with the size of the
+    transport's write buffer whenever the size changes, until the buffer is empty.
+    '''
+
+    transport: Optional[asyncio.Transport]
+
+    def __init__(self, write_buffer_callback: Callable[[int], None] = None) -> None:
+        self.transport = None
+        self._loop = asyncio.get_running_loop()
+        self._write_buffer_callback = write_buffer_callback
+        self._write_buffer_check: Optional[asyncio.TimerHandle] = None
+        self._chunk_size = MIN_CHUNK_SIZE
+        self._buffer = bytearray(self._chunk_size)
+        self._length = 0
+        self._eof = False
+        self._exc: Optional[Exception] = None
+        self._reading_paused = False
+        self._writing_paused = False
+        self._read_waiter: Optional[asyncio.Future] = None
+        self._drain_waiter: Optional[asyncio.Future] = None
+
+    def connection_made(self, transport: asyncio.BaseTransport) -> None:
+        assert isinstance(transport, asyncio.Transport)
+        self.transport = transport
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self._eof = True
+        self._exc = exc
+        self._cancel_write_buffer_check()
+        if self._write_buffer_callback is not None:
+            # The remaining data in the write buffer is discarded.
+            self._write_buffer_callback(0)
+        self._wakeup(self._read_waiter)
+        self._wakeup(self._drain_waiter, exc or ConnectionResetError('Connection lost'))
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return memoryview(self._buffer)[self._length:]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self._length += nbytes
+        if self._length >= len(self._buffer):
+            assert self.transport is not None
+            self.transport.pause_reading()
+            self._reading_paused = True
+        self._wakeup(self._read_waiter)
+
+    def eof_received(self) -> bool:
+        self._eof = True
+        self._wakeup(self._read_waiter)
+        return False
+
+    def pause_writing(self) -> None:
+        self._writing_paused = True
+
+    def resume_writing(self) -> None:
+        self._writing_paused = False
+        self._wakeup(self._drain_waiter)
+        self._check_write_buffer()
+
+    def _check_write_buffer(self) -> None:
+        if self._write_buffer_callback is None:
+            return
+        if self.transport is None or self.transport.is_closing():
+            # The owner of the callback is responsible for the data discarded on close.
+            return
+        size = self.transport.get_write_buffer_size()
+        self._write_buffer_callback(size)
+        if size > 0 and self._write_buffer_check is None:
+            # The transport does not notify us when it flushes the buffer below
+            # the low-water mark, so keep checking until the buffer is empty.
+            self._write_buffer_check = self._loop.call_later(
+                WRITE_BUFFER_CHECK_INTERVAL, self._recheck_write_buffer)
+
+    def _recheck_write_buffer(self) -> None:
+        self._write_buffer_check = None
+        self._check_write_buffer()
+
+    def _cancel_write_buffer_check(self) -> None:
+        if self._write_buffer_check is not None:
+            self._write_buffer_check.cancel()
+            self._write_buffer_check = None
+
+    def _wakeup(self, waiter: Optional[asyncio.Future], exc: Exception = None) -> None:
+        if waiter is not None and not waiter.done():
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+    async def read_chunk(self) -> Optional[memoryview]:
+        '''
+        Returns all data received since the last call,
+        or None if the service has closed the connection.
+        '''
+        while self._length == 0:
+            if self._eof:
+                if self._exc is not None:
+                    raise self._exc
+                return None
+            self._read_waiter = self._loop.create_future()
+            try:
+                await self._read_waiter
+            finally:
+                self._read_waiter = None
+        capacity = len(self._buffer)
+        chunk = memoryview(self._buffer)[:self._length]
+        if self._length == capacity:
+            self._chunk_size = min(capacity * 2, MAX_CHUNK_SIZE)
+        elif self._length < capacity // 4:
+            self._chunk_size = max(capacity // 2, MIN_CHUNK_SIZE)
+        # The chunk may still be referenced by the transport after sending,
+        # so we never reuse its buffer.
+        self._buffer = bytearray(self._chunk_size)
+        self._length = 0
+        if self._reading_paused and self.transport is not None:
+            self._reading_paused = False
+            self.transport.resume_reading()
+        return chunk
+
+    def write(self, data: bytes) -> None:
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionResetError('Connection lost')
+        self.transport.write(data)
+        self._check_write_buffer()
+
+    async def drain(self) -> None:
+        '''
+        Waits only if the write buffer of the transport is above the high-water mark.
+        '''
+        if not self._writing_paused:
+            return
+        self._drain_waiter = self._loop.create_future()
+        try:
+            await self._drain_waiter
+        finally:
+            self._drain_waiter = None
+
+    def close(self) -> None:
+        self._cancel_write_buffer_check()
+        if self.transport is not None:
+            self.transport.close()
+
+
 class TCPProxy(ServiceProxy):
 
-    __slots__ = ServiceProxy.__slots__ + ('down_task', )
+    __slots__ = ServiceProxy.__slots__ + ('down_task', 'buffered_bytes')
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
+        self.down_task = None
+        # the size of the client data reserved from the memory budget,
+        # which follows the size of the transport's write buffer as it is flushed.
+        self.buffered_bytes = 0
+
+    def _update_buffered_bytes(self, actual_size: int) -> None:
+        if self.memory_budget is not None:
+            self.memory_budget.release(self.buffered_bytes - actual_size)
+        self.buffered_bytes = actual_size
 
     async def proxy(self) -> web.WebSocketResponse:
+        protocol: Optional[_TCPProxyProtocol] = None
         try:
             try:
                 log.debug('Trying to open proxied TCP connection to {}:{}', self.host, self.port)
-                reader, writer = await asyncio.open_connection(self.host, self.port)
+                _, protocol = await asyncio.get_running_loop().create_connection(
+                    lambda: _TCPProxyProtocol(self._update_buffered_bytes),
+                    self.host, self.port)
             except ConnectionRefusedError:
                 await self.ws.close(code=WSCloseCode.TRY_AGAIN_LATER)
                 return self.ws
@@ -75,22 +319,29 @@ class TCPProxy(ServiceProxy):
                 log.exception("TCPProxy.proxy(): unexpected initial connection error")
                 await self.ws.close(code=WSCloseCode.INTERNAL_ERROR)
                 return self.ws
+            assert protocol is not None
+            assert protocol.transport is not None
+            conn = protocol
+            transport = protocol.transport
+            transport.set_write_buffer_limits(high=self.high_water, low=self.low_water)
 
             async def downstream() -> None:
                 try:
                     while True:
                         try:
-                            chunk = await reader.read(DEFAULT_CHUNK_SIZE)
-                            if not chunk:
+                            chunk = await conn.read_chunk()
+                            if chunk is None:
                                 break
+                            sent_at = time.perf_counter()
                             await self.ws.send_bytes(chunk)
+                            if self.stats is not None:
+                                self.stats.record_out(len(chunk), time.perf_counter() - sent_at)
                         except (RuntimeError, ConnectionResetError,
                                 asyncio.CancelledError):
                             # connection interrupted by client-side
                             break
                         else:
-                            if self.downstream_cb is not None:
-                                await self.downstream_cb(chunk)
+                            self.last_activity = time.monotonic()
                 except asyncio.CancelledError:
                     pass
                 except Exception:
@@ -102,21 +353,25 @@ class TCPProxy(ServiceProxy):
             self.down_task = asyncio.create_task(downstream())
             async for msg in self.ws:
                 if msg.type == web.WSMsgType.BINARY:
+                    if self.stats is not None:
+                        self.stats.record_in(len(msg.data))
+                    if self.memory_budget is not None:
+                        await self.memory_budget.reserve(len(msg.data))
+                    self.buffered_bytes += len(msg.data)
                     try:
-                        writer.write(msg.data)
-                        await writer.drain()
-                    except RuntimeError:
+                        conn.write(msg.data)
+                        # This pauses reading from the client while the service
+                        # is slower than the client.
+                        await conn.drain()
+                    except (RuntimeError, ConnectionResetError):
                         log.debug("Error on writing: Is it closed?")
-                    if self.upstream_cb is not None:
-                        await self.upstream_cb(msg.data)
+                    self.last_activity = time.monotonic()
                 elif msg.type == web.WSMsgType.PING:
                     await self.ws.pong(msg.data)
-                    if self.ping_cb is not None:
-                        await self.ping_cb(msg.data)
+                    self.last_activity = time.monotonic()
                 elif msg.type == web.WSMsgType.ERROR:
                     log.debug("TCPProxy.proxy(): websocket upstream error", exc_info=msg.data)
-                    writer.close()
-                    await writer.wait_closed()
+                    conn.close()
 
         except asyncio.CancelledError:
             pass
@@ -125,16 +380,33 @@ class TCPProxy(ServiceProxy):
         finally:
             if self.down_task is not None and not self.down_task.done():
                 self.down_task.cancel()
-                await self.down_task
+                await asyncio.gather(self.down_task, return_exceptions=True)
+            if protocol is not None:
+                protocol.close()
+            self._update_buffered_bytes(0)
             log.debug('websocket connection closed')
         return self.ws
 
 
 class WebSocketProxy:
+    '''
+    Relays the websocket messages between the client (downstream)
+    and the service (upstream).
+
+    The messages from the client are buffered in :attr:`upstream_buffer`
+    while being sent to the service.  When the buffered size reaches
+    ``high_water`` bytes, reading from the client is paused until the buffer
+    drains below ``low_water`` bytes.  The buffered messages also reserve
+    the shared ``memory_budget`` of the worker process, if given.
+    '''
+
     __slots__ = (
         'up_conn', 'down_conn',
         'upstream_buffer', 'upstream_buffer_task',
         'downstream_cb', 'upstream_cb', 'ping_cb',
+        'stats',
+        'high_water', 'low_water', 'memory_budget',
+        'buffered_bytes', '_writable',
     )
 
     up_conn: aiohttp.ClientWebSocketResponse
@@ -145,12 +417,18 @@ class WebSocketProxy:
     downstream_cb: Optional[Awaitable]
     upstream_cb: Optional[Awaitable]
     ping_cb: Optional[Awaitable]
+    stats: Optional[StreamConnStats]
+    memory_budget: Optional[ProxyMemoryBudget]
 
     def __init__(self, up_conn: aiohttp.ClientWebSocketResponse,
                  down_conn: web.WebSocketResponse, *,
                  downstream_callback: Awaitable = None,
                  upstream_callback: Awaitable = None,
-                 ping_callback: Awaitable = None):
+                 ping_callback: Awaitable = None,
+                 stats: StreamConnStats = None,
+                 high_water: int = DEFAULT_HIGH_WATER,
+                 low_water: int = DEFAULT_LOW_WATER,
+                 memory_budget: ProxyMemoryBudget = None):
         self.up_conn = up_conn
         self.down_conn = down_conn
         self.upstream_buffer = asyncio.Queue()
@@ -158,6 +436,15 @@ class WebSocketProxy:
         self.downstream_cb = downstream_callback
         self.upstream_cb = upstream_callback
         self.ping_cb = ping_callback
+        self.stats = stats
+        if stats is not None:
+            stats.queue_depth = self.upstream_buffer.qsize
+        self.high_water = high_water
+        self.low_water = low_water
+        self.memory_budget = memory_budget
+        self.buffered_bytes = 0
+        self._writable = asyncio.Event()
+        self._writable.set()
 
     async def proxy(self):
         asyncio.ensure_future(self.downstream())
@@ -167,6 +454,8 @@ class WebSocketProxy:
         try:
             async for msg in self.down_conn:
                 if msg.type in (web.WSMsgType.TEXT, web.WSMsgType.binary):
+                    if self.stats is not None:
+                        self.stats.record_in(len(msg.data))
                     await self.write(msg.data, msg.type)
                     if self.upstream_cb is not None:
                         await self.upstream_cb(msg.data)
@@ -191,12 +480,17 @@ class WebSocketProxy:
             self.upstream_buffer_task = \
                     asyncio.ensure_future(self.consume_upstream_buffer())
             async for msg in self.up_conn:
+                sent_at = time.perf_counter()
                 if msg.type == aiohttp.WSMsgType.TEXT:
                     await self.down_conn.send_str(msg.data)
+                    if self.stats is not None:
+                        self.stats.record_out(len(msg.data), time.perf_counter() - sent_at)
                     if self.downstream_cb is not None:
                         await asyncio.shield(self.downstream_cb(msg.data))
                 if msg.type == aiohttp.WSMsgType.BINARY:
                     await self.down_conn.send_bytes(msg.data)
+                    if self.stats is not None:
+                        self.stats.record_out(len(msg.data), time.perf_counter() - sent_at)
                     if self.downstream_cb is not None:
                         await asyncio.shield(self.downstream_cb(msg.data))
                 elif msg.type == aiohttp.WSMsgType.CLOSED:
@@ -214,16 +508,33 @@ class WebSocketProxy:
     async def consume_upstream_buffer(self):
         while True:
             msg, tp = await self.upstream_buffer.get()
-            if self.up_conn:
-                if tp == aiohttp.WSMsgType.TEXT:
-                    await self.up_conn.send_str(msg)
-                elif tp == aiohttp.WSMsgType.binary:
-                    await self.up_conn.send_bytes(msg)
-            else:
-                await self.close()
+            try:
+                if self.up_conn:
+                    if tp == aiohttp.WSMsgType.TEXT:
+                        await self.up_conn.send_str(msg)
+                    elif tp == aiohttp.WSMsgType.binary:
+                        await self.up_conn.send_bytes(msg)
+                else:
+                    await self.close()
+            finally:
+                self._release(len(msg))
 
     async def write(self, msg: Union[bytes, str], tp: web.WSMsgType):
-        await self.upstream_buffer.put((msg, tp))
+        # Blocking here stops reading from the client (backpressure).
+        await self._writable.wait()
+        if self.memory_budget is not None:
+            await self.memory_budget.reserve(len(msg))
+        self.buffered_bytes += len(msg)
+        if self.buffered_bytes >= self.high_water:
+            self._writable.clear()
+        self.upstream_buffer.put_nowait((msg, tp))
+
+    def _release(self, nbytes: int) -> None:
+        self.buffered_bytes -= nbytes
+        if self.memory_budget is not None:
+            self.memory_budget.release(nbytes)
+        if self.buffered_bytes <= self.low_water:
+            self._writable.set()
 
     async def close_downstream(self):
         if not self.down_conn.closed:
@@ -232,6 +543,10 @@ class WebSocketProxy:
     async def close_upstream(self):
         if self.upstream_buffer_task:
             self.upstream_buffer_task.cancel()
-            await self.upstream_buffer_task
+            await asyncio.gather(self.upstream_buffer_task, return_exceptions=True)
+        # Release the reservations of the messages which will never be sent.
+        while not self.upstream_buffer.empty():
+            msg, _ = self.upstream_buffer.get_nowait()
+            self._release(len(msg))
         if self.up_conn:
             await self.up_conn.close()
@@ -1,11 +1,12 @@
 from __future__ import annotations
 
 import asyncio
+import json
 import logging
 import time
 from typing import (
-    Awaitable, Callable, Final, Optional,
-    Literal, Union,
+    Any, Awaitable, Callable, Final, Optional,
+    Literal, Mapping, Sequence, Union,
     Set,
 )
 import uuid
@@ -22,15 +23,60 @@ from .types import BackgroundTaskEventArgs
 log = BraceStyleAdapter(logging.getLogger('ai.backend.manager.background'))
 
 MAX_BGTASK_ARCHIVE_PERIOD = 86400  # 24  hours
+DEFAULT_MAX_UPDATES_PER_SEC: Final = 5.0
+BGTASK_INDEX_KEY: Final = 'bgtask._index'
+BGTASK_EVENT_STREAM_MAXLEN: Final = 1000
+
+
+def _add_event_to_stream(
+    pipe,
+    task_id: uuid.UUID,
+    event_name: str,
+    event_args: BackgroundTaskEventArgs,
+) -> None:
+    # Keep the events in a per-task stream so that reconnecting clients could resume
+    # from the last received event.
+    stream_key = f'bgtask.{task_id}.events'
+    pipe.xadd(
+        stream_key,
+        {'data': json.dumps({
+            'event_name': event_name,
+            'args': attr.asdict(event_args),
+        })},
+        max_len=BGTASK_EVENT_STREAM_MAXLEN,
+        exact_len=False,
+    )
+    pipe.expire(stream_key, MAX_BGTASK_ARCHIVE_PERIOD)
+
+
+def _decode_event_id(raw_event_id: Union[str, bytes, None]) -> Optional[str]:
+    if isinstance(raw_event_id, bytes):
+        return raw_event_id.decode()
+    return raw_event_id
+
 
 TaskResult = Literal['task_done', 'task_cancelled', 'task_failed']
 
 
 class ProgressReporter:
+    """
+    Reports the progress of a background task.
+
+    To avoid flooding the event bus with tasks that make many small progress increments,
+    the updates are emitted at most *max_updates_per_sec* times per second.
+    The skipped updates are reflected in a trailing update emitted when the interval
+    passes, and the update that completes the total progress is always emitted.
+    """
+
     event_dispatcher: Final[EventDispatcher]
     task_id: Final[uuid.UUID]
     total_progress: Union[int, float]
     current_progress: Union[int, float]
+    min_update_interval: float
+    _last_emitted_at: float
+    _pending_message: Optional[str]
+    _pending_flush: Optional[asyncio.TimerHandle]
+    _flush_task: Optional[asyncio.Task]
 
     def __init__(
         self,
@@ -38,21 +84,82 @@ class ProgressReporter:
         task_id: uuid.UUID,
         current_progress: int = 0,
         total_progress: int = 0,
+        *,
+        max_updates_per_sec: float = DEFAULT_MAX_UPDATES_PER_SEC,
     ) -> None:
         self.event_dispatcher = event_dispatcher
         self.task_id = task_id
         self.current_progress = current_progress
         self.total_progress = total_progress
+        self.min_update_interval = 1.0 / max_updates_per_sec if max_updates_per_sec > 0 else 0.0
+        self._last_emitted_at = 0.0
+        self._pending_message = None
+        self._pending_flush = None
+        self._flush_task = None
 
     async def update(self, increment: Union[int, float] = 0, message: str = None):
         self.current_progress += increment
         # keep the state as local variables because they might be changed
         # due to interleaving at await statements below.
         current, total = self.current_progress, self.total_progress
+        now = time.monotonic()
+        is_complete = total > 0 and current >= total
+        elapsed = now - self._last_emitted_at
+        if not is_complete and elapsed < self.min_update_interval:
+            self._pending_message = message
+            if self._pending_flush is None:
+                loop = asyncio.get_running_loop()
+                self._pending_flush = loop.call_later(
+                    self.min_update_interval - elapsed, self._start_flush)
+            return
+        await self._cancel_flush()
+        self._last_emitted_at = now
+        await self._emit(current, total, message)
+
+    async def close(self) -> None:
+        """
+        Drops the pending trailing update, as the result event of the task
+        carries the last progress, and waits for the ongoing one to keep
+        the order of events.
+        """
+        await self._cancel_flush()
+
+    def _start_flush(self) -> None:
+        self._pending_flush = None
+        self._last_emitted_at = time.monotonic()
+        self._flush_task = asyncio.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        try:
+            await self._emit(self.current_progress, self.total_progress, self._pending_message)
+        except Exception:
+            log.exception('Task {}: failed to emit the trailing progress update', self.task_id)
+
+    async def _cancel_flush(self) -> None:
+        if self._pending_flush is not None:
+            self._pending_flush.cancel()
+            self._pending_flush = None
+        if self._flush_task is not None:
+            flush_task, self._flush_task = self._flush_task, None
+            await flush_task
+
+    async def _emit(
+        self,
+        current: Union[int, float],
+        total: Union[int, float],
+        message: Optional[str],
+    ) -> None:
         redis_producer = self.event_dispatcher.redis_producer
+        event_args = BackgroundTaskEventArgs(
+            str(self.task_id),
+            message=message,
+            current_progress=current,
+            total_progress=total,
+        )
 
         def _pipe_builder():
             pipe = redis_producer.pipeline()
+            _add_event_to_stream(pipe, self.task_id, 'task_updated', event_args)
             tracker_key = f'bgtask.{self.task_id}'
             pipe.hmset_dict(tracker_key, {
                 'current': str(current),
@@ -63,15 +170,11 @@ class ProgressReporter:
             pipe.expire(tracker_key, MAX_BGTASK_ARCHIVE_PERIOD)
             return pipe
 
-        await redis.execute_with_retries(_pipe_builder, max_retries=2)
+        result = await redis.execute_with_retries(_pipe_builder, max_retries=2)
+        event_id = _decode_event_id(result[0]) if result is not None else None
         await self.event_dispatcher.produce_event(
             'task_updated', (
-                attr.asdict(BackgroundTaskEventArgs(
-                    str(self.task_id),
-                    message=message,
-                    current_progress=current,
-                    total_progress=total,
-                )),
+                attr.asdict(attr.evolve(event_args, event_id=event_id)),
             )
         )
 
@@ -82,10 +185,17 @@ BackgroundTask = Callable[[ProgressReporter], Awaitable[Optional[str]]]
 class BackgroundTaskManager:
     event_dispatcher: EventDispatcher
     ongoing_tasks: Set[asyncio.Task]
+    max_updates_per_sec: float
 
-    def __init__(self, event_dispatcher: EventDispatcher) -> None:
+    def __init__(
+        self,
+        event_dispatcher: EventDispatcher,
+        *,
+        max_updates_per_sec: float = DEFAULT_MAX_UPDATES_PER_SEC,
+    ) -> None:
         self.event_dispatcher = event_dispatcher
         self.ongoing_tasks = set()
+        self.max_updates_per_sec = max_updates_per_sec
 
     async def start(
         self,
@@ -103,6 +213,7 @@ class BackgroundTaskManager:
             now = str(time.time())
             pipe.hmset_dict(tracker_key, {
                 'status': 'started',
+                'name': name or '',
                 'current': '0',
                 'total': '0',
                 'msg': '',
@@ -110,6 +221,7 @@ class BackgroundTaskManager:
                 'last_update': now,
             })
             pipe.expire(tracker_key, MAX_BGTASK_ARCHIVE_PERIOD)
+            pipe.zadd(BGTASK_INDEX_KEY, float(now), str(task_id))
             return pipe
 
         await redis.execute_with_retries(_pipe_builder)
@@ -130,7 +242,10 @@ class BackgroundTaskManager:
         task_name: Optional[str],
     ) -> None:
         task_result: TaskResult
-        reporter = ProgressReporter(self.event_dispatcher, task_id)
+        reporter = ProgressReporter(
+            self.event_dispatcher, task_id,
+            max_updates_per_sec=self.max_updates_per_sec,
+        )
         message = ''
         try:
             message = await func(reporter) or ''
@@ -142,30 +257,82 @@ class BackgroundTaskManager:
             message = repr(e)
             log.exception("Task {} ({}): unhandled error", task_id, task_name)
         finally:
+            await reporter.close()
             redis_producer = self.event_dispatcher.redis_producer
+            event_args = BackgroundTaskEventArgs(
+                str(task_id),
+                message=message,
+                current_progress=reporter.current_progress,
+                total_progress=reporter.total_progress,
+            )
 
             def _pipe_builder():
                 pipe = redis_producer.pipeline()
+                _add_event_to_stream(pipe, task_id, task_result, event_args)
                 tracker_key = f'bgtask.{task_id}'
                 pipe.hmset_dict(tracker_key, {
                     'status': task_result[5:],  # strip "task_"
+                    # include the final progress that may have been skipped by rate-limiting
+                    'current': str(reporter.current_progress),
+                    'total': str(reporter.total_progress),
                     'msg': message,
                     'last_update': str(time.time()),
                 })
                 pipe.expire(tracker_key, MAX_BGTASK_ARCHIVE_PERIOD)
+                # drop the index entries whose trackers have already expired
+                pipe.zremrangebyscore(
+                    BGTASK_INDEX_KEY,
+                    max=time.time() - MAX_BGTASK_ARCHIVE_PERIOD,
+                )
                 return pipe
 
-            await redis.execute_with_retries(_pipe_builder, max_retries=2)
+            result = await redis.execute_with_retries(_pipe_builder, max_retries=2)
+            event_id = _decode_event_id(result[0]) if result is not None else None
             await self.event_dispatcher.produce_event(
                 task_result, (
-                    attr.asdict(BackgroundTaskEventArgs(
-                        str(task_id),
-                        message=message,
-                    )),
+                    attr.asdict(attr.evolve(event_args, event_id=event_id)),
                 )
             )
             log.info('Task {} ({}): {}', task_id, task_name or '', task_result)
 
+    async def list_tasks(self, *, status: str = None) -> Sequence[Mapping[str, Any]]:
+        """
+        Returns the information of background tasks started within the archive period
+        by all manager processes, in the order of their start time.
+        Optionally filter them by *status* (one of "started", "done", "cancelled" and "failed").
+        """
+        redis_producer = self.event_dispatcher.redis_producer
+        expire_before = time.time() - MAX_BGTASK_ARCHIVE_PERIOD
+
+        def _index_pipe_builder():
+            pipe = redis_producer.pipeline()
+            pipe.zremrangebyscore(BGTASK_INDEX_KEY, max=expire_before)
+            pipe.zrange(BGTASK_INDEX_KEY, 0, -1)
+            return pipe
+
+        _, raw_task_ids = await redis.execute_with_retries(_index_pipe_builder)
+        task_ids = [
+            raw_task_id.decode() if isinstance(raw_task_id, bytes) else raw_task_id
+            for raw_task_id in raw_task_ids
+        ]
+
+        def _info_pipe_builder():
+            pipe = redis_producer.pipeline()
+            for task_id in task_ids:
+                pipe.hgetall(f'bgtask.{task_id}', encoding='utf8')
+            return pipe
+
+        task_infos = await redis.execute_with_retries(_info_pipe_builder) if task_ids else []
+        results = []
+        for task_id, task_info in zip(task_ids, task_infos):
+            if not task_info:
+                # expired
+                continue
+            if status is not None and task_info['status'] != status:
+                continue
+            results.append({'task_id': task_id, **task_info})
+        return results
+
     async def shutdown(self) -> None:
         log.info('Cancelling remaining background tasks...')
         for task in self.ongoing_tasks.copy():
@@ -0,0 +1,46 @@
+"""create-usage-rollup-tables
+
+Revision ID: 3e1f2b7c9d04
+Revises: a7bcd0a9f3c2
+Create Date: 2026-10-18 16:40:12.718305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from ai.backend.manager.models.base import GUID
+
+
+# revision identifiers, used by Alembic.
+revision = '3e1f2b7c9d04'
+down_revision = 'a7bcd0a9f3c2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'usage_daily',
+        sa.Column('kernel_id', GUID(), nullable=False),
+        sa.Column('bucket', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('session_id', GUID(), nullable=False),
+        sa.Column('domain_name', sa.String(length=64), nullable=False),
+        sa.Column('group_id', GUID(), nullable=False),
+        sa.Column('user_uuid', GUID(), nullable=False),
+        sa.Column('access_key', sa.String(length=20), nullable=True),
+        sa.Column('used_seconds', sa.Float(), nullable=False),
+        sa.Column('cpu_used', sa.Float(), nullable=False),
+        sa.Column('io_read', sa.BigInteger(), nullable=False),
+        sa.Column('io_write', sa.BigInteger(), nullable=False),
+        sa.Column('mem_used', sa.BigInteger(), nullable=False),
+        sa.Column('disk_used', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('kernel_id', 'bucket', name=op.f('pk_usage_daily')),
+    )
+    op.create_index(op.f('ix_usage_daily_bucket'), 'usage_daily', ['bucket'])
+    op.create_index(op.f('ix_usage_daily_group_id_bucket'), 'usage_daily', ['group_id', 'bucket'])
+
+
+def downgrade():
+    op.drop_index(op.f('ix_usage_daily_group_id_bucket'), table_name='usage_daily')
+    op.drop_index(op.f('ix_usage_daily_bucket'), table_name='usage_daily')
+    op.drop_table('usage_daily')
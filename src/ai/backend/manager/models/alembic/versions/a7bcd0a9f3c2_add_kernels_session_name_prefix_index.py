@@ -0,0 +1,31 @@
+"""add-kernels-session-name-prefix-index
+
+Revision ID: a7bcd0a9f3c2
+Revises: 518ecf41f567
+Create Date: 2026-10-18 10:12:31.502114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7bcd0a9f3c2'
+down_revision = '518ecf41f567'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        op.f('ix_kernels_access_key_session_name_prefix'),
+        'kernels',
+        ['access_key', sa.text('session_name COLLATE "C"')],
+    )
+
+
+def downgrade():
+    op.drop_index(
+        op.f('ix_kernels_access_key_session_name_prefix'),
+        'kernels',
+    )
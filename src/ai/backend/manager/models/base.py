@@ -546,6 +546,33 @@ def privileged_mutation(required_role, target_func=None):
     return wrap
 
 
+def auth_context_invalidating_mutation(scope: str, target_func):
+    """
+    Broadcasts the invalidation of the cached authentication contexts
+    in all manager processes after the decorated mutation succeeds.
+
+    ``scope`` is one of "access_key", "user" (email), and "resource_policy" (name),
+    and ``target_func`` extracts the target key from the mutation arguments.
+    """
+
+    def wrap(func):
+
+        @functools.wraps(func)
+        async def wrapped(cls, root, info, *args, **kwargs):
+            result = await func(cls, root, info, *args, **kwargs)
+            event_dispatcher = info.context.get('event_dispatcher')
+            if event_dispatcher is not None and getattr(result, 'ok', False):
+                await event_dispatcher.broadcast_event(
+                    'auth_context_invalidated',
+                    (scope, target_func(*args, **kwargs)),
+                )
+            return result
+
+        return wrapped
+
+    return wrap
+
+
 async def simple_db_mutate(result_cls, context, mutation_query):
     async with context['dbpool'].acquire() as conn, conn.begin():
         try:
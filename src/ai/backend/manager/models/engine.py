@@ -0,0 +1,297 @@
+from __future__ import annotations
+
+import logging
+import time
+from typing import (
+    Any,
+    Callable,
+    List,
+    MutableMapping,
+    Optional,
+    TypeVar,
+)
+import weakref
+
+import aiopg
+from aiopg.sa import exc
+from aiopg.sa.connection import SAConnection, _distill_params
+from aiopg.sa.engine import Engine as SAEngine
+from aiopg.sa.result import ResultProxy
+import attr
+import sqlalchemy as sa
+from sqlalchemy.engine.interfaces import Compiled
+from sqlalchemy.sql.base import Executable
+
+from ai.backend.common.logging import BraceStyleAdapter
+
+__all__ = (
+    'InstrumentedEngine',
+    'InstrumentedSAConnection',
+    'PoolStats',
+    'ReadReplicaRouter',
+    'cached_statement',
+    'create_engine',
+)
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.manager.models.engine'))
+
+AcquireListener = Callable[[float], None]
+QueryListener = Callable[[Any, float], None]
+TExecutable = TypeVar('TExecutable', bound=Executable)
+
+
+def cached_statement(stmt: TExecutable) -> TExecutable:
+    """
+    Marks a fixed-shape statement so that :class:`InstrumentedEngine` compiles it
+    only once and reuses the compiled SQL string and bind processors afterwards.
+
+    All variable parts of the statement must be bind parameters
+    (e.g., ``sa.bindparam('access_key')``) whose values are passed as a dict
+    when executing it, and the returned statement object itself must be reused
+    (e.g., by keeping it as a module-level constant) to benefit from the cache.
+    """
+    return stmt.execution_options(cache_compiled=True)
+
+
+@attr.s(auto_attribs=True, slots=True)
+class PoolStats:
+    num_waiting: int = 0
+    # measurements since the last reset
+    acquire_count: int = 0
+    acquire_wait_sum: float = 0.0
+    acquire_wait_max: float = 0.0
+    hold_count: int = 0
+    hold_time_sum: float = 0.0
+    hold_time_max: float = 0.0
+    num_slow_queries: int = 0
+
+    def record_acquire(self, wait_time: float) -> None:
+        self.acquire_count += 1
+        self.acquire_wait_sum += wait_time
+        self.acquire_wait_max = max(self.acquire_wait_max, wait_time)
+
+    def record_hold(self, hold_time: float) -> None:
+        self.hold_count += 1
+        self.hold_time_sum += hold_time
+        self.hold_time_max = max(self.hold_time_max, hold_time)
+
+    def reset_window(self) -> None:
+        self.acquire_count = 0
+        self.acquire_wait_sum = 0.0
+        self.acquire_wait_max = 0.0
+        self.hold_count = 0
+        self.hold_time_sum = 0.0
+        self.hold_time_max = 0.0
+        self.num_slow_queries = 0
+
+
+class InstrumentedSAConnection(SAConnection):
+    """
+    An SAConnection which reports the elapsed time of each executed statement
+    to the query listeners of its engine.
+    """
+
+    def __init__(self, connection, engine: InstrumentedEngine) -> None:
+        super().__init__(connection, engine)
+        self._instrumented_engine = engine
+        self._acquired_at = time.perf_counter()
+
+    async def _execute(self, query, *multiparams, **params):
+        started_at = time.perf_counter()
+        try:
+            if (
+                isinstance(query, Executable)
+                and query.get_execution_options().get('cache_compiled', False)
+            ):
+                return await self._execute_cached(query, multiparams, params)
+            return await super()._execute(query, *multiparams, **params)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            engine = self._instrumented_engine
+            if 0 < engine.slow_query_threshold <= elapsed:
+                engine.stats.num_slow_queries += 1
+                log.warning('slow query ({:.3f} sec): {}', elapsed, query)
+            for listener in engine.query_listeners:
+                listener(query, elapsed)
+
+    async def _execute_cached(self, query, multiparams, params) -> ResultProxy:
+        # This mirrors SAConnection._execute() for non-DDL statements,
+        # except that the compiled statement is taken from the engine's cache.
+        compiled = self._instrumented_engine.get_compiled(query)
+        cursor = await self._get_cursor()
+        dp = _distill_params(multiparams, params)
+        if len(dp) > 1:
+            raise exc.ArgumentError("aiopg doesn't support executemany")
+        if dp and not hasattr(dp[0], 'keys'):
+            raise exc.ArgumentError("cached statements accept only named parameters")
+        compiled_params = compiled.construct_params(dp[0] if dp else None)
+        processors = compiled._bind_processors
+        processed_params = {
+            key: (processors[key](value) if key in processors else value)
+            for key, value in compiled_params.items()
+        }
+        await cursor.execute(compiled.string, processed_params)
+        return ResultProxy(self, cursor, self._dialect, compiled._result_columns)
+
+
+class InstrumentedEngine(SAEngine):
+    """
+    An aiopg.sa engine which reports the connection acquisition wait time and
+    the statement execution time to the registered listeners.
+
+    The listeners are plain synchronous callables invoked in the caller's
+    context, so they may use context variables to attribute the measurements
+    to the current API request.
+
+    It also keeps the pool statistics such as the number of waiters,
+    the acquisition wait time, and the connection hold time (which is bounded
+    below by the duration of transactions), and logs the statements slower
+    than ``slow_query_threshold`` seconds (0 to disable).
+
+    The statements marked by :func:`cached_statement` are compiled once per engine.
+    """
+
+    acquire_listeners: List[AcquireListener]
+    query_listeners: List[QueryListener]
+    _compiled_cache: MutableMapping[Executable, Compiled]
+
+    def __init__(self, dialect, pool, dsn, *, slow_query_threshold: float = 0.0) -> None:
+        super().__init__(dialect, pool, dsn)
+        self.slow_query_threshold = slow_query_threshold
+        self.stats = PoolStats()
+        self.acquire_listeners = []
+        self.query_listeners = []
+        self._compiled_cache = weakref.WeakKeyDictionary()
+
+    def get_compiled(self, stmt: Executable) -> Compiled:
+        compiled = self._compiled_cache.get(stmt)
+        if compiled is None:
+            compiled = self._compiled_cache[stmt] = stmt.compile(dialect=self.dialect)
+        return compiled
+
+    async def _acquire(self):
+        started_at = time.perf_counter()
+        self.stats.num_waiting += 1
+        try:
+            raw = await self._pool.acquire()
+        finally:
+            self.stats.num_waiting -= 1
+        elapsed = time.perf_counter() - started_at
+        self.stats.record_acquire(elapsed)
+        for listener in self.acquire_listeners:
+            listener(elapsed)
+        return InstrumentedSAConnection(raw, self)
+
+    def release(self, conn):
+        if isinstance(conn, InstrumentedSAConnection):
+            self.stats.record_hold(time.perf_counter() - conn._acquired_at)
+        return super().release(conn)
+
+
+async def create_engine(
+    dsn: str = None, *,
+    minsize: int = 1,
+    maxsize: int = 10,
+    dialect,
+    timeout: float = aiopg.DEFAULT_TIMEOUT,
+    pool_recycle: float = -1,
+    slow_query_threshold: float = 0.0,
+    **kwargs,
+) -> InstrumentedEngine:
+    """
+    A drop-in replacement of :func:`aiopg.sa.create_engine` which creates
+    an :class:`InstrumentedEngine`.
+    """
+    pool = await aiopg.create_pool(
+        dsn,
+        minsize=minsize, maxsize=maxsize,
+        timeout=timeout, pool_recycle=pool_recycle,
+        **kwargs,
+    )
+    conn = await pool.acquire()
+    try:
+        real_dsn = conn.dsn
+    finally:
+        await pool.release(conn)
+    return InstrumentedEngine(dialect, pool, real_dsn, slow_query_threshold=slow_query_threshold)
+
+
+_replica_status_query = sa.text('''
+SELECT
+    pg_is_in_recovery() AS in_recovery,
+    pg_last_wal_replay_lsn() >= CAST(:primary_lsn AS pg_lsn) AS caught_up,
+    EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) AS replay_delay
+''')
+
+
+class ReadReplicaRouter:
+    """
+    Chooses the engine to run read-only queries.
+
+    If a read replica is configured, read-only queries are routed to it as long as
+    its replication lag measured by :meth:`check_lag` is within ``max_lag`` seconds.
+    Otherwise (including when the lag is not yet measured or the replica is not
+    reachable), they fall back to the primary engine.
+    Writes and read-modify-write transactions must always use the primary engine.
+    """
+
+    lag: Optional[float]
+
+    def __init__(
+        self,
+        primary: InstrumentedEngine,
+        replica: InstrumentedEngine = None,
+        *,
+        max_lag: float = 10.0,
+    ) -> None:
+        self.primary = primary
+        self.replica = replica
+        self.max_lag = max_lag
+        self.lag = None
+
+    @property
+    def readonly(self) -> InstrumentedEngine:
+        if self.replica is not None and self.lag is not None and self.lag <= self.max_lag:
+            return self.replica
+        return self.primary
+
+    async def check_lag(self) -> Optional[float]:
+        """
+        Measures the replication lag of the replica in seconds.
+
+        If the replica has replayed the current WAL position of the primary,
+        the lag is zero.  Otherwise it is the time elapsed since the last replayed
+        transaction, which may over-estimate the lag but never under-estimates it.
+        """
+        if self.replica is None:
+            return None
+        prev_usable = self.replica is self.readonly
+        try:
+            async with self.primary.acquire() as conn:
+                primary_lsn = await conn.scalar(sa.text('SELECT pg_current_wal_lsn()'))
+            async with self.replica.acquire() as conn:
+                result = await conn.execute(
+                    _replica_status_query.bindparams(primary_lsn=str(primary_lsn)),
+                )
+                row = await result.first()
+        except Exception:
+            log.exception('failed to check the replication lag of the read replica')
+            self.lag = None
+        else:
+            if not row['in_recovery'] or row['caught_up']:
+                self.lag = 0.0
+            elif row['replay_delay'] is None:
+                self.lag = None
+            else:
+                self.lag = max(0.0, float(row['replay_delay']))
+        usable = self.replica is self.readonly
+        if usable != prev_usable:
+            if usable:
+                log.info('routing read-only queries to the read replica (lag: {:.3f} sec)',
+                         self.lag)
+            else:
+                log.warning('routing read-only queries to the primary '
+                            '(replica lag: {} sec, max-lag: {} sec)',
+                            'unknown' if self.lag is None else f'{self.lag:.3f}',
+                            self.max_lag)
+        return self.lag
@@ -4,6 +4,7 @@ from collections import OrderedDict
 from datetime import datetime
 from decimal import Decimal
 import enum
+import re
 from typing import (
     Any,
     Dict,
@@ -12,6 +13,7 @@ from typing import (
     Mapping,
     Optional,
     Sequence,
+    Tuple,
     Type,
     TypedDict,
     TypeVar,
@@ -226,6 +228,9 @@ kernels = sa.Table(
              postgresql_where=sa.text(
                  "status NOT IN ('TERMINATED', 'CANCELLED') and "
                  "cluster_role = 'main'")),
+    # for prefix matches of session names with LIKE (see match_session_ids())
+    sa.Index('ix_kernels_access_key_session_name_prefix',
+             'access_key', sa.text('session_name COLLATE "C"')),
 )
 
 session_dependencies = sa.Table(
@@ -255,8 +260,27 @@ class SessionInfo(TypedDict):
     created_at: datetime
 
 
-async def match_session_ids(
-    session_name_or_id: Union[str, UUID],
+_rx_hex_prefix = re.compile(r'^[0-9a-f]{0,32}$')
+
+
+def _uuid_prefix_range(prefix: str) -> Optional[Tuple[UUID, UUID]]:
+    """
+    Convert a (possibly hyphenated) UUID prefix into the inclusive range of UUIDs
+    sharing the prefix, so that prefix matching can use the UUID column indexes.
+    Returns None if the given string cannot be a UUID prefix.
+    """
+    hex_prefix = prefix.replace('-', '').lower()
+    if _rx_hex_prefix.match(hex_prefix) is None:
+        return None
+    return UUID(hex_prefix.ljust(32, '0')), UUID(hex_prefix.ljust(32, 'f'))
+
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+async def _query_matching_sessions(
+    match_conds: Sequence[Tuple[Any, int]],
     access_key: AccessKey,
     *,
     db_connection: SAConnection,
@@ -265,101 +289,116 @@ async def match_session_ids(
     max_matches: int = 10,
 ) -> Sequence[SessionInfo]:
     """
-    Match the prefix of session ID or session name among the sessions that belongs to the given
-    access key, and return the list of session IDs with matching prefixes.
+    Find the sessions having a kernel which satisfies any of the given conditions
+    in a single query, and return the main kernel information of the sessions
+    matched by the condition with the highest priority (lowest number).
     """
-    cond_id = (
-        (sa.sql.expression.cast(kernels.c.id, sa.String).like(f'{session_name_or_id}%')) &
-        (kernels.c.access_key == access_key)
-    )
-    if extra_cond is not None:
-        cond_id = cond_id & extra_cond
-    cond_name = (
-        (kernels.c.session_name.like(f'{session_name_or_id}%')) &
-        (kernels.c.access_key == access_key)
-    )
-    if extra_cond is not None:
-        cond_name = cond_name & extra_cond
-    cond_session_id = (
-        (sa.sql.expression.cast(kernels.c.session_id, sa.String).like(f'{session_name_or_id}%')) &
-        (kernels.c.access_key == access_key)
+    priority = sa.func.min(sa.case(match_conds, else_=len(match_conds)))
+    cond = (
+        (kernels.c.access_key == access_key) &
+        sa.or_(*(match_cond for match_cond, _ in match_conds))
     )
     if extra_cond is not None:
-        cond_session_id = cond_session_id & extra_cond
-    info_cols = [
-        kernels.c.session_id,
-        kernels.c.session_name,
-        kernels.c.status,
-        kernels.c.created_at,
-    ]
-    match_sid_by_id = (
-        sa.select(info_cols, for_update=for_update)
+        cond = cond & extra_cond
+    matched_sessions = (
+        sa.select([kernels.c.session_id, priority.label('priority')])
         .select_from(kernels)
-        .where(
-            (kernels.c.session_id.in_(
-                sa.select(
-                    [kernels.c.session_id]
-                )
-                .select_from(kernels)
-                .where(cond_id)
-                .group_by(kernels.c.session_id)
-                .limit(max_matches).offset(0)
-            )) &
-            (kernels.c.cluster_role == DEFAULT_ROLE)
-        )
-        .order_by(sa.desc(kernels.c.created_at))
+        .where(cond)
+        .group_by(kernels.c.session_id)
+        .order_by(priority)
+        .limit(max_matches).offset(0)
+        .alias('matched_sessions')
     )
-    match_sid_by_name = (
-        sa.select(info_cols, for_update=for_update)
-        .select_from(kernels)
-        .where(
-            (kernels.c.session_id.in_(
-                sa.select(
-                    [kernels.c.session_id]
-                )
-                .select_from(kernels)
-                .where(cond_name)
-                .group_by(kernels.c.session_id)
-                .limit(max_matches).offset(0)
-            )) &
-            (kernels.c.cluster_role == DEFAULT_ROLE)
+    query = (
+        sa.select([
+            kernels.c.session_id,
+            kernels.c.session_name,
+            kernels.c.status,
+            kernels.c.created_at,
+            matched_sessions.c.priority,
+        ])
+        .select_from(
+            kernels.join(matched_sessions, kernels.c.session_id == matched_sessions.c.session_id)
         )
+        .where(kernels.c.cluster_role == DEFAULT_ROLE)
         .order_by(sa.desc(kernels.c.created_at))
     )
-    match_sid_by_session_id = (
-        sa.select(info_cols, for_update=for_update)
-        .select_from(kernels)
-        .where(
-            (kernels.c.session_id.in_(
-                sa.select(
-                    [kernels.c.session_id]
-                )
-                .select_from(kernels)
-                .where(cond_session_id)
-                .group_by(kernels.c.session_id)
-                .limit(max_matches).offset(0)
-            )) &
-            (kernels.c.cluster_role == DEFAULT_ROLE)
-        )
-        .order_by(sa.desc(kernels.c.created_at))
+    if for_update:
+        query = query.with_for_update(of=kernels)
+    result = await db_connection.execute(query)
+    rows = await result.fetchall()
+    if not rows:
+        return []
+    top_priority = min(row['priority'] for row in rows)
+    return [
+        SessionInfo(
+            session_id=row['session_id'],
+            session_name=row['session_name'],
+            status=row['status'],
+            created_at=row['created_at'],
+        ) for row in rows
+        if row['priority'] == top_priority
+    ]
+
+
+async def match_session_ids(
+    session_name_or_id: Union[str, UUID],
+    access_key: AccessKey,
+    *,
+    db_connection: SAConnection,
+    extra_cond=None,
+    for_update: bool = False,
+    max_matches: int = 10,
+) -> Sequence[SessionInfo]:
+    """
+    Match the session ID or session name among the sessions that belongs to the given
+    access key, and return the list of session IDs with matching prefixes.
+
+    The exact matches of the kernel ID, the session ID, and the session name are
+    looked up first in the order.  If there are none, the prefix matches of them are
+    looked up in the same order, using the UUID ranges for the ID prefixes.
+    """
+    full_id: Optional[UUID]
+    if isinstance(session_name_or_id, UUID):
+        full_id = session_name_or_id
+        session_name_or_id = str(session_name_or_id)
+    else:
+        try:
+            full_id = UUID(session_name_or_id)
+        except ValueError:
+            full_id = None
+    exact_conds = []
+    if full_id is not None:
+        exact_conds.append((kernels.c.id == full_id, 0))
+        exact_conds.append((kernels.c.session_id == full_id, 1))
+    exact_conds.append((kernels.c.session_name == session_name_or_id, 2))
+    session_infos = await _query_matching_sessions(
+        exact_conds, access_key,
+        db_connection=db_connection,
+        extra_cond=extra_cond,
+        for_update=for_update,
+        max_matches=max_matches,
+    )
+    if session_infos or full_id is not None:
+        # A full UUID has no other prefix matches than itself.
+        return session_infos
+    prefix_conds = []
+    if (id_range := _uuid_prefix_range(session_name_or_id)) is not None:
+        prefix_conds.append((kernels.c.id.between(*id_range), 3))
+        prefix_conds.append((kernels.c.session_id.between(*id_range), 4))
+    # The C collation lets PostgreSQL use the index on session names for prefix matching.
+    # (LIKE uses the backslash as the default escape character.)
+    prefix_conds.append((
+        sa.collate(kernels.c.session_name, 'C').like(_escape_like(session_name_or_id) + '%'),
+        5,
+    ))
+    return await _query_matching_sessions(
+        prefix_conds, access_key,
+        db_connection=db_connection,
+        extra_cond=extra_cond,
+        for_update=for_update,
+        max_matches=max_matches,
     )
-    for match_query in [
-        match_sid_by_id,
-        match_sid_by_session_id,
-        match_sid_by_name,
-    ]:
-        result = await db_connection.execute(match_query)
-        if result.rowcount == 0:
-            continue
-        return [
-            SessionInfo(
-                session_id=row['session_id'],
-                session_name=row['session_name'],
-                status=row['status'],
-                created_at=row['created_at'],
-            ) for row in await result.fetchall()
-        ]
-    return []
 
 
 async def get_main_kernels(
@@ -33,6 +33,7 @@ from ai.backend.common.types import (
 
 from .base import (
     ForeignKeyIDColumn,
+    auth_context_invalidating_mutation,
     Item,
     PaginatedList,
     metadata,
@@ -434,6 +435,7 @@ class ModifyKeyPair(graphene.Mutation):
     msg = graphene.String()
 
     @classmethod
+    @auth_context_invalidating_mutation('access_key', lambda access_key, **kwargs: access_key)
     async def mutate(cls, root, info, access_key, props):
         data = {}
         set_if_set(props, data, 'is_active')
@@ -459,6 +461,7 @@ class DeleteKeyPair(graphene.Mutation):
     msg = graphene.String()
 
     @classmethod
+    @auth_context_invalidating_mutation('access_key', lambda access_key, **kwargs: access_key)
     async def mutate(cls, root, info, access_key):
         delete_query = (
             keypairs.delete()
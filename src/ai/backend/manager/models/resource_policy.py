@@ -10,6 +10,7 @@ from ai.backend.common.logging import BraceStyleAdapter
 from ai.backend.common.types import DefaultForUnspecified, ResourceSlot
 from .base import (
     metadata, BigInt, EnumType, ResourceSlotColumn,
+    auth_context_invalidating_mutation,
     simple_db_mutate,
     simple_db_mutate_returning_item,
     set_if_set,
@@ -219,6 +220,7 @@ class ModifyKeyPairResourcePolicy(graphene.Mutation):
     msg = graphene.String()
 
     @classmethod
+    @auth_context_invalidating_mutation('resource_policy', lambda name, **kwargs: name)
     async def mutate(cls, root, info, name, props):
         data = {}
         set_if_set(props, data, 'default_for_unspecified',
@@ -249,6 +251,7 @@ class DeleteKeyPairResourcePolicy(graphene.Mutation):
     msg = graphene.String()
 
     @classmethod
+    @auth_context_invalidating_mutation('resource_policy', lambda name, **kwargs: name)
     async def mutate(cls, root, info, name):
         delete_query = (
             keypair_resource_policies.delete()
@@ -0,0 +1,37 @@
+import sqlalchemy as sa
+
+from .base import metadata, GUID
+
+__all__ = (
+    'usage_daily',
+    'USAGE_COUNTER_FIELDS',
+    'USAGE_GAUGE_FIELDS',
+)
+
+
+# the increments of the cumulative counters within each bucket
+USAGE_COUNTER_FIELDS = ('cpu_used', 'io_read', 'io_write')
+# the peaks of the gauges observed within each bucket
+USAGE_GAUGE_FIELDS = ('mem_used', 'disk_used')
+
+
+# The per-kernel usage aggregated by the usage rollup job of the manager
+# (see ai.backend.manager.usage) in days of the system timezone.
+usage_daily = sa.Table(
+    'usage_daily', metadata,
+    sa.Column('kernel_id', GUID, primary_key=True),
+    sa.Column('bucket', sa.DateTime(timezone=True), primary_key=True),
+    sa.Column('session_id', GUID, nullable=False),
+    sa.Column('domain_name', sa.String(length=64), nullable=False),
+    sa.Column('group_id', GUID, nullable=False),
+    sa.Column('user_uuid', GUID, nullable=False),
+    sa.Column('access_key', sa.String(length=20), nullable=True),
+    sa.Column('used_seconds', sa.Float, nullable=False, default=0),
+    sa.Column('cpu_used', sa.Float, nullable=False, default=0),
+    sa.Column('io_read', sa.BigInteger, nullable=False, default=0),
+    sa.Column('io_write', sa.BigInteger, nullable=False, default=0),
+    sa.Column('mem_used', sa.BigInteger, nullable=False, default=0),
+    sa.Column('disk_used', sa.BigInteger, nullable=False, default=0),
+    sa.Index('ix_usage_daily_bucket', 'bucket'),
+    sa.Index('ix_usage_daily_group_id_bucket', 'group_id', 'bucket'),
+)
@@ -25,6 +25,7 @@ from sqlalchemy.types import TypeDecorator, VARCHAR
 from ai.backend.common.logging import BraceStyleAdapter
 from .base import (
     EnumValueType,
+    auth_context_invalidating_mutation,
     IDColumn,
     Item,
     PaginatedList,
@@ -504,6 +505,7 @@ class ModifyUser(graphene.Mutation):
     user = graphene.Field(lambda: User)
 
     @classmethod
+    @auth_context_invalidating_mutation('user', lambda email, **kwargs: email)
     async def mutate(cls, root, info, email, props):
         async with info.context['dbpool'].acquire() as conn, conn.begin():
 
@@ -647,6 +649,7 @@ class DeleteUser(graphene.Mutation):
     msg = graphene.String()
 
     @classmethod
+    @auth_context_invalidating_mutation('user', lambda email, **kwargs: email)
     async def mutate(cls, root, info, email):
         async with info.context['dbpool'].acquire() as conn, conn.begin():
             try:
@@ -703,6 +706,7 @@ class PurgeUser(graphene.Mutation):
     msg = graphene.String()
 
     @classmethod
+    @auth_context_invalidating_mutation('user', lambda email, **kwargs: email)
     async def mutate(cls, root, info, email, props):
         purge_shared_vfolders = props.purge_shared_vfolders if props.purge_shared_vfolders else False
         async with info.context['dbpool'].acquire() as conn, conn.begin():
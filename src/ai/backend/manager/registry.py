@@ -2,9 +2,10 @@ from __future__ import annotations
 
 import asyncio
 from contextvars import ContextVar
-from collections import defaultdict
+from collections import OrderedDict, defaultdict
 import copy
 from datetime import datetime
+import functools
 import itertools
 import logging
 import secrets
@@ -12,14 +13,18 @@ import time
 from typing import (
     Any,
     AsyncIterator,
+    Awaitable,
     Callable,
     Container,
+    DefaultDict,
     Dict,
+    Final,
     List,
     Mapping,
     MutableMapping,
     Optional,
     Sequence,
+    Set,
     Tuple,
     TYPE_CHECKING,
     Union,
@@ -36,6 +41,8 @@ if TYPE_CHECKING:
     from aiopg.sa.result import RowProxy
 import aiotools
 from aioredis import Redis
+from aiopg.sa.engine import Engine as SAEngine
+import attr
 from async_timeout import timeout as _timeout
 from callosum.rpc import Peer, RPCUserError
 from callosum.lower.zeromq import ZeroMQAddress, ZeroMQRPCTransport
@@ -105,6 +112,7 @@ from .models import (
     USER_RESOURCE_OCCUPYING_KERNEL_STATUSES,
     DEAD_KERNEL_STATUSES,
 )
+from .models.engine import cached_statement
 from .models.kernel import match_session_ids, get_all_kernels, get_main_kernels
 from .models.utils import reenter_txn
 if TYPE_CHECKING:
@@ -123,6 +131,62 @@ log = BraceStyleAdapter(logging.getLogger('ai.backend.manager.registry'))
 
 agent_peers: MutableMapping[str, zmq.asyncio.Socket] = {}  # agent-addr to socket
 
+_increment_session_usage_query: Final = cached_statement(
+    sa.update(kernels)
+    .values(num_queries=kernels.c.num_queries + 1)
+    .where(
+        (kernels.c.session_name == sa.bindparam('session_name')) &
+        (kernels.c.access_key == sa.bindparam('access_key')) &
+        (kernels.c.cluster_role == DEFAULT_ROLE)
+    )
+)
+_heartbeat_agent_query: Final = cached_statement(
+    sa.select([
+        agents.c.status,
+        agents.c.addr,
+        agents.c.scaling_group,
+        agents.c.available_slots,
+    ], for_update=True)
+    .select_from(agents)
+    .where(agents.c.id == sa.bindparam('agent_id'))
+)
+
+
+@functools.lru_cache(maxsize=64)
+def _get_kernel_query(field, allow_stale: bool) -> sa.sql.Select:
+    """
+    Build the query used by :meth:`AgentRegistry.get_kernel()` once per distinct
+    combination of the (hashable) field specification and the staleness option.
+    """
+    cols = [kernels.c.id, kernels.c.session_id,
+            kernels.c.agent_addr, kernels.c.kernel_host, kernels.c.access_key]
+    if field == '*':
+        cols = [sa.text('*')]
+    elif isinstance(field, tuple):
+        cols.extend(field)
+    elif isinstance(field, (sa.Column, sa.sql.elements.ColumnClause)):
+        cols.append(field)
+    elif isinstance(field, str):
+        cols.append(sa.column(field))
+    if allow_stale:
+        query = (
+            sa.select(cols)
+            .select_from(kernels)
+            .where(kernels.c.id == sa.bindparam('kernel_id'))
+            .limit(1).offset(0))
+    else:
+        query = (
+            sa.select(cols)
+            .select_from(kernels.join(agents))
+            .where(
+                (kernels.c.id == sa.bindparam('kernel_id')) &
+                ~(kernels.c.status.in_(DEAD_KERNEL_STATUSES)) &
+                (agents.c.status == AgentStatus.ALIVE) &
+                (agents.c.id == kernels.c.agent)
+            )
+            .limit(1).offset(0))
+    return cached_statement(query)
+
 
 class PeerInvoker(Peer):
 
@@ -196,6 +260,172 @@ async def cleanup_agent_peers():
     await asyncio.gather(*closing_tasks, return_exceptions=True)
 
 
+@attr.s(auto_attribs=True, slots=True, frozen=True)
+class SessionRoute:
+    """
+    The information required to route requests to the main kernel of a session.
+    """
+    kernel_id: KernelId
+    session_id: SessionId
+    agent: AgentId
+    agent_addr: str
+    kernel_host: Optional[str]
+    repl_in_port: int
+    repl_out_port: int
+    stdin_port: int
+    stdout_port: int
+    service_ports: Any
+
+    @classmethod
+    def from_row(cls, row: Mapping[str, Any]) -> SessionRoute:
+        return cls(
+            kernel_id=row['id'],
+            session_id=row['session_id'],
+            agent=row['agent'],
+            agent_addr=row['agent_addr'],
+            kernel_host=row['kernel_host'],
+            repl_in_port=row['repl_in_port'],
+            repl_out_port=row['repl_out_port'],
+            stdin_port=row['stdin_port'],
+            stdout_port=row['stdout_port'],
+            service_ports=row['service_ports'],
+        )
+
+
+class SessionRoutingCache:
+    """
+    A per-process TTL/LRU cache of the session routes keyed by the pair of
+    the access key and the exact session name (or ID) given by API requests,
+    so that repeated execute/stream requests to the same session do not have to
+    look up the database every time.
+
+    Entries are invalidated via the kernel/session lifecycle events received by
+    all manager processes and upon RPC failures, while the TTL bounds the
+    staleness caused by missed events.
+    """
+
+    _entries: OrderedDict[Tuple[str, str], Tuple[float, SessionRoute]]
+    _session_keys: DefaultDict[uuid.UUID, Set[Tuple[str, str]]]
+
+    def __init__(self, ttl: float = 30.0, maxsize: int = 16384) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._session_keys = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, access_key: str, session_name_or_id: str) -> Optional[SessionRoute]:
+        key = (access_key, session_name_or_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, route = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return route
+
+    def put(self, access_key: str, session_name_or_id: str, route: SessionRoute) -> None:
+        if self.ttl <= 0:
+            return
+        key = (access_key, session_name_or_id)
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, route)
+        self._session_keys[route.session_id].add(key)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate_session(self, session_id: uuid.UUID) -> None:
+        for key in self._session_keys.pop(session_id, set()):
+            self._entries.pop(key, None)
+
+    def _remove(self, key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        session_id = entry[1].session_id
+        keys = self._session_keys.get(session_id)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._session_keys[session_id]
+
+
+class SessionUsageBuffer:
+    """
+    Accumulates the "num_queries" statistics of sessions in memory and writes them
+    to the database in batches, instead of updating the kernel rows on every
+    execute/stream API request.
+    """
+
+    _usage: Dict[Tuple[str, str], int]
+
+    def __init__(self, batch_size: int = 500) -> None:
+        self.batch_size = batch_size
+        self._usage = {}
+
+    def __len__(self) -> int:
+        return len(self._usage)
+
+    def record(self, session_name: str, access_key: str) -> None:
+        key = (session_name, access_key)
+        self._usage[key] = self._usage.get(key, 0) + 1
+
+    async def flush(self, dbpool: SAEngine) -> None:
+        usage, self._usage = self._usage, {}
+        items = iter(usage.items())
+        while batch := dict(itertools.islice(items, self.batch_size)):
+            query = (
+                sa.update(kernels)
+                .values(num_queries=kernels.c.num_queries + sa.case(
+                    [
+                        (
+                            (kernels.c.session_name == session_name) &
+                            (kernels.c.access_key == access_key),
+                            count,
+                        )
+                        for (session_name, access_key), count in batch.items()
+                    ],
+                    else_=0,
+                ))
+                .where(
+                    sa.tuple_(kernels.c.session_name, kernels.c.access_key).in_(list(batch.keys())) &
+                    (kernels.c.cluster_role == DEFAULT_ROLE)
+                )
+            )
+            try:
+                async with dbpool.acquire() as conn:
+                    await conn.execute(query)
+            except Exception:
+                log.exception('failed to write session usage statistics; will retry later')
+                self._restore(batch)
+                self._restore(dict(items))
+                return
+
+    def _restore(self, usage: Mapping[Tuple[str, str], int]) -> None:
+        for key, count in usage.items():
+            self._usage[key] = self._usage.get(key, 0) + count
+
+
+async def invalidate_session_route(
+    registry: AgentRegistry,
+    agent_id: AgentId,
+    event_name: str,
+    raw_id: str,
+    *args,
+) -> None:
+    """
+    Invalidate the cached route of a session upon its lifecycle events.
+    Since the main kernel ID is same to the session ID, the kernel-level events
+    are handled in the same way.
+    """
+    if registry.session_route_cache is not None:
+        registry.session_route_cache.invalidate_session(uuid.UUID(raw_id))
+
+
 class AgentRegistry:
     """
     Provide a high-level API to create, destroy, and query the computation
@@ -218,6 +448,9 @@ class AgentRegistry:
         event_dispatcher: EventDispatcher,
         storage_manager:  StorageSessionManager,
         hook_plugin_ctx: HookPluginContext,
+        *,
+        session_route_cache: SessionRoutingCache = None,
+        session_usage_buffer: SessionUsageBuffer = None,
     ) -> None:
         self.shared_config = shared_config
         self.docker = aiodocker.Docker()
@@ -230,6 +463,8 @@ class AgentRegistry:
         self.hook_plugin_ctx = hook_plugin_ctx
         self.kernel_creation_tracker = {}
         self._post_kernel_creation_tasks = {}
+        self.session_route_cache = session_route_cache
+        self.session_usage_buffer = session_usage_buffer
 
     async def init(self) -> None:
         self.heartbeat_lock = asyncio.Lock()
@@ -286,6 +521,10 @@ class AgentRegistry:
                 await storage_resp.json(), HardwareMetadata,  # type: ignore  # (python/mypy#9827)
             )
 
+    def _invalidate_session_route(self, session_id: Union[str, SessionId]) -> None:
+        if self.session_route_cache is not None and isinstance(session_id, uuid.UUID):
+            self.session_route_cache.invalidate_session(session_id)
+
     @aiotools.actxmgr
     async def handle_kernel_exception(
         self,
@@ -305,6 +544,7 @@ class AgentRegistry:
             'upload_file': KernelExecutionFailed,
             'download_file': KernelExecutionFailed,
             'list_files': KernelExecutionFailed,
+            'stat_file': KernelExecutionFailed,
             'get_logs_from_agent': KernelExecutionFailed,
             'refresh_session': KernelExecutionFailed,
         }
@@ -313,6 +553,7 @@ class AgentRegistry:
         try:
             yield
         except asyncio.TimeoutError:
+            self._invalidate_session_route(session_id)
             if set_error:
                 await self.set_session_status(
                     session_id,
@@ -328,6 +569,7 @@ class AgentRegistry:
                 await cancellation_callback()
             raise
         except AgentError as e:
+            self._invalidate_session_route(session_id)
             if set_error:
                 await self.set_session_status(
                     session_id,
@@ -350,6 +592,7 @@ class AgentRegistry:
             # silently re-raise to make them handled by gateway http handlers
             raise
         except Exception as e:
+            self._invalidate_session_route(session_id)
             if set_error:
                 await self.set_session_status(
                     session_id,
@@ -384,35 +627,11 @@ class AgentRegistry:
         If ``allow_stale`` is true, it skips checking validity of the kernel
         owner instance.
         """
-        cols = [kernels.c.id, kernels.c.session_id,
-                kernels.c.agent_addr, kernels.c.kernel_host, kernels.c.access_key]
-        if field == '*':
-            cols = [sa.text('*')]
-        elif isinstance(field, (tuple, list)):
-            cols.extend(field)
-        elif isinstance(field, (sa.Column, sa.sql.elements.ColumnClause)):
-            cols.append(field)
-        elif isinstance(field, str):
-            cols.append(sa.column(field))
+        if isinstance(field, list):
+            field = tuple(field)
+        query = _get_kernel_query(field, allow_stale)
         async with reenter_txn(self.dbpool, db_connection) as conn:
-            if allow_stale:
-                query = (
-                    sa.select(cols)
-                    .select_from(kernels)
-                    .where(kernels.c.id == kern_id)
-                    .limit(1).offset(0))
-            else:
-                query = (
-                    sa.select(cols)
-                    .select_from(kernels.join(agents))
-                    .where(
-                        (kernels.c.id == kern_id) &
-                        ~(kernels.c.status.in_(DEAD_KERNEL_STATUSES)) &
-                        (agents.c.status == AgentStatus.ALIVE) &
-                        (agents.c.id == kernels.c.agent)
-                    )
-                    .limit(1).offset(0))
-            result = await conn.execute(query)
+            result = await conn.execute(query, {'kernel_id': kern_id})
             row = await result.first()
             if row is None:
                 raise SessionNotFound
@@ -626,6 +845,32 @@ class AgentRegistry:
             )
             return kernel_list[0]
 
+    async def get_session_route(
+        self,
+        session_name_or_id: Union[str, uuid.UUID],
+        access_key: Union[str, AccessKey],
+    ) -> SessionRoute:
+        """
+        Retrieve the routing information of the main kernel of an active session,
+        using the per-process routing cache if available.
+
+        Only the exact session names and IDs are cached, because the sessions
+        matched by a name or ID prefix may change as new sessions are created.
+        """
+        cache_key = str(session_name_or_id)
+        if self.session_route_cache is not None:
+            route = self.session_route_cache.get(access_key, cache_key)
+            if route is not None:
+                return route
+        kernel = await self.get_session(session_name_or_id, access_key)
+        route = SessionRoute.from_row(kernel)
+        if (
+            self.session_route_cache is not None
+            and cache_key in (kernel['session_name'], str(kernel['session_id']), str(kernel['id']))
+        ):
+            self.session_route_cache.put(access_key, cache_key, route)
+        return route
+
     async def get_session_kernels(
         self,
         session_id: str,
@@ -795,6 +1040,7 @@ class AgentRegistry:
         mounts = determined_mounts
 
         ids = []
+        kernel_owners = []
         is_multicontainer = cluster_size > 1
         if is_multicontainer:
             if len(kernel_enqueue_configs) == 1:
@@ -1036,6 +1282,17 @@ class AgentRegistry:
                 })
                 await conn.execute(query)
                 ids.append(kernel_id)
+                kernel_owners.append({
+                    'id': kernel_id,
+                    'session_id': session_id,
+                    'session_name': session_name,
+                    'access_key': access_key,
+                    'cluster_role': kernel['cluster_role'],
+                    'cluster_idx': kernel['cluster_idx'],
+                    'domain_name': domain_name,
+                    'group_id': group_id,
+                    'user_uuid': user_uuid,
+                })
 
         await self.hook_plugin_ctx.notify(
             'POST_ENQUEUE_SESSION',
@@ -1044,6 +1301,7 @@ class AgentRegistry:
         await self.event_dispatcher.produce_event(
             'session_enqueued',
             (str(session_id), session_creation_id, ),
+            kernel_owners=kernel_owners,
         )
         return session_id
 
@@ -1835,26 +2093,83 @@ class AgentRegistry:
         *,
         flush_timeout: float = None,
     ) -> Mapping[str, Any]:
-        kernel = await self.get_session(session_name_or_id, access_key)
-        async with self.handle_kernel_exception('execute', kernel['id'], access_key):
+        route = await self.get_session_route(session_name_or_id, access_key)
+        async with self.handle_kernel_exception('execute', route.kernel_id, access_key):
             # The agent aggregates at most 2 seconds of outputs
             # if the kernel runs for a long time.
             major_api_version = api_version[0]
             if major_api_version == 4:  # manager-agent protocol is same.
                 major_api_version = 3
             async with RPCContext(
-                kernel['agent'],
-                kernel['agent_addr'],
+                route.agent,
+                route.agent_addr,
                 30,
-                order_key=kernel['id'],
+                order_key=route.kernel_id,
             ) as rpc:
                 return await rpc.call.execute(
-                    str(kernel['id']),
+                    str(route.kernel_id),
                     major_api_version,
                     run_id, mode, code, opts,
                     flush_timeout,
                 )
 
+    async def execute_stream(
+        self,
+        session_name_or_id: Union[str, SessionId],
+        access_key: AccessKey,
+        api_version: Tuple[int, str],
+        run_id: str,
+        mode: str,
+        code: str,
+        opts: Mapping[str, Any],
+        *,
+        read_input: Callable[[], Awaitable[str]],
+        flush_timeout: float = 0.05,
+        call_timeout: float = 30,
+    ) -> AsyncIterator[Mapping[str, Any]]:
+        """
+        Runs a code execution until it finishes and yields the results flushed by
+        the agent as they arrive.
+
+        Unlike repeating :meth:`execute` with the "continue" mode, the session route
+        and the RPC context of the agent are resolved only once per run.
+        When the kernel waits for user inputs, ``read_input`` is awaited to get them.
+        """
+        route = await self.get_session_route(session_name_or_id, access_key)
+        major_api_version = api_version[0]
+        if major_api_version == 4:  # manager-agent protocol is same.
+            major_api_version = 3
+        opts = dict(opts)
+        async with self.handle_kernel_exception('execute', route.kernel_id, access_key):
+            async with RPCContext(
+                route.agent,
+                route.agent_addr,
+                None,
+                order_key=route.kernel_id,
+            ) as rpc:
+                while True:
+                    with _timeout(call_timeout):
+                        result = await rpc.call.execute(
+                            str(route.kernel_id),
+                            major_api_version,
+                            run_id, mode, code, opts,
+                            flush_timeout,
+                        )
+                    if result is None:
+                        status = 'continued'
+                    else:
+                        yield result
+                        status = result['status']
+                    if status == 'finished':
+                        break
+                    elif status == 'waiting-input':
+                        mode = 'input'
+                        code = await read_input()
+                    else:
+                        mode = 'continue'
+                        code = ''
+                    opts = {}
+
     async def execute_batch(
         self,
         session_id: SessionId,
@@ -1892,15 +2207,15 @@ class AgentRegistry:
         session_name_or_id: Union[str, SessionId],
         access_key: AccessKey,
     ) -> Mapping[str, Any]:
-        kernel = await self.get_session(session_name_or_id, access_key)
-        async with self.handle_kernel_exception('execute', kernel['id'], access_key):
+        route = await self.get_session_route(session_name_or_id, access_key)
+        async with self.handle_kernel_exception('execute', route.kernel_id, access_key):
             async with RPCContext(
-                kernel['agent'],
-                kernel['agent_addr'],
+                route.agent,
+                route.agent_addr,
                 30,
-                order_key=kernel['id'],
+                order_key=route.kernel_id,
             ) as rpc:
-                return await rpc.call.interrupt_kernel(str(kernel['id']))
+                return await rpc.call.interrupt_kernel(str(route.kernel_id))
 
     async def get_completions(
         self,
@@ -1910,15 +2225,15 @@ class AgentRegistry:
         text: str,
         opts: Mapping[str, Any],
     ) -> Mapping[str, Any]:
-        kernel = await self.get_session(session_name_or_id, access_key)
-        async with self.handle_kernel_exception('execute', kernel['id'], access_key):
+        route = await self.get_session_route(session_name_or_id, access_key)
+        async with self.handle_kernel_exception('execute', route.kernel_id, access_key):
             async with RPCContext(
-                kernel['agent'],
-                kernel['agent_addr'],
+                route.agent,
+                route.agent_addr,
                 10,
-                order_key=kernel['id'],
+                order_key=route.kernel_id,
             ) as rpc:
-                return await rpc.call.get_completions(str(kernel['id']), mode, text, opts)
+                return await rpc.call.get_completions(str(route.kernel_id), mode, text, opts)
 
     async def start_service(
         self,
@@ -1987,6 +2302,114 @@ class AgentRegistry:
             ) as rpc:
                 return await rpc.call.download_file(str(kernel['id']), filepath)
 
+    async def stat_file(
+        self,
+        session_name_or_id: Union[str, SessionId],
+        access_key: AccessKey,
+        filepath: str,
+    ) -> Mapping[str, Any]:
+        """
+        Returns the size of a file in the main kernel of the session.
+        """
+        route = await self.get_session_route(session_name_or_id, access_key)
+        async with self.handle_kernel_exception('stat_file', route.kernel_id, access_key):
+            async with RPCContext(
+                route.agent,
+                route.agent_addr,
+                30,
+                order_key=route.kernel_id,
+            ) as rpc:
+                return await rpc.call.stat_file(str(route.kernel_id), filepath)
+
+    async def upload_file_chunks(
+        self,
+        session_name_or_id: Union[str, SessionId],
+        access_key: AccessKey,
+        filename: str,
+        offset: int,
+        chunks: AsyncIterator[bytes],
+        *,
+        call_timeout: float = 30,
+    ) -> int:
+        """
+        Writes the chunks to a file in the main kernel of the session sequentially
+        from the given offset, and returns the offset after the last written chunk.
+        Writing at offset zero truncates the existing file.
+
+        Each chunk is sent as a separate RPC call as soon as it is read from the
+        iterator, so only a single chunk is kept in memory at a time.
+        """
+        route = await self.get_session_route(session_name_or_id, access_key)
+        async with self.handle_kernel_exception('upload_file', route.kernel_id, access_key):
+            async with RPCContext(
+                route.agent,
+                route.agent_addr,
+                None,
+                order_key=route.kernel_id,
+            ) as rpc:
+                async for chunk in chunks:
+                    with _timeout(call_timeout):
+                        await rpc.call.upload_file_chunk(
+                            str(route.kernel_id), filename, offset, chunk)
+                    offset += len(chunk)
+        return offset
+
+    async def truncate_file(
+        self,
+        session_name_or_id: Union[str, SessionId],
+        access_key: AccessKey,
+        filepath: str,
+        size: int,
+    ) -> None:
+        """
+        Truncates a file in the main kernel of the session to the given size,
+        creating an empty file if it does not exist.
+        """
+        route = await self.get_session_route(session_name_or_id, access_key)
+        async with self.handle_kernel_exception('upload_file', route.kernel_id, access_key):
+            async with RPCContext(
+                route.agent,
+                route.agent_addr,
+                30,
+                order_key=route.kernel_id,
+            ) as rpc:
+                await rpc.call.truncate_file(str(route.kernel_id), filepath, size)
+
+    async def download_file_chunks(
+        self,
+        session_name_or_id: Union[str, SessionId],
+        access_key: AccessKey,
+        filepath: str,
+        offset: int,
+        length: int,
+        *,
+        chunk_size: int,
+        call_timeout: float = 30,
+    ) -> AsyncIterator[bytes]:
+        """
+        Reads the given range of a file in the main kernel of the session
+        and yields it in chunks of at most ``chunk_size`` bytes.
+        """
+        route = await self.get_session_route(session_name_or_id, access_key)
+        end = offset + length
+        async with self.handle_kernel_exception('download_file', route.kernel_id, access_key):
+            async with RPCContext(
+                route.agent,
+                route.agent_addr,
+                None,
+                order_key=route.kernel_id,
+            ) as rpc:
+                while offset < end:
+                    with _timeout(call_timeout):
+                        chunk = await rpc.call.download_file_chunk(
+                            str(route.kernel_id), filepath,
+                            offset, min(chunk_size, end - offset))
+                    if not chunk:
+                        # the file is truncated while reading.
+                        break
+                    yield chunk
+                    offset += len(chunk)
+
     async def list_files(
         self,
         session_name_or_id: Union[str, SessionId],
@@ -2024,17 +2447,23 @@ class AgentRegistry:
         access_key: AccessKey,
         conn: SAConnection = None,
     ) -> None:
+        """
+        Count a query to the given session.
+        If the session usage buffer is configured, the count is written to the database
+        later by :meth:`flush_session_usage()`.
+        """
+        if self.session_usage_buffer is not None and conn is None:
+            self.session_usage_buffer.record(session_name, access_key)
+            return
         async with reenter_txn(self.dbpool, conn) as conn:
-            query = (
-                sa.update(kernels)
-                .values(num_queries=kernels.c.num_queries + 1)
-                .where(
-                    (kernels.c.session_name == session_name) &
-                    (kernels.c.access_key == access_key) &
-                    (kernels.c.cluster_role == DEFAULT_ROLE)
-                )
-            )
-            await conn.execute(query)
+            await conn.execute(_increment_session_usage_query, {
+                'session_name': session_name,
+                'access_key': access_key,
+            })
+
+    async def flush_session_usage(self) -> None:
+        if self.session_usage_buffer is not None:
+            await self.session_usage_buffer.flush(self.dbpool)
 
     async def kill_all_sessions_in_agent(self, agent_id, agent_addr):
         async with RPCContext(agent_id, agent_addr, None) as rpc:
@@ -2065,17 +2494,7 @@ class AgentRegistry:
 
             # Check and update status of the agent record in DB
             async with self.dbpool.acquire() as conn, conn.begin():
-                query = (
-                    sa.select([
-                        agents.c.status,
-                        agents.c.addr,
-                        agents.c.scaling_group,
-                        agents.c.available_slots,
-                    ], for_update=True)
-                    .select_from(agents)
-                    .where(agents.c.id == agent_id)
-                )
-                result = await conn.execute(query)
+                result = await conn.execute(_heartbeat_agent_query, {'agent_id': agent_id})
                 row = await result.first()
 
                 slot_key_and_units = {
@@ -16,6 +16,7 @@ class BackgroundTaskEventArgs:
     message: Optional[str] = None
     current_progress: Optional[Union[int, float]] = None
     total_progress: Optional[Union[int, float]] = None
+    event_id: Optional[str] = None  # the entry ID in the per-task event stream
 
 
 class SessionGetter(Protocol):
@@ -0,0 +1,359 @@
+from __future__ import annotations
+
+from datetime import datetime, time, timedelta, tzinfo
+import logging
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    TYPE_CHECKING,
+)
+
+from aiopg.sa.connection import SAConnection
+import aioredis
+import aioredlock
+from dateutil.parser import isoparse
+from dateutil.tz import tzutc
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql as pgsql
+
+from ai.backend.common import msgpack, redis
+from ai.backend.common.logging import BraceStyleAdapter
+from ai.backend.common.types import aobject, AgentId
+from ai.backend.common.utils import nmget
+
+from .distributed import GlobalTimer
+from .models import (
+    kernels, usage_daily,
+    KernelStatus,
+    LIVE_STATUS,
+    USAGE_COUNTER_FIELDS, USAGE_GAUGE_FIELDS,
+)
+from ..gateway.defs import REDIS_STREAM_DB
+if TYPE_CHECKING:
+    from ..gateway.config import LocalConfig, SharedConfig
+    from ..gateway.events import EventDispatcher
+    from .registry import AgentRegistry
+
+__all__ = (
+    'UsageRollup',
+    'build_usage_rows',
+    'read_usage_stat',
+)
+
+log = BraceStyleAdapter(logging.getLogger('ai.backend.manager.usage'))
+
+WATERMARK_KEY = 'manager/usage-rollup/watermark'
+# Re-scan the kernels terminated shortly before the watermark
+# to tolerate the clock skews among the manager nodes.
+WATERMARK_MARGIN = timedelta(minutes=10)
+ROLLUP_BATCH_SIZE = 500
+ROLLUP_INSERT_SIZE = 1000
+
+BucketFunc = Callable[[datetime, tzinfo], datetime]
+
+
+def floor_day(dt: datetime, tz: tzinfo) -> datetime:
+    return datetime.combine(dt.astimezone(tz).date(), time(0), tzinfo=tz)
+
+
+def next_day(bucket: datetime, tz: tzinfo) -> datetime:
+    return datetime.combine(bucket.astimezone(tz).date() + timedelta(days=1), time(0), tzinfo=tz)
+
+
+def read_usage_stat(stat: Optional[Mapping[str, Any]]) -> Dict[str, Any]:
+    """
+    Extracts the usage values to roll up from the kernel statistics
+    (``last_stat`` of terminated kernels or the live statistics in Redis).
+    """
+    return {
+        'cpu_used': float(nmget(stat, 'cpu_used.current', 0)),
+        'io_read': int(nmget(stat, 'io_read.current', 0)),
+        'io_write': int(nmget(stat, 'io_write.current', 0)),
+        'mem_used': int(nmget(stat, 'mem.capacity', 0)),
+        'disk_used': int(nmget(stat, 'io_scratch_size/stats.max', 0, '/')),
+    }
+
+
+def build_usage_rows(
+    kernel: Mapping[str, Any],
+    usage: Mapping[str, Any],
+    rolled_up: Optional[Mapping[str, Any]],
+    now: datetime,
+    tz: tzinfo,
+    floor_bucket: BucketFunc,
+    next_bucket: BucketFunc,
+) -> List[Dict[str, Any]]:
+    """
+    Builds the rollup rows of a kernel to upsert, from the last bucket rolled up
+    previously (or the creation time) to the bucket of the termination time
+    (or the current time for live kernels).
+
+    The used seconds of the buckets are recalculated, while the increments of
+    the counters since the previous rollup are spread over the buckets in proportion
+    to the used seconds after the end of the previous rollup.  As the buckets are
+    contiguous, the previous rollup ended at the creation time plus the sum of
+    the used seconds rolled up.
+    """
+    started = kernel['created_at']
+    ended = max(started, kernel['terminated_at'] or now)
+    counted_until = started
+    if rolled_up is not None:
+        counted_until = min(ended, started + timedelta(seconds=rolled_up['used_seconds']))
+    bucket = floor_bucket(started, tz)
+    if rolled_up is not None and rolled_up['last_bucket'] > bucket:
+        bucket = rolled_up['last_bucket']
+    last_bucket = max(bucket, floor_bucket(ended, tz))
+    common = {
+        'kernel_id': kernel['id'],
+        'session_id': kernel['session_id'],
+        'domain_name': kernel['domain_name'],
+        'group_id': kernel['group_id'],
+        'user_uuid': kernel['user_uuid'],
+        'access_key': kernel['access_key'],
+    }
+    rows = []
+    weights = []
+    while bucket <= last_bucket:
+        bucket_end = next_bucket(bucket, tz)
+        used_seconds = (min(ended, bucket_end) - max(started, bucket)).total_seconds()
+        weights.append(max((min(ended, bucket_end) - max(counted_until, bucket)).total_seconds(), 0.0))
+        rows.append({
+            **common,
+            'bucket': bucket,
+            'used_seconds': max(used_seconds, 0.0),
+            **{field: 0 for field in USAGE_COUNTER_FIELDS},
+            **{field: 0 for field in USAGE_GAUGE_FIELDS},
+        })
+        bucket = bucket_end
+    total_weight = sum(weights)
+    for field in USAGE_COUNTER_FIELDS:
+        prev_total = rolled_up[field] if rolled_up is not None else 0
+        # The counters may be reset when the live statistics are missing.
+        increment = max(usage[field] - prev_total, 0)
+        remaining = increment
+        if total_weight > 0:
+            for row, weight in zip(rows[:-1], weights):
+                share = increment * weight / total_weight
+                row[field] = int(share) if isinstance(increment, int) else share
+                remaining -= row[field]
+        # The last bucket takes the rest to keep the sum exact.
+        rows[-1][field] = remaining
+    for field in USAGE_GAUGE_FIELDS:
+        rows[-1][field] = usage[field]
+    return rows
+
+
+class UsageRollup(aobject):
+    """
+    Periodically aggregates the resource usage of the kernels into the daily
+    rollup table, so that the usage reports do not need to scan the kernels
+    and their statistics for the whole period.
+
+    Each run rolls up the live kernels using their live statistics and the kernels
+    terminated since the previous run using their last statistics.  The progress of
+    the terminated kernels is kept as the watermark in etcd, and all terminated
+    kernels are rolled up at the first run.  As the rollup of a kernel is idempotent,
+    it is safe to process the same kernel multiple times.
+    """
+
+    local_config: LocalConfig
+    shared_config: SharedConfig
+    event_dispatcher: EventDispatcher
+    registry: AgentRegistry
+
+    lock_manager: aioredlock.Aioredlock
+    timer_redis: aioredis.Redis
+    rollup_timer: GlobalTimer
+
+    def __init__(
+        self,
+        local_config: LocalConfig,
+        shared_config: SharedConfig,
+        event_dispatcher: EventDispatcher,
+        registry: AgentRegistry,
+    ) -> None:
+        self.local_config = local_config
+        self.shared_config = shared_config
+        self.event_dispatcher = event_dispatcher
+        self.registry = registry
+        self.dbpool = registry.dbpool
+        self.interval = local_config['manager']['usage-rollup-interval']
+        self.rollup_lock_timeout = max(self.interval, 120.0)
+
+    async def __ainit__(self) -> None:
+        redis_url = self.shared_config.get_redis_url(db=REDIS_STREAM_DB)
+        # A run may take longer than the interval when there are many kernels to roll up
+        # (e.g., the first run), so skip the ticks while another run holds the lock.
+        self.lock_manager = aioredlock.Aioredlock([str(redis_url)], retry_count=1)
+        self.timer_redis = await aioredis.create_redis(str(redis_url))
+        self._evh_rollup = self.event_dispatcher.consume('do_usage_rollup', None, self.rollup)
+        self.rollup_timer = GlobalTimer(
+            self.timer_redis,
+            self.event_dispatcher,
+            'do_usage_rollup',
+            interval=self.interval,
+        )
+        await self.rollup_timer.join()
+
+    async def close(self) -> None:
+        await self.rollup_timer.leave()
+        self.event_dispatcher.unconsume('do_usage_rollup', self._evh_rollup)
+        await self.lock_manager.destroy()
+        self.timer_redis.close()
+        await self.timer_redis.wait_closed()
+
+    async def rollup(
+        self,
+        context: Any,
+        agent_id: AgentId,
+        event_name: str,
+        *args, **kwargs,
+    ) -> None:
+        try:
+            lock = await self.lock_manager.lock(
+                'manager.usage_rollup',
+                lock_timeout=self.rollup_lock_timeout,
+            )
+            async with lock:
+                await self.rollup_impl(lock)
+        except aioredlock.LockError:
+            log.debug('rollup(): another rollup is running; will be retried.')
+
+    async def rollup_impl(self, lock: aioredlock.Lock = None) -> None:
+        log.debug('rollup(): triggered')
+        now = datetime.now(tzutc())
+        tz = self.shared_config['system']['timezone']
+        raw_watermark = await self.shared_config.etcd.get(WATERMARK_KEY)
+        watermark = isoparse(raw_watermark) - WATERMARK_MARGIN if raw_watermark else None
+        kernel_cols = [
+            kernels.c.id, kernels.c.session_id,
+            kernels.c.domain_name, kernels.c.group_id, kernels.c.user_uuid, kernels.c.access_key,
+            kernels.c.created_at, kernels.c.terminated_at,
+        ]
+
+        num_terminated = 0
+        cursor: Optional[Tuple[datetime, Any]] = None
+        while True:
+            query = (
+                sa.select(kernel_cols + [kernels.c.last_stat])
+                .select_from(kernels)
+                .where(
+                    (kernels.c.status == KernelStatus.TERMINATED) &
+                    (kernels.c.terminated_at.isnot(None))
+                )
+                .order_by(kernels.c.terminated_at, kernels.c.id)
+                .limit(ROLLUP_BATCH_SIZE)
+            )
+            if watermark is not None:
+                query = query.where(kernels.c.terminated_at >= watermark)
+            if cursor is not None:
+                query = query.where(
+                    sa.tuple_(kernels.c.terminated_at, kernels.c.id) > sa.tuple_(*cursor))
+            async with self.dbpool.acquire() as conn, conn.begin():
+                result = await conn.execute(query)
+                rows = await result.fetchall()
+                if rows:
+                    await self._rollup_kernels(
+                        conn, rows, [row['last_stat'] for row in rows], now, tz)
+            if not rows:
+                break
+            num_terminated += len(rows)
+            cursor = (rows[-1]['terminated_at'], rows[-1]['id'])
+            await self.shared_config.etcd.put(WATERMARK_KEY, cursor[0].isoformat())
+            if lock is not None:
+                await self.lock_manager.extend(lock, lock_timeout=self.rollup_lock_timeout)
+            if len(rows) < ROLLUP_BATCH_SIZE:
+                break
+
+        num_live = 0
+        last_id = None
+        while True:
+            query = (
+                sa.select(kernel_cols)
+                .select_from(kernels)
+                .where(kernels.c.status.in_(LIVE_STATUS))
+                .order_by(kernels.c.id)
+                .limit(ROLLUP_BATCH_SIZE)
+            )
+            if last_id is not None:
+                query = query.where(kernels.c.id > last_id)
+            async with self.dbpool.acquire() as conn:
+                result = await conn.execute(query)
+                rows = await result.fetchall()
+            if not rows:
+                break
+            raw_stats = await redis.execute_with_retries(
+                lambda: self.registry.redis_stat.mget(
+                    *[str(row['id']) for row in rows], encoding=None),
+            )
+            stats = [
+                msgpack.unpackb(raw_stat) if raw_stat is not None else None
+                for raw_stat in raw_stats
+            ]
+            async with self.dbpool.acquire() as conn, conn.begin():
+                await self._rollup_kernels(conn, rows, stats, now, tz)
+            num_live += len(rows)
+            last_id = rows[-1]['id']
+            if lock is not None:
+                await self.lock_manager.extend(lock, lock_timeout=self.rollup_lock_timeout)
+            if len(rows) < ROLLUP_BATCH_SIZE:
+                break
+        log.info('rolled up the usage of {} terminated and {} live kernels',
+                 num_terminated, num_live)
+
+    async def _rollup_kernels(
+        self,
+        conn: SAConnection,
+        kernel_rows: Sequence[Mapping[str, Any]],
+        stats: Sequence[Optional[Mapping[str, Any]]],
+        now: datetime,
+        tz: tzinfo,
+    ) -> None:
+        table = usage_daily
+        kernel_ids = [row['id'] for row in kernel_rows]
+        usages = [read_usage_stat(stat) for stat in stats]
+        query = (
+            sa.select([
+                table.c.kernel_id,
+                sa.func.max(table.c.bucket).label('last_bucket'),
+                sa.func.sum(table.c.used_seconds).label('used_seconds'),
+                *[
+                    sa.cast(sa.func.sum(table.c[field]), table.c[field].type).label(field)
+                    for field in USAGE_COUNTER_FIELDS
+                ],
+            ])
+            .select_from(table)
+            .where(table.c.kernel_id.in_(kernel_ids))
+            .group_by(table.c.kernel_id)
+        )
+        result = await conn.execute(query)
+        rolled_up = {row['kernel_id']: row for row in await result.fetchall()}
+        values: List[Dict[str, Any]] = []
+        for kernel, usage in zip(kernel_rows, usages):
+            values.extend(build_usage_rows(
+                kernel, usage, rolled_up.get(kernel['id']),
+                now, tz, floor_day, next_day,
+            ))
+        for idx in range(0, len(values), ROLLUP_INSERT_SIZE):
+            insert_query = pgsql.insert(table).values(values[idx:idx + ROLLUP_INSERT_SIZE])
+            insert_query = insert_query.on_conflict_do_update(
+                index_elements=[table.c.kernel_id, table.c.bucket],
+                set_={
+                    'used_seconds': insert_query.excluded.used_seconds,
+                    **{
+                        field: table.c[field] + insert_query.excluded[field]
+                        for field in USAGE_COUNTER_FIELDS
+                    },
+                    **{
+                        field: sa.func.greatest(table.c[field], insert_query.excluded[field])
+                        for field in USAGE_GAUGE_FIELDS
+                    },
+                },
+            )
+            await conn.execute(insert_query)
@@ -0,0 +1,18 @@
+from ai.backend.gateway.admin import is_readonly_operation
+
+
+def test_is_readonly_operation():
+    assert is_readonly_operation('{ agents { id } }', None)
+    assert is_readonly_operation('query { agents { id } }', None)
+    assert not is_readonly_operation(
+        'mutation { modify_keypair(access_key: "x", props: {}) { ok } }', None)
+    assert not is_readonly_operation('{ agents { id }', None)  # syntax error
+
+    document = '''
+    query q1 { agents { id } }
+    mutation m1 { delete_keypair(access_key: "x") { ok } }
+    '''
+    assert is_readonly_operation(document, 'q1')
+    assert not is_readonly_operation(document, 'm1')
+    assert not is_readonly_operation(document, 'unknown')
+    assert not is_readonly_operation(document, None)  # ambiguous
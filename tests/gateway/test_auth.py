@@ -1,12 +1,21 @@
 from collections import UserDict
 from datetime import datetime, timedelta
+import hmac
 import json
 import uuid
 
 from dateutil.tz import tzutc, gettz
 import pytest
 
-from ai.backend.gateway.auth import _extract_auth_params, check_date
+from ai.backend.gateway.auth import (
+    AuthContext,
+    AuthContextCache,
+    KeypairUsageBuffer,
+    _derive_signing_key,
+    _extract_auth_params,
+    _parse_http_date,
+    check_date,
+)
 from ai.backend.gateway.server import shared_config_ctx, database_ctx, monitoring_ctx
 from ai.backend.gateway.exceptions import InvalidAuthParameters
 
@@ -79,6 +88,73 @@ def test_check_date():
     assert check_date(request)
 
 
+def test_parse_http_date():
+    assert _parse_http_date('Sun, 06 Nov 1994 08:49:37 GMT') == \
+        datetime(1994, 11, 6, 8, 49, 37, tzinfo=tzutc())
+    # Other formats are left to the fallback parser.
+    assert _parse_http_date('Sunday, 06-Nov-94 08:49:37 GMT') is None
+    assert _parse_http_date('Sun, 06 Nov 1994 08:49:37 KST') is None
+    assert _parse_http_date('Sun, 06 Xyz 1994 08:49:37 GMT') is None
+    assert _parse_http_date('Sun, 36 Nov 1994 08:49:37 GMT') is None
+
+
+def test_derive_signing_key():
+    _derive_signing_key.cache_clear()
+    key = _derive_signing_key('fake-sk', '20201010', 'localhost', 'sha256')
+    assert key == hmac.new(
+        hmac.new(b'fake-sk', b'20201010', 'sha256').digest(),
+        b'localhost', 'sha256',
+    ).digest()
+    assert _derive_signing_key('fake-sk', '20201010', 'localhost', 'sha256') == key
+    assert _derive_signing_key.cache_info().hits == 1
+    assert _derive_signing_key('fake-sk', '20201011', 'localhost', 'sha256') != key
+
+
+def test_auth_context_cache():
+    def make_auth_ctx(email, policy):
+        return AuthContext(
+            secret_key='fake-sk',
+            keypair={'is_admin': False},
+            resource_policy={'name': policy},
+            user={'email': email, 'role': 'user'},
+        )
+
+    cache = AuthContextCache(ttl=60.0, maxsize=3)
+    cache.put('ak1', make_auth_ctx('a@example.com', 'default'))
+    cache.put('ak2', make_auth_ctx('a@example.com', 'custom'))
+    cache.put('ak3', make_auth_ctx('b@example.com', 'default'))
+    assert cache.get('ak1').user['email'] == 'a@example.com'
+    # the least recently used entry (ak2) is evicted.
+    cache.put('ak4', make_auth_ctx('c@example.com', 'custom'))
+    assert len(cache) == 3
+    assert cache.get('ak2') is None
+
+    cache.invalidate('access_key', 'ak4')
+    assert cache.get('ak4') is None
+    cache.invalidate('user', 'a@example.com')
+    assert cache.get('ak1') is None
+    assert cache.get('ak3') is not None
+    cache.invalidate('resource_policy', 'default')
+    assert len(cache) == 0
+
+    # ttl=0 disables caching.
+    cache = AuthContextCache(ttl=0)
+    cache.put('ak1', make_auth_ctx('a@example.com', 'default'))
+    assert cache.get('ak1') is None
+
+
+def test_keypair_usage_buffer():
+    buffer = KeypairUsageBuffer()
+    t1 = datetime.now(tzutc())
+    t2 = t1 + timedelta(seconds=1)
+    buffer.record('ak1', t1)
+    buffer.record('ak1', t2)
+    buffer.record('ak2', t1)
+    assert len(buffer) == 2
+    assert buffer._usage['ak1'] == (t2, 2)
+    assert buffer._usage['ak2'] == (t1, 1)
+
+
 @pytest.mark.asyncio
 async def test_authorize(etcd_fixture, database_fixture, create_app_and_client, get_headers):
     # The auth module requires config_server and database to be set up.
@@ -40,3 +40,55 @@ async def test_check_rlim_for_authorized_query(etcd_fixture, database_fixture,
     assert '30000' == ret.headers['X-RateLimit-Limit']
     assert '29999' == ret.headers['X-RateLimit-Remaining']
     assert str(rlim._rlim_window) == ret.headers['X-RateLimit-Window']
+
+
+@pytest.mark.asyncio
+async def test_check_rlim_with_sliding_window(etcd_fixture, database_fixture,
+                                              create_app_and_client,
+                                              get_headers, local_config,
+                                              monkeypatch):
+    monkeypatch.setitem(local_config['manager'], 'rate-limiter', 'sliding-window')
+    monkeypatch.setitem(local_config['manager'], 'rate-limit-endpoint-overrides',
+                        {'POST /auth/test': 2})
+    app, client = await create_app_and_client(
+        [shared_config_ctx, redis_ctx, database_ctx, monitoring_ctx],
+        ['.auth', '.ratelimit'],
+    )
+    url = '/auth/test'
+    req_bytes = json.dumps({'echo': 'hello!'}).encode()
+    for expected_remaining in ('29999', '29998'):
+        headers = get_headers('POST', url, req_bytes)
+        ret = await client.post(url, data=req_bytes, headers=headers)
+        assert ret.status == 200
+        assert '30000' == ret.headers['X-RateLimit-Limit']
+        assert expected_remaining == ret.headers['X-RateLimit-Remaining']
+    # The per-endpoint limit is exceeded.
+    headers = get_headers('POST', url, req_bytes)
+    ret = await client.post(url, data=req_bytes, headers=headers)
+    assert ret.status == 429
+
+
+@pytest.mark.asyncio
+async def test_sliding_window_token_lease(etcd_fixture, database_fixture,
+                                          create_app_and_client):
+    app, client = await create_app_and_client(
+        [shared_config_ctx, redis_ctx, database_ctx, monitoring_ctx],
+        ['.ratelimit'],
+    )
+    limiter = rlim.SlidingWindowRateLimiter(app['redis_stat'], lease_size=10)
+    key = 'test-lease-key'
+    # The first call reserves 10 tokens from Redis and the subsequent calls use them locally.
+    assert await limiter.consume(key, 1000) == 1
+    for i in range(2, 11):
+        assert await limiter.consume(key, 1000) == i
+    assert await limiter.consume(key, 1000) == 11
+    # Another process has its own lease while sharing the counter.
+    other_limiter = rlim.SlidingWindowRateLimiter(app['redis_stat'], lease_size=10)
+    assert await other_limiter.consume(key, 1000) == 21
+    assert await other_limiter.consume(key, 1000) == 22
+    # Small rate limits do not use leases.
+    small_key = 'test-lease-key-small'
+    assert await other_limiter.consume(small_key, 50) == 1
+    assert await other_limiter.consume(small_key, 50) == 2
+    assert small_key not in other_limiter._leases
+    await app['redis_stat'].delete(*(await app['redis_stat'].keys('test-lease-key*')))
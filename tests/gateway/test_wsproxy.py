@@ -0,0 +1,190 @@
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock
+
+import aiohttp
+import pytest
+
+from ai.backend.gateway.wsproxy import (
+    MAX_CHUNK_SIZE,
+    MIN_CHUNK_SIZE,
+    ProxyMemoryBudget,
+    TCPProxy,
+    WebSocketProxy,
+    _TCPProxyProtocol,
+)
+
+
+class DummyWebSocket:
+
+    def __init__(self) -> None:
+        self.messages: asyncio.Queue = asyncio.Queue()
+        self.send_bytes = AsyncMock()
+        self.pong = AsyncMock()
+        self.close = AsyncMock()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> aiohttp.WSMessage:
+        msg = await self.messages.get()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
+
+@pytest.mark.asyncio
+async def test_tcp_proxy_protocol_adaptive_chunks():
+    payload = bytes(range(256)) * 40000
+
+    async def handle(reader, writer):
+        writer.write(payload)
+        await writer.drain()
+        data = await reader.read(5)
+        writer.write(data[::-1])
+        await writer.drain()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        _, protocol = await asyncio.get_running_loop().create_connection(
+            _TCPProxyProtocol, '127.0.0.1', port)
+        received = bytearray()
+        chunk_sizes = []
+        while len(received) < len(payload):
+            chunk = await protocol.read_chunk()
+            chunk_sizes.append(len(chunk))
+            received += chunk
+            # simulate a slow consumer to let the chunks coalesce
+            await asyncio.sleep(0.001)
+        assert received[:len(payload)] == payload
+        assert max(chunk_sizes) <= MAX_CHUNK_SIZE
+        assert max(chunk_sizes) > MIN_CHUNK_SIZE
+
+        protocol.write(b'hello')
+        await protocol.drain()
+        remaining = received[len(payload):]
+        while (chunk := await protocol.read_chunk()) is not None:
+            remaining += chunk
+        assert remaining == b'olleh'
+        protocol.close()
+    finally:
+        server.close()
+        await server.wait_closed()
+
+
+@pytest.mark.asyncio
+async def test_proxy_memory_budget():
+    budget = ProxyMemoryBudget(100)
+    await budget.reserve(80)
+    waiter = asyncio.create_task(budget.reserve(30))
+    await asyncio.sleep(0)
+    assert not waiter.done()
+    budget.release(50)
+    await waiter
+    assert budget.used == 60
+
+    # A cancelled waiter does not hold the budget.
+    waiter = asyncio.create_task(budget.reserve(50))
+    await asyncio.sleep(0)
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+    assert budget.used == 60
+    budget.release(60)
+
+    # An oversized reservation is allowed only when nothing else is reserved.
+    await budget.reserve(500)
+    assert budget.used == 500
+    budget.release(500)
+
+    unlimited = ProxyMemoryBudget(0)
+    await unlimited.reserve(10 ** 9)
+
+
+@pytest.mark.asyncio
+async def test_websocket_proxy_backpressure():
+    sending = asyncio.Event()
+
+    async def send_bytes(data):
+        await sending.wait()
+
+    up_conn = MagicMock()
+    up_conn.send_bytes = AsyncMock(side_effect=send_bytes)
+    budget = ProxyMemoryBudget(1000)
+    proxy = WebSocketProxy(
+        up_conn, MagicMock(),
+        high_water=300, low_water=100, memory_budget=budget,
+    )
+    for _ in range(3):
+        await proxy.write(b'x' * 100, aiohttp.WSMsgType.BINARY)
+    assert proxy.buffered_bytes == 300
+    assert budget.used == 300
+
+    # The writer is blocked above the high-water mark.
+    writer = asyncio.create_task(proxy.write(b'x' * 100, aiohttp.WSMsgType.BINARY))
+    await asyncio.sleep(0)
+    assert not writer.done()
+
+    # ...until the buffer drains below the low-water mark.
+    consumer = asyncio.create_task(proxy.consume_upstream_buffer())
+    sending.set()
+    await writer
+    assert budget.used == proxy.buffered_bytes
+    consumer.cancel()
+    await asyncio.gather(consumer, return_exceptions=True)
+
+
+@pytest.mark.asyncio
+async def test_tcp_proxy_memory_budget():
+    # large enough to stay in the transport's write buffer over the socket buffers
+    payload = b'x' * (32 * 1024 * 1024)
+    service_reading = asyncio.Event()
+    service_closing = asyncio.Event()
+    received = bytearray()
+
+    async def handle(reader, writer):
+        await service_reading.wait()
+        received.extend(await reader.readexactly(len(payload)))
+        await service_closing.wait()
+        writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    try:
+        ws = DummyWebSocket()
+        budget = ProxyMemoryBudget(64 * 1024 * 1024)
+        proxy = TCPProxy(
+            ws, '127.0.0.1', port,
+            high_water=len(payload) * 2, low_water=len(payload),
+            memory_budget=budget,
+        )
+        proxy_task = asyncio.create_task(proxy.proxy())
+        await ws.messages.put(aiohttp.WSMessage(aiohttp.WSMsgType.BINARY, payload, None))
+        while not ws.messages.empty():
+            await asyncio.sleep(0.01)
+        await asyncio.sleep(0.01)
+        # The data not yet written to the service holds the budget.
+        assert 0 < budget.used == proxy.buffered_bytes <= len(payload)
+
+        # The reservation is released as the service consumes the data,
+        # even though the client sends nothing more and the connection is kept open.
+        service_reading.set()
+        deadline = time.monotonic() + 5.0
+        while budget.used > 0:
+            assert time.monotonic() < deadline, 'the budget is not released'
+            await asyncio.sleep(0.01)
+        assert proxy.buffered_bytes == 0
+        while len(received) < len(payload):
+            assert time.monotonic() < deadline, 'the service has not received the data'
+            await asyncio.sleep(0.01)
+
+        service_closing.set()
+        await ws.messages.put(None)
+        await proxy_task
+        assert budget.used == 0
+        assert received == payload
+        ws.close.assert_awaited()
+    finally:
+        server.close()
+        await server.wait_closed()
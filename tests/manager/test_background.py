@@ -0,0 +1,36 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, call
+import uuid
+
+import pytest
+
+from ai.backend.manager.background import ProgressReporter
+
+
+@pytest.mark.asyncio
+async def test_progress_reporter_trailing_update():
+    reporter = ProgressReporter(MagicMock(), uuid.uuid4(), total_progress=10,
+                                max_updates_per_sec=10)
+    reporter._emit = AsyncMock()
+
+    await reporter.update(1, 'a')
+    reporter._emit.assert_awaited_once_with(1, 10, 'a')
+
+    # The throttled updates are emitted together when the interval passes.
+    await reporter.update(1, 'b')
+    await reporter.update(1, 'c')
+    assert reporter._emit.await_count == 1
+    await asyncio.sleep(0.15)
+    assert reporter._emit.await_args_list == [call(1, 10, 'a'), call(3, 10, 'c')]
+
+    # The completing update is emitted immediately, dropping the pending one.
+    await reporter.update(1, 'd')
+    await reporter.update(6, 'e')
+    assert reporter._emit.await_args == call(10, 10, 'e')
+    assert reporter._emit.await_count == 3
+
+    # Closing the reporter drops the pending update.
+    await reporter.update(-1)
+    await reporter.close()
+    await asyncio.sleep(0.15)
+    assert reporter._emit.await_count == 3
@@ -0,0 +1,24 @@
+from uuid import UUID
+
+from ai.backend.manager.models.kernel import _escape_like, _uuid_prefix_range
+
+
+def test_uuid_prefix_range():
+    assert _uuid_prefix_range('8f3a') == (
+        UUID('8f3a0000-0000-0000-0000-000000000000'),
+        UUID('8f3affff-ffff-ffff-ffff-ffffffffffff'),
+    )
+    assert _uuid_prefix_range('8F3A1B2C-d4') == (
+        UUID('8f3a1b2c-d400-0000-0000-000000000000'),
+        UUID('8f3a1b2c-d4ff-ffff-ffff-ffffffffffff'),
+    )
+    full_id = UUID('8f3a1b2c-d4e5-46f7-8a9b-0c1d2e3f4a5b')
+    assert _uuid_prefix_range(str(full_id)) == (full_id, full_id)
+    assert _uuid_prefix_range('my-session') is None
+    assert _uuid_prefix_range('8f3a1b2c' * 5) is None
+
+
+def test_escape_like():
+    assert _escape_like('my_session') == 'my\\_session'
+    assert _escape_like('100%') == '100\\%'
+    assert _escape_like('a\\b') == 'a\\\\b'
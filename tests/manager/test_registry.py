@@ -3,11 +3,18 @@ from typing import (
     Mapping,
 )
 from unittest.mock import MagicMock, AsyncMock
+import uuid
 
+import pytest
 import snappy
 from sqlalchemy.sql.dml import Insert, Update
 
-from ai.backend.manager.registry import AgentRegistry
+from ai.backend.manager.registry import (
+    AgentRegistry,
+    SessionRoute,
+    SessionRoutingCache,
+    SessionUsageBuffer,
+)
 from ai.backend.manager.models import AgentStatus
 from ai.backend.common import msgpack
 from ai.backend.common.types import ResourceSlot
@@ -141,3 +148,210 @@ async def test_handle_heartbeat(mocker):
     assert q.parameters['scaling_group'] == 'sg-testing2'
     assert 'compute_plugins' in q.parameters
     assert 'version' in q.parameters
+
+
+def _make_route(session_id: uuid.UUID) -> SessionRoute:
+    return SessionRoute(
+        kernel_id=session_id,
+        session_id=session_id,
+        agent='i-001',
+        agent_addr='tcp://10.0.0.5:6001',
+        kernel_host=None,
+        repl_in_port=2000,
+        repl_out_port=2001,
+        stdin_port=2002,
+        stdout_port=2003,
+        service_ports=[],
+    )
+
+
+def test_session_routing_cache():
+    cache = SessionRoutingCache(ttl=30.0, maxsize=2)
+    sid1, sid2 = uuid.uuid4(), uuid.uuid4()
+    route1, route2 = _make_route(sid1), _make_route(sid2)
+    cache.put('ak1', 'sess1', route1)
+    cache.put('ak1', str(sid1), route1)
+    assert cache.get('ak1', 'sess1') is route1
+    assert cache.get('ak2', 'sess1') is None
+
+    # Invalidation by session ID removes all aliases of the session.
+    cache.invalidate_session(sid1)
+    assert len(cache) == 0
+    assert cache.get('ak1', 'sess1') is None
+    assert cache.get('ak1', str(sid1)) is None
+
+    # The least recently used entry is evicted.
+    cache.put('ak1', 'sess1', route1)
+    cache.put('ak1', 'sess2', route2)
+    cache.get('ak1', 'sess1')
+    cache.put('ak1', 'sess3', route2)
+    assert cache.get('ak1', 'sess2') is None
+    assert cache.get('ak1', 'sess1') is route1
+    cache.invalidate_session(sid2)
+    assert len(cache) == 1
+
+    disabled_cache = SessionRoutingCache(ttl=0)
+    disabled_cache.put('ak1', 'sess1', route1)
+    assert disabled_cache.get('ak1', 'sess1') is None
+
+
+@pytest.mark.asyncio
+async def test_session_route_cache_exact_matches_only():
+    registry = AgentRegistry(
+        shared_config=MagicMock(),
+        dbpool=MagicMock(),
+        redis_stat=MagicMock(),
+        redis_live=MagicMock(),
+        redis_image=MagicMock(),
+        event_dispatcher=MagicMock(),
+        storage_manager=None,
+        hook_plugin_ctx=MagicMock(),
+        session_route_cache=SessionRoutingCache(ttl=30.0),
+    )
+    sid = uuid.uuid4()
+    kernel = {
+        'id': sid,
+        'session_id': sid,
+        'session_name': 'sess1',
+        'agent': 'i-001',
+        'agent_addr': 'tcp://10.0.0.5:6001',
+        'kernel_host': None,
+        'repl_in_port': 2000,
+        'repl_out_port': 2001,
+        'stdin_port': 2002,
+        'stdout_port': 2003,
+        'service_ports': [],
+    }
+    registry.get_session = AsyncMock(return_value=kernel)
+
+    # The exact session name and ID are cached.
+    for name_or_id in ('sess1', str(sid), 'sess1', str(sid)):
+        route = await registry.get_session_route(name_or_id, 'ak1')
+        assert route.session_id == sid
+    assert registry.get_session.await_count == 2
+
+    # The prefixes are looked up every time as they may match other sessions later.
+    for name_or_id in ('sess', str(sid)[:8], 'sess', str(sid)[:8]):
+        await registry.get_session_route(name_or_id, 'ak1')
+    assert registry.get_session.await_count == 6
+    assert len(registry.session_route_cache) == 2
+
+
+@pytest.mark.asyncio
+async def test_session_usage_buffer():
+    buffer = SessionUsageBuffer()
+    buffer.record('sess1', 'ak1')
+    buffer.record('sess1', 'ak1')
+    buffer.record('sess2', 'ak1')
+    assert len(buffer) == 2
+    assert buffer._usage[('sess1', 'ak1')] == 2
+
+    mock_dbpool = MagicMock()
+    mock_dbconn = MagicMock()
+    mock_dbconn_ctx = MagicMock()
+    mock_dbpool.acquire = MagicMock(return_value=mock_dbconn_ctx)
+    mock_dbconn_ctx.__aenter__ = AsyncMock(return_value=mock_dbconn)
+    mock_dbconn_ctx.__aexit__ = AsyncMock(return_value=False)
+
+    # Failed writes are retried at the next flush.
+    mock_dbconn.execute = AsyncMock(side_effect=ConnectionError)
+    await buffer.flush(mock_dbpool)
+    buffer.record('sess1', 'ak1')
+    assert buffer._usage[('sess1', 'ak1')] == 3
+
+    mock_dbconn.execute = AsyncMock()
+    await buffer.flush(mock_dbpool)
+    assert len(buffer) == 0
+    q = mock_dbconn.execute.await_args.args[0]
+    assert isinstance(q, Update)
+
+
+@pytest.fixture
+def registry_with_mock_rpc(mocker):
+    """
+    Returns an AgentRegistry which routes all sessions to a single kernel,
+    along with the mocked agent RPC client and RPCContext.
+    """
+    registry = AgentRegistry(
+        shared_config=MagicMock(),
+        dbpool=MagicMock(),
+        redis_stat=MagicMock(),
+        redis_live=MagicMock(),
+        redis_image=MagicMock(),
+        event_dispatcher=MagicMock(),
+        storage_manager=None,
+        hook_plugin_ctx=MagicMock(),
+    )
+    registry.get_session_route = AsyncMock(return_value=_make_route(uuid.uuid4()))
+    mock_rpc = MagicMock()
+    mock_rpc_ctx = MagicMock()
+    mock_rpc_ctx.__aenter__ = AsyncMock(return_value=mock_rpc)
+    mock_rpc_ctx.__aexit__ = AsyncMock(return_value=False)
+    mock_rpc_context = MagicMock(return_value=mock_rpc_ctx)
+    mocker.patch('ai.backend.manager.registry.RPCContext', mock_rpc_context)
+    return registry, mock_rpc, mock_rpc_context
+
+
+@pytest.mark.asyncio
+async def test_execute_stream(registry_with_mock_rpc):
+    registry, mock_rpc, mock_rpc_context = registry_with_mock_rpc
+    mock_rpc.call.execute = AsyncMock(side_effect=[
+        None,
+        {'status': 'continued', 'console': [['stdout', 'a']]},
+        {'status': 'waiting-input', 'console': []},
+        {'status': 'finished', 'console': [['stdout', 'b']]},
+    ])
+    read_input = AsyncMock(return_value='hello')
+
+    results = [
+        result async for result in registry.execute_stream(
+            'sess1', 'ak1', (4, '20190615'), 'run1', 'query', 'print(1)', {'x': 1},
+            read_input=read_input,
+        )
+    ]
+    assert [r['status'] for r in results] == ['continued', 'waiting-input', 'finished']
+    # The session route and the RPC context are resolved only once per run.
+    registry.get_session_route.assert_awaited_once()
+    mock_rpc_context.assert_called_once()
+    read_input.assert_awaited_once()
+    calls = mock_rpc.call.execute.await_args_list
+    assert [c.args[2:5] for c in calls] == [
+        ('run1', 'query', 'print(1)'),
+        ('run1', 'continue', ''),
+        ('run1', 'continue', ''),
+        ('run1', 'input', 'hello'),
+    ]
+    assert calls[0].args[1] == 3
+    assert calls[0].args[5] == {'x': 1}
+    assert calls[1].args[5] == {}
+
+
+@pytest.mark.asyncio
+async def test_file_chunks(registry_with_mock_rpc):
+    registry, mock_rpc, mock_rpc_context = registry_with_mock_rpc
+    content = b'0123456789'
+    mock_rpc.call.upload_file_chunk = AsyncMock()
+    mock_rpc.call.truncate_file = AsyncMock()
+    mock_rpc.call.download_file_chunk = AsyncMock(
+        side_effect=lambda kid, path, offset, size: content[offset:offset + size])
+
+    async def read_chunks():
+        yield b'abcd'
+        yield b'efg'
+
+    # The upload resumes from the given offset and advances it per chunk.
+    offset = await registry.upload_file_chunks('sess1', 'ak1', 'a.txt', 5, read_chunks())
+    assert offset == 12
+    calls = mock_rpc.call.upload_file_chunk.await_args_list
+    assert [c.args[1:] for c in calls] == [('a.txt', 5, b'abcd'), ('a.txt', 9, b'efg')]
+    mock_rpc_context.assert_called_once()
+
+    # The download reads only the requested range, stopping at the end of the file.
+    chunks = [
+        chunk async for chunk in registry.download_file_chunks(
+            'sess1', 'ak1', 'a.txt', 3, 20, chunk_size=4)
+    ]
+    assert chunks == [b'3456', b'789']
+
+    await registry.truncate_file('sess1', 'ak1', 'a.txt', 5)
+    assert mock_rpc.call.truncate_file.await_args.args[1:] == ('a.txt', 5)